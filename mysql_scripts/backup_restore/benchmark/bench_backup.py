@@ -0,0 +1,462 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import ast
+import getpass
+import hashlib
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# 功能：
+#   1. 不需要MySQL，使用fake_xtrabackup.py代替xtrabackup，在工作目录中生成合成的datadir
+#   2. 以命令行方式执行指定版本的mysql_backup.py（复制后替换配置项），测量以下场景的耗时及子进程CPU时间：
+#      full: 全量备份
+#      incr: 增量备份
+#      chain: 长备份链（合成的全备及--chain个增量备份）上的增量备份，包括备份链检查，首次执行(cold)及再次执行(warm)
+#      monitor: --index-lines行index文件下的monitor
+#      prune: --old-backups个过期全备时的全量备份（包括删除过期备份）
+#      copy: 复制至localhost的全量备份，需要ssh localhost无密钥访问
+#   3. 结果保存为json，--compare与之前的结果比较各场景耗时的中位数
+# 用法：
+#   SHELL> python bench_backup.py --output new.json
+#   SHELL> python bench_backup.py --script /path/to/old/mysql_backup.py --output old.json
+#   SHELL> python bench_backup.py --compare old.json --output new.json
+
+SCENARIOS = ('full', 'incr', 'chain', 'monitor', 'prune', 'copy')
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAKE_XTRABACKUP = os.path.join(BENCH_DIR, 'fake_xtrabackup.py')
+
+PAGE_SIZE = 16384
+
+DATEFMT = '%Y%m%d_%H%M%S'
+
+
+class BenchError(Exception):
+    def __init__(self, message):
+        super(BenchError, self).__init__(message)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MySQL Backup Benchmark')
+    parser.add_argument('--script',
+                        default=os.path.join(os.path.dirname(BENCH_DIR), 'mysql_backup.py'),
+                        help='mysql_backup.py to benchmark, default: ../mysql_backup.py')
+    parser.add_argument('--python',
+                        default=sys.executable,
+                        help='python to run mysql_backup.py (old versions may need python2), default: {0}'.format(
+                            sys.executable))
+    parser.add_argument('--work-dir',
+                        help='dir for datadir and backups, default: a temp dir removed after benchmark')
+    parser.add_argument('--only',
+                        help='comma separated scenarios, default: all ({0})'.format(','.join(SCENARIOS)))
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='runs of each scenario, default: 3')
+    parser.add_argument('--mode',
+                        choices=('dir', 'stream'),
+                        default='dir',
+                        help='BACKUP_MODE, default: dir')
+    parser.add_argument('--datadir-mb',
+                        type=int,
+                        default=256,
+                        help='synthetic datadir size (MB), default: 256')
+    parser.add_argument('--tables',
+                        type=int,
+                        default=16,
+                        help='.ibd files in synthetic datadir, default: 16')
+    parser.add_argument('--compressibility',
+                        type=float,
+                        default=0.5,
+                        help='zero filled ratio of each page, default: 0.5')
+    parser.add_argument('--change-ratio',
+                        type=float,
+                        default=0.05,
+                        help='changed pages between backups, default: 0.05')
+    parser.add_argument('--chain',
+                        type=int,
+                        default=200,
+                        help='incremental backups in chain scenario, default: 200')
+    parser.add_argument('--index-lines',
+                        type=int,
+                        default=200000,
+                        help='index file lines in monitor scenario, default: 200000')
+    parser.add_argument('--monitor-key',
+                        default='backup_elapsed',
+                        help='monitor key, default: backup_elapsed')
+    parser.add_argument('--old-backups',
+                        type=int,
+                        default=10,
+                        help='expired full backups in prune scenario, default: 10')
+    parser.add_argument('--old-backup-mb',
+                        type=int,
+                        default=64,
+                        help='size of each expired full backup (MB), default: 64')
+    parser.add_argument('--set',
+                        action='append',
+                        default=[],
+                        metavar='NAME=VALUE',
+                        help='override conf item of mysql_backup.py, value is a python literal, can repeat')
+    parser.add_argument('--output',
+                        help='result json file, default: print only')
+    parser.add_argument('--compare',
+                        help='previous result json file to compare with')
+    return parser.parse_args()
+
+
+# 生成合成的datadir：ibdata1及--tables个.ibd文件，每页前部为随机数据、后部填充0
+def make_datadir(datadir, size_mb, tables, compressibility):
+    page = int(PAGE_SIZE * (1 - compressibility))
+    files = [('ibdata1', size_mb // 8 or 1)]
+    table_mb = max(1, (size_mb - files[0][1]) // max(1, tables))
+    files.extend((os.path.join('bench', 't{0}.ibd'.format(i)), table_mb) for i in range(tables))
+
+    for rel_path, mb in files:
+        path = os.path.join(datadir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            for _ in range(mb * 1024 * 1024 // PAGE_SIZE):
+                fp.write(os.urandom(page) + b'\0' * (PAGE_SIZE - page))
+
+    return sum(mb for rel_path, mb in files) * 1024 * 1024
+
+
+# 复制mysql_backup.py并替换配置项，不存在的配置项（旧版本没有）跳过
+# 返回：跳过的配置项
+def patch_script(src, dest, conf):
+    with open(src) as fp:
+        source = fp.read()
+
+    skipped = []
+    for name, value in sorted(conf.items()):
+        pattern = re.compile(r'^{0} = .*$'.format(name), re.M)
+        if not pattern.search(source):
+            skipped.append(name)
+            continue
+        source = pattern.sub(lambda m: '{0} = {1!r}'.format(name, value), source, count=1)
+
+    with open(dest, 'w') as fp:
+        fp.write(source)
+    return skipped
+
+
+# 执行一次mysql_backup.py
+# 返回：{seconds, cpu_seconds}
+def run(python, script, args, env, log):
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    begin = time.time()
+
+    with open(log, 'a') as log_fp:
+        log_fp.write('# {0} {1}\n'.format(datetime.now().strftime(DATEFMT), ' '.join(args)))
+        log_fp.flush()
+        returncode = subprocess.call([python, script] + args, env=env, stdout=log_fp, stderr=log_fp)
+
+    seconds = time.time() - begin
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if returncode != 0:
+        raise BenchError('Command failed: {0}, Return code: {1}, see {2}'.format(' '.join(args), returncode, log))
+
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    return {'seconds': round(seconds, 3), 'cpu_seconds': round(cpu, 3)}
+
+
+def summarize(runs, **extra):
+    seconds = sorted(r['seconds'] for r in runs)
+    result = {
+        'runs': runs,
+        'median': seconds[len(seconds) // 2],
+        'min': seconds[0],
+        'max': seconds[-1]
+    }
+    result.update(extra)
+    return result
+
+
+class Bench(object):
+    def __init__(self, args, work_dir):
+        self.args = args
+        self.work_dir = work_dir
+        self.datadir = os.path.join(work_dir, 'datadir')
+        self.cnf = os.path.join(work_dir, 'my.cnf')
+        self.log = os.path.join(work_dir, 'bench.log')
+        self.results = {}
+        self.skipped_conf = set()
+        self.env = dict(os.environ, BENCH_CHANGE_RATIO=str(args.change_ratio))
+
+        # xtrabackup需为可执行文件
+        self.xtrabackup = os.path.join(work_dir, 'xtrabackup')
+        with open(self.xtrabackup, 'w') as fp:
+            fp.write('#!/bin/sh\nexec {0} {1} "$@"\n'.format(sys.executable, FAKE_XTRABACKUP))
+        os.chmod(self.xtrabackup, 0o755)
+
+        with open(self.cnf, 'w') as fp:
+            fp.write('[client]\nsocket = {0}\n\n[mysqld]\ndatadir = {1}\nsocket = {0}\n'.format(
+                os.path.join(work_dir, 'mysql.sock'), self.datadir))
+
+        self.data_bytes = make_datadir(self.datadir, args.datadir_mb, args.tables, args.compressibility)
+
+    # 为一个场景准备备份目录及mysql_backup.py
+    # 返回：(脚本路径, 备份目录)
+    def prepare(self, name, **conf):
+        target = os.path.join(self.work_dir, name)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.makedirs(target)
+
+        settings = {
+            'TARGET_PATH': target,
+            'MYSQL_CNF': self.cnf,
+            'XTRABACKUP': self.xtrabackup,
+            'BACKUP_MODE': self.args.mode,
+            'COPY_TO_REMOTE': 'off',
+            'BACKUP_REDUNDANCY': 1,
+            'LOCK_PATH': target
+        }
+        settings.update(conf)
+        for item in self.args.set:
+            key, value = item.split('=', 1)
+            settings[key.strip()] = ast.literal_eval(value)
+
+        script = os.path.join(self.work_dir, 'mysql_backup_{0}.py'.format(name))
+        self.skipped_conf.update(patch_script(self.args.script, script, settings))
+        return script, target
+
+    def run(self, script, *args):
+        return run(self.args.python, script, list(args), self.env, self.log)
+
+    # 生成合成的备份目录：xtrabackup_checkpoints等元数据及data_mb大小的数据文件，并写入index文件
+    def make_backup_dir(self, target, name, from_lsn, to_lsn, data_mb=0):
+        path = os.path.join(target, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'xtrabackup_checkpoints'), 'w') as fp:
+            fp.write('backup_type = {0}\nfrom_lsn = {1}\nto_lsn = {2}\nlast_lsn = {2}\ncompact = 0\n'
+                     'recover_binlog_info = 0\n'.format('incremental' if from_lsn else 'full-backuped', from_lsn,
+                                                        to_lsn))
+        with open(os.path.join(path, 'xtrabackup_binlog_info'), 'w') as fp:
+            fp.write('mysql-bin.000001\t{0}\n'.format(to_lsn % 1000000))
+        if data_mb:
+            with open(os.path.join(path, 'ibdata1'), 'wb') as fp:
+                for _ in range(data_mb):
+                    fp.write(os.urandom(1024 * 1024))
+
+        with open(os.path.join(target, 'mysql_backup.index'), 'a') as fp:
+            for event_name in ('backup_begin', 'backup_end'):
+                fp.write('{0}\t{1}\t{2}\n'.format(path, event_name, name[:15]))
+        return path
+
+    # 生成合成的备份链：一个全备及incrementals个增量备份，时间早于当前时间
+    # 返回：最后一个备份的to_lsn
+    def make_chain(self, target, incrementals, begin):
+        lsn = 8 * 1024 * 1024
+        self.make_backup_dir(target, begin.strftime(DATEFMT) + '_base', 0, lsn)
+        for i in range(incrementals):
+            name = (begin + timedelta(minutes=i + 1)).strftime(DATEFMT) + '_incr'
+            self.make_backup_dir(target, name, lsn, lsn + 1000000)
+            lsn += 1000000
+
+        # 之后的增量备份从该LSN继续
+        with open(os.path.join(self.datadir, '.bench_lsn'), 'w') as fp:
+            json.dump({'lsn': lsn, 'binlog_pos': 4}, fp)
+        return lsn
+
+    def bench_full(self):
+        runs = []
+        for _ in range(self.args.repeat):
+            script, target = self.prepare('full')
+            runs.append(self.run(script, 'full'))
+        result = summarize(runs, bytes=self.data_bytes)
+        result['mb_per_sec'] = round(self.data_bytes / 1048576.0 / result['median'], 1)
+        return result
+
+    def bench_incr(self):
+        script, target = self.prepare('incr')
+        self.run(script, 'full')
+        runs = []
+        for _ in range(self.args.repeat):
+            time.sleep(1)  # 备份目录名精确到秒
+            runs.append(self.run(script, 'incr'))
+        return summarize(runs)
+
+    def bench_chain(self):
+        runs = []
+        for _ in range(self.args.repeat):
+            script, target = self.prepare('chain')
+            self.make_chain(target, self.args.chain, datetime.now() - timedelta(days=30))
+            cold = self.run(script, 'incr')
+            time.sleep(1)
+            warm = self.run(script, 'incr')
+            runs.append({'seconds': cold['seconds'], 'cpu_seconds': cold['cpu_seconds'],
+                         'warm_seconds': warm['seconds'], 'warm_cpu_seconds': warm['cpu_seconds']})
+
+            # 备份链不完整时会执行全量备份，结果不可比较
+            if len([name for name in os.listdir(target) if name.endswith('_incr')]) != self.args.chain + 2:
+                raise BenchError('Chain scenario took full backup, check {0}'.format(self.log))
+
+        warm = sorted(r['warm_seconds'] for r in runs)
+        return summarize(runs, chain=self.args.chain, warm_median=warm[len(warm) // 2])
+
+    def bench_monitor(self):
+        script, target = self.prepare('monitor')
+        self.make_chain(target, 50, datetime.now() - timedelta(days=30))
+        self.run(script, 'incr')
+
+        # 在已有备份的事件之前补充历史事件，使index文件达到--index-lines行
+        index_file = os.path.join(target, 'mysql_backup.index')
+        with open(index_file) as fp:
+            lines = fp.readlines()
+        begin = datetime.now() - timedelta(days=3650)
+        events = ('backup_begin', 'backup_end', 'copy_begin', 'copy_end')
+        with open(index_file, 'w') as fp:
+            for i in range(max(0, self.args.index_lines - len(lines))):
+                name = (begin + timedelta(minutes=i // len(events))).strftime(DATEFMT) + '_incr'
+                fp.write('{0}\t{1}\t{2}\n'.format(os.path.join(target, name), events[i % len(events)], name[:15]))
+            fp.writelines(lines)
+
+        # 首次执行时新版本根据index文件生成状态文件
+        state_file = os.path.join(target, 'mysql_backup.state')
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        cold = self.run(script, 'monitor', self.args.monitor_key)
+        runs = [self.run(script, 'monitor', self.args.monitor_key) for _ in range(self.args.repeat)]
+        return summarize(runs, index_lines=max(self.args.index_lines, len(lines)), cold_seconds=cold['seconds'])
+
+    def bench_prune(self):
+        runs = []
+        old_bytes = self.args.old_backups * self.args.old_backup_mb * 1024 * 1024
+        for _ in range(self.args.repeat):
+            script, target = self.prepare('prune')
+            begin = datetime.now() - timedelta(days=30)
+            for i in range(self.args.old_backups):
+                name = (begin + timedelta(days=i)).strftime(DATEFMT) + '_base'
+                self.make_backup_dir(target, name, 0, 8 * 1024 * 1024 * (i + 1), self.args.old_backup_mb)
+            runs.append(self.run(script, 'full'))
+
+            left = [name for name in os.listdir(target) if name.endswith('_base')]
+            if len(left) != 1:
+                raise BenchError('Prune scenario left {0} full backups, check {1}'.format(len(left), self.log))
+
+        result = summarize(runs, old_backups=self.args.old_backups, old_bytes=old_bytes)
+        # 与full场景比较得出删除过期备份的耗时
+        if 'full' in self.results:
+            result['prune_seconds'] = round(max(0.0, result['median'] - self.results['full']['median']), 3)
+        return result
+
+    def bench_copy(self):
+        remote = os.path.join(self.work_dir, 'remote')
+        command = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5', 'localhost', 'true']
+        with open(os.devnull, 'wb') as devnull:
+            if subprocess.call(command, stdout=devnull, stderr=devnull) != 0:
+                return {'skipped': 'ssh localhost is not available'}
+
+        runs = []
+        for _ in range(self.args.repeat):
+            if os.path.exists(remote):
+                shutil.rmtree(remote)
+            os.makedirs(remote)
+            script, target = self.prepare('copy', COPY_TO_REMOTE='scp', REMOTE_HOST='localhost',
+                                          REMOTE_USER=getpass.getuser(), REMOTE_PATH=remote)
+            runs.append(self.run(script, 'full'))
+
+        result = summarize(runs)
+        if 'full' in self.results:
+            result['copy_seconds'] = round(max(0.0, result['median'] - self.results['full']['median']), 3)
+            result['copy_mb_per_sec'] = round(self.data_bytes / 1048576.0 / result['copy_seconds'], 1) \
+                if result['copy_seconds'] else None
+        return result
+
+    def bench(self, scenarios):
+        for name in scenarios:
+            print('Running {0} ...'.format(name), file=sys.stderr)
+            self.results[name] = getattr(self, 'bench_' + name)()
+            print('  {0}'.format(json.dumps(dict((k, v) for k, v in self.results[name].items() if k != 'runs'),
+                                            sort_keys=True)), file=sys.stderr)
+        return self.results
+
+
+# 脚本版本：所在git仓库的提交及文件md5
+def script_version(script):
+    version = {}
+    with open(script, 'rb') as fp:
+        version['md5'] = hashlib.md5(fp.read()).hexdigest()
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            version['git'] = subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(script)),
+                stderr=devnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return version
+
+
+def compare(old, new):
+    rows = [('scenario', 'old', 'new', 'new/old')]
+    for name in SCENARIOS:
+        a, b = old['results'].get(name, {}), new['results'].get(name, {})
+        if 'median' in a and 'median' in b:
+            rows.append((name, '{0:.3f}'.format(a['median']), '{0:.3f}'.format(b['median']),
+                         '{0:.2f}'.format(b['median'] / a['median']) if a['median'] else '-'))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    print('old: {0}, new: {1}'.format(old.get('version'), new.get('version')))
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    args = parse_args()
+
+    scenarios = args.only.split(',') if args.only else list(SCENARIOS)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            raise BenchError('Unknown scenario: {0}'.format(name))
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='bench_backup_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        bench = Bench(args, work_dir)
+        begin = time.time()
+        results = bench.bench(scenarios)
+        output = {
+            'version': script_version(args.script),
+            'script': os.path.abspath(args.script),
+            'time': datetime.now().strftime(DATEFMT),
+            'seconds': round(time.time() - begin, 3),
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'params': dict((k, v) for k, v in vars(args).items() if k not in ('output', 'compare', 'work_dir')),
+            'skipped_conf': sorted(bench.skipped_conf),
+            'results': results
+        }
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), output)
+
+
+if __name__ == '__main__':
+    main()
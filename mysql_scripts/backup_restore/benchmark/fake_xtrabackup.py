@@ -0,0 +1,278 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import zlib
+from datetime import datetime
+
+# 功能：
+#   1. 代替xtrabackup供bench_backup.py使用，读取--defaults-file中datadir下的合成数据文件
+#   2. 全量备份复制全部文件，增量备份按BENCH_CHANGE_RATIO抽取变化页写入.delta/.meta
+#   3. 生成与xtrabackup格式一致的xtrabackup_checkpoints/xtrabackup_binlog_info/xtrabackup_info/xtrabackup_logfile
+#   4. --stream=xbstream时以xbstream格式输出至stdout，--prepare时只更新xtrabackup_checkpoints
+# 环境变量：
+#   BENCH_CHANGE_RATIO: 两次备份之间变化的页比例，默认0.05
+#   BENCH_REDO_RATIO: 每个变化页产生的redo字节数与页大小之比(决定LSN增长)，默认2
+
+PAGE_SIZE = 16384
+
+# LSN状态文件，位于datadir中，每次备份时LSN按变化页数增长
+LSN_FILE = '.bench_lsn'
+
+# xbstream每个分块的最大数据长度
+XBSTREAM_CHUNK_SIZE = 10 * 1024 * 1024
+
+CHANGE_RATIO = float(os.environ.get('BENCH_CHANGE_RATIO', '0.05'))
+REDO_RATIO = float(os.environ.get('BENCH_REDO_RATIO', '2'))
+
+
+# 解析命令行参数，只处理--name=value及--name形式
+def parse_args(argv):
+    args = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            args[name] = value if _ else True
+    return args
+
+
+def get_datadir(cnf):
+    section = None
+    with open(cnf) as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip()
+            elif section == 'mysqld' and '=' in line:
+                k, v = [x.strip() for x in line.split('=', 1)]
+                if k == 'datadir':
+                    return v.strip('\'"')
+    raise SystemExit('Cannot find datadir in {0}'.format(cnf))
+
+
+# 数据文件（相对路径），与xtrabackup一致只复制InnoDB文件及表定义
+def list_data_files(datadir):
+    files = []
+    for root, dir_names, file_names in os.walk(datadir):
+        for name in sorted(file_names):
+            if name == LSN_FILE:
+                continue
+            files.append(os.path.relpath(os.path.join(root, name), datadir))
+    return sorted(files)
+
+
+def read_checkpoints(path):
+    checkpoints = {}
+    with open(os.path.join(path, 'xtrabackup_checkpoints')) as fp:
+        for line in fp:
+            if '=' in line:
+                k, v = [x.strip() for x in line.split('=', 1)]
+                checkpoints[k] = v
+    return checkpoints
+
+
+def format_checkpoints(backup_type, from_lsn, to_lsn):
+    return ('backup_type = {0}\nfrom_lsn = {1}\nto_lsn = {2}\nlast_lsn = {3}\nflushed_lsn = {3}\n'
+            'compact = 0\nrecover_binlog_info = 0\n').format(backup_type, from_lsn, to_lsn, to_lsn + 9)
+
+
+# 模拟两次备份之间的写入：LSN按变化页数及redo比例增长
+def advance_lsn(datadir, files):
+    path = os.path.join(datadir, LSN_FILE)
+    try:
+        with open(path) as fp:
+            state = json.load(fp)
+    except (IOError, OSError, ValueError):
+        state = {'lsn': 8 * 1024 * 1024, 'binlog_pos': 4}
+
+    pages = sum(os.path.getsize(os.path.join(datadir, f)) // PAGE_SIZE for f in files)
+    changed = int(pages * CHANGE_RATIO)
+    state['lsn'] += int(changed * PAGE_SIZE * REDO_RATIO) + 1
+    state['binlog_pos'] += changed * 200
+
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.rename(path + '.tmp', path)
+    return state
+
+
+# 生成增量文件：第一页为头部(xtra + 页号列表)，之后为变化的页
+# 返回：[(相对路径, 内容)]
+def make_delta(datadir, rel_path, seed):
+    path = os.path.join(datadir, rel_path)
+    pages = os.path.getsize(path) // PAGE_SIZE
+    rng = random.Random('{0}:{1}'.format(seed, rel_path))
+    changed = sorted(rng.sample(range(pages), int(pages * CHANGE_RATIO))) if pages else []
+
+    per_header = PAGE_SIZE // 4 - 1
+    blocks = []
+    with open(path, 'rb') as fp:
+        for i in range(0, max(1, len(changed)), per_header):
+            group = changed[i:i + per_header]
+            header = b'xtra' + b''.join(struct.pack('>I', n) for n in group)
+            if len(group) < per_header:
+                header += struct.pack('>I', 0xFFFFFFFF)
+            blocks.append(header.ljust(PAGE_SIZE, b'\0'))
+            for n in group:
+                fp.seek(n * PAGE_SIZE)
+                blocks.append(fp.read(PAGE_SIZE))
+
+    meta = 'page_size = {0}\nzip_size = 0\nspace_id = {1}\n'.format(PAGE_SIZE, zlib.crc32(rel_path.encode()) & 0xffff)
+    return [(rel_path + '.delta', b''.join(blocks)), (rel_path + '.meta', meta.encode())]
+
+
+# 备份完成后的元数据文件
+# 返回：[(相对路径, 内容)]
+def metadata_files(backup_type, from_lsn, state, cnf):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    info = ('tool_name = xtrabackup\ntool_version = 8.0.35-30\nstart_time = {0}\nend_time = {0}\n'
+            'binlog_pos = filename \'mysql-bin.000001\', position \'{1}\'\ninnodb_from_lsn = {2}\n'
+            'innodb_to_lsn = {3}\npartial = N\nincremental = {4}\ncompressed = N\nencrypted = N\n').format(
+        now, state['binlog_pos'], from_lsn, state['lsn'], 'Y' if backup_type == 'incremental' else 'N')
+    with open(cnf) as fp:
+        my_cnf = fp.read()
+    return [
+        ('xtrabackup_checkpoints', format_checkpoints(backup_type, from_lsn, state['lsn']).encode()),
+        ('xtrabackup_binlog_info', 'mysql-bin.000001\t{0}\n'.format(state['binlog_pos']).encode()),
+        ('xtrabackup_info', info.encode()),
+        ('xtrabackup_logfile', b'\0' * (2 * 1024 * 1024)),
+        ('backup-my.cnf', my_cnf.encode())
+    ]
+
+
+# 与xtrabackup 8.0格式一致的输出
+def log(message):
+    print('{0} 0 [Note] [MY-011825] [Xtrabackup] {1}'.format(datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f'), message),
+          file=sys.stderr)
+
+
+def write_file(target_dir, rel_path, data):
+    path = os.path.join(target_dir, rel_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+# xbstream格式输出
+class XbstreamWriter(object):
+    def __init__(self, fp):
+        self.fp = fp
+
+    def chunk(self, path, payload, offset, chunk_type=b'P'):
+        name = path.encode()
+        header = b'XBSTCK01' + b'\0' + chunk_type + struct.pack('<I', len(name)) + name
+        if chunk_type == b'E':
+            self.fp.write(header)
+            return
+        self.fp.write(header + struct.pack('<QQI', len(payload), offset, zlib.crc32(payload) & 0xffffffff))
+        self.fp.write(payload)
+
+    def add_file(self, path, fp):
+        offset = 0
+        while True:
+            data = fp.read(XBSTREAM_CHUNK_SIZE)
+            if not data:
+                break
+            self.chunk(path, data, offset)
+            offset += len(data)
+        self.chunk(path, b'', 0, b'E')
+
+    def add_data(self, path, data):
+        for offset in range(0, len(data), XBSTREAM_CHUNK_SIZE):
+            self.chunk(path, data[offset:offset + XBSTREAM_CHUNK_SIZE], offset)
+        self.chunk(path, b'', 0, b'E')
+
+
+def backup(args):
+    cnf = args['defaults-file']
+    datadir = get_datadir(cnf)
+    files = list_data_files(datadir)
+    stream = args.get('stream') == 'xbstream'
+    target_dir = args['target-dir']
+    lsn_dir = args.get('extra-lsndir')
+
+    if 'incremental-basedir' in args:
+        backup_type = 'incremental'
+        from_lsn = int(read_checkpoints(args['incremental-basedir'])['to_lsn'])
+    else:
+        backup_type = 'full-backuped'
+        from_lsn = 0
+
+    state = advance_lsn(datadir, files)
+    writer = XbstreamWriter(getattr(sys.stdout, 'buffer', sys.stdout)) if stream else None
+    if not stream and not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+
+    action = 'Streaming' if stream else 'Copying'
+    for rel_path in files:
+        log('{0} ./{1} to {2}'.format(action, rel_path, os.path.join(target_dir, rel_path)))
+        if backup_type == 'incremental':
+            for name, data in make_delta(datadir, rel_path, state['lsn']):
+                if stream:
+                    writer.add_data(name, data)
+                else:
+                    write_file(target_dir, name, data)
+        elif stream:
+            with open(os.path.join(datadir, rel_path), 'rb') as fp:
+                writer.add_file(rel_path, fp)
+        else:
+            if not os.path.isdir(os.path.dirname(os.path.join(target_dir, rel_path))):
+                os.makedirs(os.path.dirname(os.path.join(target_dir, rel_path)))
+            shutil.copyfile(os.path.join(datadir, rel_path), os.path.join(target_dir, rel_path))
+        log('Done: {0} ./{1} to {2}'.format(action, rel_path, os.path.join(target_dir, rel_path)))
+        log('>> log scanned up to ({0})'.format(state['lsn']))
+
+    for name, data in metadata_files(backup_type, from_lsn, state, cnf):
+        if stream:
+            writer.add_data(name, data)
+        else:
+            write_file(target_dir, name, data)
+        if lsn_dir and name in ('xtrabackup_checkpoints', 'xtrabackup_info'):
+            write_file(lsn_dir, name, data)
+
+    log('Transaction log of lsn ({0}) to ({1}) was copied.'.format(from_lsn, state['lsn']))
+
+
+# prepare只更新xtrabackup_checkpoints
+def prepare(args):
+    target_dir = args['target-dir']
+    checkpoints = read_checkpoints(target_dir)
+    to_lsn = int(checkpoints['to_lsn'])
+
+    if 'incremental-dir' in args:
+        incremental = read_checkpoints(args['incremental-dir'])
+        if int(incremental['from_lsn']) != to_lsn:
+            raise SystemExit('This incremental backup seems not to be proper for the target. '
+                             'Check \'to_lsn\' of the target and \'from_lsn\' of the incremental.')
+        to_lsn = int(incremental['to_lsn'])
+
+    backup_type = 'log-applied' if 'apply-log-only' in args else 'full-prepared'
+    write_file(target_dir, 'xtrabackup_checkpoints',
+               format_checkpoints(backup_type, checkpoints['from_lsn'], to_lsn).encode())
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if 'backup' in args:
+        backup(args)
+    elif 'prepare' in args:
+        prepare(args)
+    elif 'version' in args:
+        print('xtrabackup version 8.0.35-30 based on MySQL server 8.0.35 Linux (x86_64) (benchmark stub)',
+              file=sys.stderr)
+    else:
+        raise SystemExit('Unsupported arguments: {0}'.format(' '.join(sys.argv[1:])))
+
+    print('{0} completed OK!'.format(datetime.now().strftime('%y%m%d %H:%M:%S')), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,91 @@
 
 from __future__ import print_function
 
+import base64
+import hashlib
+import json
+import select
+import argparse
+import binascii
+import ctypes
+import ctypes.util
+import fcntl
 import logging
+import re
+import resource
+import sqlite3
 from datetime import datetime
 from distutils import spawn
 import os
 import subprocess
+import shutil
+import threading
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import signal
+import struct
 import sys
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+# boto3导入耗时较长，只在上传至对象存储时导入(import_boto3)，不影响monitor等频繁执行的命令
+boto3 = None
+botocore = None
+
 
 # 功能：
 #   1. 使用xtrabackup备份MySQL
 #   2. 可选择全量备份、增量备份
 #   3. 增量备份时自动确定incremental-basedir
 #   4. 增量备份时对全备及其后备份链检查，如果没有全备或者备份链不完整，则自动进行全量备份
-#   5. 可选择将备份文件scp至其他服务器
+#   5. 可选择将备份文件复制至其他服务器（多ssh通道并发、分块校验、断点续传）
 #   6. 可选择备份保留份数
 #   7. 可返回备份执行情况供zabbix监控使用
+#   8. 可选择stream模式，xtrabackup输出经多线程压缩后写入单个归档文件
+#   9. 备份信息（类型、LSN、大小、耗时、校验和、复制状态）记录在SQLite编目库中，备份链检查及过期备份清理不再扫描目录
+#   10. 可选择根据MySQL负载、复制延迟及磁盘使用率暂停/恢复xtrabackup，降低备份对业务的影响
+#   11. 恢复备份：解析备份链，并发解压/复制、依次prepare全备及增量备份、并发复制/移动至数据目录
+#   12. Binlog备份：常驻进程使用mysqlbinlog --raw持续拉取binlog，压缩已关闭的文件并记录位置/GTID范围
+#   13. 基于时间点/GTID恢复：选择目标之前最新的备份链恢复数据目录，再并发解析binlog依次应用至恢复后的MySQL
+#   14. 过期备份移入回收目录后由后台进程以最低IO优先级限速删除，远端过期备份通过一个ssh会话批量删除
+#   15. 可选择去重存储：备份文件按块计算sha256，相同的块只保存一份，备份目录只保留清单，过期备份按引用计数回收
+#   16. 备份目录中保存md5sum格式的校验清单，stream模式在写入归档时解析xbstream计算各文件md5；verify并发校验本地及远端备份
+#   17. 合成全备：在备份机上将最新全备及其增量备份合并为新的全备，MySQL只需执行首次全备，之后只需增量备份
+#   18. 增量备份自动使用变化页跟踪(changed page bitmap/page tracking)，避免扫描全部数据页，记录扫描方式及页数
+#   19. 可选择在备份过程中通过inotify监控备份目录，xtrabackup写完一个文件即开始复制至远端，备份结束后再同步剩余文件
+#   20. 多实例：实例配置文件中为每个实例覆盖配置，schedule按全局并发数及IO预算依次备份各实例，实例及备份目录加锁
+#   21. 增量备份前估算备份链的恢复时间及增量备份总大小，超过阈值时改为全量备份，决定及原因记录在index文件中
+#   22. 可选择将备份上传至S3兼容对象存储（并发分片上传、分片md5校验、重试），删除过期备份时同时删除对象
+#   23. 备份/复制各阶段记录读写字节数、吞吐量、CPU时间、内存峰值及xtrabackup进度，可写入node_exporter textfile
 # 注意：
 #   1. 需安装xtrabackup
 #   2. ssh/scp需要配置无密钥访问
+#   3. stream模式需安装对应的压缩程序(zstd/pigz)
+#   4. 可选依赖psutil（https://github.com/giampaolo/psutil），用于auto设置时获取CPU核数
+#   5. 可选依赖MySQL-python(Python3依赖mysqlclient)，用于备份限速时获取MySQL负载；Binlog备份必须安装
+#   6. Binlog备份使用的MySQL用户需要REPLICATION SLAVE, REPLICATION CLIENT ON *.*权限
+#   7. 上传至对象存储(COPY_TO_REMOTE = 's3')需安装boto3
 # TODO:
-#   1. Binlog备份
-#   2. FTP传输
+#   1. FTP传输
 
 # ==================配置信息==================
 
@@ -43,9 +106,60 @@ MYSQL_PASSWORD = 'password'
 # 默认从PATH中查找，可手动设置绝对路径
 XTRABACKUP = spawn.find_executable('xtrabackup')
 
+# mysql客户端文件，基于时间点恢复时用于应用binlog
+MYSQL_CLIENT = spawn.find_executable('mysql')
+
+# xtrabackup备份时并发复制数据文件的线程数(--parallel)
+# auto: 根据CPU核数确定
+XTRABACKUP_PARALLEL = 'auto'
+
+# prepare时使用的内存(--use-memory)，如'4G'
+# auto: 根据/proc/meminfo中的可用内存确定
+PREPARE_MEMORY = 'auto'
+
+# 增量备份使用的变化页跟踪
+# 可选：auto, off
+# auto: 连接MySQL检测，Percona Server开启innodb_track_changed_pages时xtrabackup读取changed page bitmap；
+#       MySQL 8.0安装了component_mysqlbackup时全备及增量备份均使用--page-tracking；均不可用时扫描全部数据页
+# off: 增量备份扫描全部数据页
+CHANGED_PAGE_TRACKING = 'auto'
+
+# 备份方式
+# 可选：dir, stream
+# dir: xtrabackup直接输出未压缩的备份目录
+# stream: 使用--stream=xbstream，经压缩程序写入备份目录中的单个归档文件，
+#         xtrabackup_checkpoints等元数据通过--extra-lsndir保留在备份目录中，供增量备份及备份链检查使用
+BACKUP_MODE = 'dir'
+
+# stream模式使用的压缩程序
+# 可选：zstd, pigz
+COMPRESSOR = 'zstd'
+
+# 压缩线程数
+# auto: 根据CPU核数确定
+COMPRESS_THREADS = 'auto'
+
+# 备份存储方式
+# 可选：dir, dedup
+# dir: 备份文件保存在备份目录中
+# dedup: 备份完成(及复制至远端)后，数据文件按块拆分，以sha256为名保存在TARGET_PATH/chunks中，相同的块只保存一份，
+#        备份目录中只保留xtrabackup_*等元数据文件及清单，恢复时根据清单还原；仅支持BACKUP_MODE = 'dir'
+STORAGE_BACKEND = 'dir'
+
+# 去重块大小，单位MB，为InnoDB页大小的整数倍
+DEDUP_CHUNK_SIZE = 4
+
+# dir模式是否在备份完成后生成校验清单（verify需要）
+# 可选：off, on
+# on: 备份完成后多进程重新读取备份目录中的全部文件计算md5，额外产生与备份大小相同的读IO；
+#     stream模式的校验清单在写入归档时计算，不受此项影响
+DIR_CHECKSUM = 'off'
+
 # 是否将备份复制到远端
-# 可选：off, scp
-# 注意：使用SCP需要配置无密钥访问
+# 可选：off, scp, s3
+# scp: 备份文件按块拆分，通过多个ssh通道并发写入远端，每块传输后校验md5，失败的块可断点续传
+# s3: 备份文件(stream模式为归档文件)上传至S3兼容对象存储，大于S3_PART_SIZE的文件由COPY_STREAMS个线程并发分片上传
+# 注意：使用SCP需要配置无密钥访问，远端需要dd/truncate/md5sum(GNU coreutils)
 COPY_TO_REMOTE = 'off'
 
 REMOTE_HOST = '192.168.56.1'
@@ -54,17 +168,195 @@ REMOTE_USER = 'mysql'
 
 REMOTE_PATH = '/data/mysql_hostname'
 
+# 远端复制并发ssh通道数
+COPY_STREAMS = 4
+
+# 远端复制分块大小(MB)
+COPY_CHUNK_SIZE = 256
+
+# 远端复制带宽上限(MB/s)，所有通道共享，0表示不限制
+COPY_BANDWIDTH = 0
+
+# 单个分块失败后的重试次数
+COPY_RETRY = 3
+
+# S3兼容对象存储，对象名为S3_PREFIX/<备份目录名>/<相对路径>
+# S3_ENDPOINT: None为AWS S3，MinIO等填写如http://192.168.56.1:9000
+# S3_ACCESS_KEY/S3_SECRET_KEY: None时使用boto3默认的认证方式(环境变量、~/.aws/credentials、实例角色)
+S3_ENDPOINT = None
+S3_REGION = None
+S3_BUCKET = 'mysql-backup'
+S3_PREFIX = 'hostname'
+S3_ACCESS_KEY = None
+S3_SECRET_KEY = None
+
+# 分片大小(MB)，不小于5，上传时每个线程缓存一个分片，内存占用约为COPY_STREAMS * S3_PART_SIZE
+S3_PART_SIZE = 64
+
+# 是否在备份过程中开始复制
+# 可选：off, on
+# on: 通过inotify监控备份目录，xtrabackup关闭文件后立即由复制通道传输，备份结束后同步剩余文件(元数据等)及之后有修改的文件；
+#     仅dir模式有效，stream模式只有一个归档文件，备份结束后复制
+COPY_PIPELINE = 'off'
+
 # 备份保留份数
+# 删除过期备份时同时删除最早保留的全备之前的binlog
 BACKUP_REDUNDANCY = 1
 
+# 增量备份策略，执行incr时备份链超过以下任一阈值则改为全量备份，0表示不检查
+# INCR_MAX_RESTORE_TIME: 备份链（包括本次增量备份）预计恢复秒数
+# INCR_MAX_SIZE_RATIO: 增量备份总大小与全备大小之比
+INCR_MAX_RESTORE_TIME = 0
+INCR_MAX_SIZE_RATIO = 0
+
+# 估算恢复时间使用的速率(MB/s)及每次prepare的固定耗时(秒)
+# RESTORE_COPY_RATE: 解压/复制备份文件；RESTORE_APPLY_RATE: prepare时应用增量备份
+# index文件中有restore_stat记录时使用最近一次恢复的实际速率
+RESTORE_COPY_RATE = 200
+RESTORE_APPLY_RATE = 50
+RESTORE_PREPARE_OVERHEAD = 10
+
+# 是否使用合成全备代替全备
+# 可选：off, on
+# on: 执行full时，若最新备份链包含增量备份，在备份机上将全备及增量合并(prepare --apply-log-only)为新的全备，不读取MySQL数据；
+#     备份链不完整时仍从MySQL执行全备
+SYNTHETIC_FULL = 'off'
+
+# 过期备份删除速率，单位MB/s，0表示不限制
+# 过期备份先移入回收目录，由后台进程以最低IO优先级(ionice -c3)删除，避免集中释放大量空间影响MySQL
+PURGE_BANDWIDTH = 200
+
+# 大于该大小(MB)的文件删除前逐步截断，每次截断该大小
+PURGE_TRUNCATE_SIZE = 1024
+
+# Binlog备份目录
+BINLOG_PATH = os.path.join(TARGET_PATH, 'binlog')
+
+# mysqlbinlog文件
+# 默认从PATH中查找，可手动设置绝对路径
+MYSQLBINLOG = spawn.find_executable('mysqlbinlog')
+
+# mysqlbinlog连接MySQL使用的server_id，不能与复制拓扑中其他实例相同
+BINLOG_SERVER_ID = 65535
+
+# Binlog备份检查周期（秒），检查已关闭的binlog并压缩，更新延迟
+BINLOG_INTERVAL = 10
+
+# MySQL不可用时重连的最长间隔（秒），从BINLOG_INTERVAL开始每次失败加倍
+BINLOG_RETRY_MAX = 300
+
+# 备份限速
+# 可选：off, on
+# on: 备份过程中周期性采样Threads_running、oputil.heartbeat复制延迟、数据目录所在磁盘使用率，
+#     超过阈值时通过SIGSTOP/SIGCONT降低xtrabackup的运行时间比例，负载恢复后逐步提高；
+#     xtrabackup开始加锁（FLUSH TABLES WITH READ LOCK/LOCK TABLES FOR BACKUP）后不再暂停
+BACKUP_THROTTLE = 'off'
+
+# 采样及调整周期（秒）
+THROTTLE_INTERVAL = 1
+
+# xtrabackup最低运行时间比例
+THROTTLE_MIN_DUTY = 0.2
+
+# Threads_running阈值
+THROTTLE_MAX_THREADS_RUNNING = 32
+
+# 复制延迟阈值（秒）
+THROTTLE_MAX_LAG = 10
+
+# 磁盘使用率阈值（%）
+THROTTLE_MAX_DISK_UTIL = 80
+
+# xtrabackup读取数据文件的速率上限(MB/s，--throttle)，0表示不限制，schedule --throttle时按并发实例数平均分配
+XTRABACKUP_THROTTLE = 0
+
+# 多实例配置文件，json格式，每个实例为一个对象，name为实例名，其余为需要覆盖的上述配置项，如：
+# [{"name": "3306", "MYSQL_CNF": "/etc/my3306.cnf", "TARGET_PATH": "/data/backup/3306", "REMOTE_PATH": "/backup/3306"}]
+# 未指定BINLOG_PATH时使用实例TARGET_PATH下的binlog目录
+INSTANCES_FILE = '/etc/mysql_backup/instances.json'
+
+# 锁文件及调度状态文件目录
+LOCK_PATH = '/tmp'
+
+# 实例名，用于监控指标的instance标签及textfile文件名，None时使用TARGET_PATH的目录名；多实例时默认为实例配置中的name
+INSTANCE_NAME = None
+
+# node_exporter textfile collector目录，备份/复制阶段结束时及备份过程中每PROGRESS_INTERVAL秒
+# 原子写入mysql_backup_<实例名>.prom，None表示不写入
+PROMETHEUS_TEXTFILE_DIR = None
+
+# 阶段指标采样周期（秒）：进程内存峰值、xtrabackup进度
+PROGRESS_INTERVAL = 10
+
 # ==================功能实现==================
 DATEFMT = '%Y%m%d_%H%M%S'
 
-# index文件每行字段为backup_dir event_name occur_time
-# event_name取值包括backup_begin/backup_end/backup_error/copy_begin/copy_end/copy_error
-index_file = os.path.join(TARGET_PATH, 'mysql_backup.index')
-log_file = os.path.join(TARGET_PATH, 'mysql_backup.log')
-output_file = os.path.join(TARGET_PATH, 'xtrabackup_output.log')
+# stream模式归档文件名
+ARCHIVE_NAMES = {
+    'zstd': 'backup.xbstream.zst',
+    'pigz': 'backup.xbstream.gz'
+}
+
+# stream模式每次读取的数据块大小
+STREAM_BUFFER_SIZE = 4 * 1024 * 1024
+
+# 以下文件位于TARGET_PATH下，切换实例(apply_conf)后重新计算
+def set_paths():
+    global index_file, catalog_file, state_file, binlog_state_file, trash_path, purge_lock_file, chunk_path, \
+        log_file, output_file, target_lock_file, scheduler_state_file, scheduler_lock_file
+
+    # index文件每行字段为backup_dir event_name occur_time [info]
+    # event_name取值包括backup_begin/backup_end/backup_error/copy_begin/copy_end/copy_error/copy_stat/tuning/throttle/
+    # verify_end/verify_error/restore_stat/dedup_stat/incremental_scan/pipeline_stat/
+    # phase_stat/binlog_archived(backup_dir为binlog压缩文件)/replay_stat(backup_dir为开始应用的binlog)/
+    # backup_decision(backup_dir为执行incr时最新的备份，没有备份时为TARGET_PATH)
+    # info为可选的json格式附加信息，如stream模式下backup_end记录的raw_bytes/compressed_bytes
+    index_file = os.path.join(TARGET_PATH, 'mysql_backup.index')
+
+    # 编目库，记录每个备份的类型、LSN、大小等信息，首次使用时扫描TARGET_PATH导入已有备份
+    catalog_file = os.path.join(TARGET_PATH, 'mysql_backup.db')
+
+    # 状态文件，保存最新备份的各阶段事件时间及监控信息，monitor只读取该文件
+    state_file = os.path.join(TARGET_PATH, 'mysql_backup.state')
+
+    # Binlog备份状态文件，记录本地binlog最近一次与MySQL同步的时间
+    binlog_state_file = os.path.join(TARGET_PATH, 'mysql_backup.binlog_state')
+
+    # 过期备份回收目录，与备份在同一文件系统，移入时只需rename
+    trash_path = os.path.join(TARGET_PATH, '.trash')
+    purge_lock_file = os.path.join(TARGET_PATH, 'mysql_backup.purge_lock')
+
+    # 去重存储的块目录及备份目录中的清单文件
+    # 清单每行字段为相对路径 文件大小 块sha256列表(逗号分隔)
+    chunk_path = os.path.join(TARGET_PATH, 'chunks')
+    log_file = os.path.join(TARGET_PATH, 'mysql_backup.log')
+    output_file = os.path.join(TARGET_PATH, 'xtrabackup_output.log')
+
+    # 备份目录锁，同一TARGET_PATH同时只运行一个备份/复制/合成任务
+    target_lock_file = os.path.join(TARGET_PATH, 'mysql_backup.lock')
+
+    # 调度状态文件（位于LOCK_PATH下），schedule每个实例状态变化时原子替换，monitor scheduler_*读取
+    scheduler_state_file = os.path.join(LOCK_PATH, 'mysql_backup.scheduler')
+    scheduler_lock_file = os.path.join(LOCK_PATH, 'mysql_backup_scheduler.lock')
+
+
+set_paths()
+
+# 当前进程的实例参数（--instances/--instance），启动后台purge等子进程时传递，使其使用相同的实例配置
+_instance_args = []
+
+DEDUP_MANIFEST = 'dedup.manifest'
+
+# 校验清单，md5sum格式，可直接使用md5sum -c校验
+# CHECKSUM_MANIFEST: 备份目录中的文件；STREAM_MANIFEST: stream模式归档文件中的各文件
+CHECKSUM_MANIFEST = 'mysql_backup.md5'
+STREAM_MANIFEST = 'xbstream.md5'
+
+# xbstream分块格式：magic(8) flags(1) type(1) path_len(4) path [sparse_map_size(4)] payload_len(8) payload_offset(8)
+# checksum(4) [sparse_map(8 * n)] payload，type为P(数据)/S(稀疏数据)/E(文件结束)
+XBSTREAM_MAGIC = b'XBSTCK01'
+STEP_EVENTS = ('backup_begin', 'backup_end', 'backup_error', 'copy_begin', 'copy_end', 'copy_error')
+VERIFY_EVENTS = ('verify_end', 'verify_error')
 
 # log
 logger = logging.getLogger('mysql_backup')
@@ -79,6 +371,79 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
+# 备份目录名格式
+BACKUP_DIR_PATTERN = re.compile(r'^\d{8}_\d{6}_(base|incr)$')
+
+# 编目库表结构
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS backups (
+    backup_dir  TEXT PRIMARY KEY,  -- 备份目录
+    backup_type TEXT NOT NULL,     -- base/incr
+    parent      TEXT,              -- 增量备份的incremental-basedir
+    from_lsn    INTEGER,
+    to_lsn      INTEGER,
+    size        INTEGER,           -- 字节
+    duration    INTEGER,           -- 秒
+    checksum    TEXT,              -- stream模式归档文件的md5
+    status      TEXT NOT NULL,     -- running/success/error
+    copy_status TEXT,              -- NULL(未复制)/running/success/error
+    begin_time  TEXT,
+    end_time    TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_backups_type ON backups (backup_type, backup_dir);
+CREATE TABLE IF NOT EXISTS catalog_meta (
+    name  TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS binlogs (
+    file       TEXT PRIMARY KEY,   -- binlog文件名
+    path       TEXT NOT NULL,      -- 压缩后的备份文件
+    end_pos    INTEGER,
+    first_time TEXT,               -- 第一个/最后一个事件的时间
+    last_time  TEXT,
+    gtid_begin TEXT,               -- 文件开始/结束时已执行的GTID集合
+    gtid_end   TEXT
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,         -- 块sha256
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL          -- 引用该块的清单条目数
+);
+'''
+
+# backups表后续增加的列，打开编目库时对旧版本创建的库执行ALTER TABLE
+CATALOG_ADDED_COLUMNS = (
+    ('binlog_file', 'TEXT'),  # 备份对应的binlog位置
+    ('binlog_pos', 'INTEGER'),
+    ('gtid_executed', 'TEXT'),
+    ('scan_method', 'TEXT'),  # 增量备份查找变化页的方式：bitmap/page_tracking/full_scan
+    ('pages_changed', 'INTEGER'),
+    ('pages_examined', 'INTEGER')
+)
+
+CATALOG_COLUMNS = ('backup_dir', 'backup_type', 'parent', 'from_lsn', 'to_lsn', 'size', 'duration', 'checksum',
+                   'status', 'copy_status', 'begin_time', 'end_time') + \
+    tuple(name for name, column_type in CATALOG_ADDED_COLUMNS)
+
+BINLOG_COLUMNS = ('file', 'path', 'end_pos', 'first_time', 'last_time', 'gtid_begin', 'gtid_end')
+
+# binlog文件名格式
+BINLOG_NAME_PATTERN = re.compile(r'^.+\.\d{6,}$')
+
+# binlog压缩后的扩展名
+BINLOG_EXTS = {
+    'zstd': '.zst',
+    'pigz': '.gz'
+}
+
+# binlog事件类型
+FORMAT_DESCRIPTION_EVENT = 15
+PREVIOUS_GTIDS_EVENT = 35
+
+# 远端复制时每次读取/写入的数据块大小
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
 # 异常定义
 class ProgramError(Exception):
     def __init__(self, message):
@@ -125,14 +490,176 @@ def check_conf():
         logger.error(msg)
         raise ProgramError(msg)
 
+    if BACKUP_MODE not in ('dir', 'stream'):
+        msg = 'Wrong backup mode: {0}'.format(BACKUP_MODE)
+        logger.error(msg)
+        raise ProgramError(msg)
+
+    if BACKUP_MODE == 'stream' and compressor_path() is None:
+        msg = 'Cannot find compressor: {0}'.format(COMPRESSOR)
+        logger.error(msg)
+        raise ProgramError(msg)
+
+    if COPY_TO_REMOTE not in ('off', 'scp', 's3'):
+        msg = 'Wrong copy to remote: {0}'.format(COPY_TO_REMOTE)
+        logger.error(msg)
+        raise ProgramError(msg)
+
+    if COPY_TO_REMOTE == 's3' and import_boto3() is None:
+        msg = 'boto3 is required to copy backups to S3'
+        logger.error(msg)
+        raise ProgramError(msg)
+
+    if STORAGE_BACKEND not in ('dir', 'dedup') or (STORAGE_BACKEND == 'dedup' and BACKUP_MODE != 'dir'):
+        msg = 'Wrong storage backend: {0}, dedup requires dir backup mode'.format(STORAGE_BACKEND)
+        logger.error(msg)
+        raise ProgramError(msg)
+
     if BACKUP_REDUNDANCY is None or BACKUP_REDUNDANCY <= 0:
         msg = 'Backup Redundancy: {0}, will not remove old backups'.format(BACKUP_REDUNDANCY)
         logger.warning(msg)
 
-    if len(sys.argv) < 2 or sys.argv[1].lower() not in ('full', 'incr', 'monitor'):
-        msg = 'Wrong argument: {0}. Usage：{1} <full | incr | monitor>'.format(sys.argv[1:], sys.argv[0])
+
+# 读取多实例配置文件
+def load_instances(path):
+    try:
+        with open(path) as fp:
+            instances = json.load(fp)
+    except (IOError, OSError, ValueError) as exc:
+        raise ProgramError('Cannot read instances file {0}: {1}'.format(path, exc))
+
+    names = [instance.get('name') for instance in instances]
+    if not all(names) or len(set(names)) != len(names):
+        raise ProgramError('Instance name missing or duplicated in {0}'.format(path))
+    return instances
+
+
+# 使用实例配置覆盖配置项，并重新计算TARGET_PATH下的文件路径
+# 只能覆盖已有的配置项（大写），避免拼写错误的配置项被静默忽略
+def apply_conf(instance):
+    global _catalog_conn, _tuning
+
+    conf = globals()
+    overrides = dict((name, value) for name, value in instance.items() if name != 'name')
+    for name in overrides:
+        if not name.isupper() or name not in conf:
+            raise ProgramError('Unknown conf item in instance {0}: {1}'.format(instance.get('name'), name))
+
+    if 'TARGET_PATH' in overrides and 'BINLOG_PATH' not in overrides:
+        overrides['BINLOG_PATH'] = os.path.join(overrides['TARGET_PATH'], 'binlog')
+    overrides.setdefault('INSTANCE_NAME', instance['name'])
+
+    conf.update(overrides)
+    set_paths()
+    _catalog_conn = None
+    _tuning = None
+
+
+# 实例锁文件，以MySQL配置文件路径区分实例
+def instance_lock_file():
+    name = re.sub(r'[^\w.-]', '_', os.path.abspath(MYSQL_CNF).strip(os.path.sep))
+    return os.path.join(LOCK_PATH, 'mysql_backup_{0}.lock'.format(name))
+
+
+# 加锁（不等待），锁在进程退出时自动释放
+_locks = []
+
+
+def acquire_lock(path):
+    lock_fp = open(path, 'a')
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_fp.close()
+        msg = 'Another backup is running, cannot lock {0}'.format(path)
         logger.error(msg)
         raise ProgramError(msg)
+    _locks.append(lock_fp)
+
+
+# 导入boto3，未安装时返回None
+def import_boto3():
+    global boto3, botocore
+
+    try:
+        import boto3
+        import botocore.config
+        import botocore.exceptions
+    except ImportError:
+        boto3 = None
+    return boto3
+
+
+# 压缩程序路径
+def compressor_path():
+    if COMPRESSOR not in ARCHIVE_NAMES:
+        return None
+    return spawn.find_executable(COMPRESSOR)
+
+
+# 压缩命令，从stdin读取，写入stdout
+def compress_command():
+    if COMPRESSOR == 'zstd':
+        return [compressor_path(), '-q', '-c', '-T{0}'.format(get_tuning()['compress_threads'])]
+    else:
+        return [compressor_path(), '-c', '-p', str(get_tuning()['compress_threads'])]
+
+
+# 读取/proc/meminfo
+# 返回：{名称: KB}
+def read_meminfo():
+    info = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            name, val = line.split(':', 1)
+            info[name] = int(val.strip().strip('kKbB').strip())
+    return info
+
+
+# 确定xtrabackup并发线程数、压缩线程数、prepare内存
+# 配置为auto时根据CPU核数及可用内存确定：备份在生产库上执行，复制及压缩线程各使用约1/4的CPU；
+# prepare内存使用可用内存的一半，范围128M~32G
+_tuning = None
+
+
+def get_tuning():
+    global _tuning
+
+    if _tuning is not None:
+        return _tuning
+
+    cpus = (psutil.cpu_count() if psutil else None) or multiprocessing.cpu_count()
+
+    meminfo = read_meminfo()
+    mem_available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0) + meminfo.get('Cached', 0))
+
+    _tuning = {
+        'cpus': cpus,
+        'mem_available_mb': mem_available // 1024,
+        'parallel': XTRABACKUP_PARALLEL,
+        'compress_threads': COMPRESS_THREADS,
+        'use_memory': PREPARE_MEMORY
+    }
+
+    if str(XTRABACKUP_PARALLEL).lower() == 'auto':
+        _tuning['parallel'] = max(1, min(cpus // 4, 8))
+    if str(COMPRESS_THREADS).lower() == 'auto':
+        _tuning['compress_threads'] = max(1, cpus // 4)
+    if str(PREPARE_MEMORY).lower() == 'auto':
+        _tuning['use_memory'] = '{0}M'.format(max(128, min(mem_available // 1024 // 2, 32 * 1024)))
+
+    logger.info('Tuning: parallel={parallel}, compress_threads={compress_threads}, use_memory={use_memory} '
+                '(cpus={cpus}, mem_available={mem_available_mb}M)'.format(**_tuning))
+    return _tuning
+
+
+# 取得备份目录中的归档文件，非stream模式的备份返回None
+def get_archive(backup_dir):
+    for name in ARCHIVE_NAMES.values():
+        path = os.path.join(backup_dir, name)
+        if os.path.isfile(path):
+            return path
+    return None
 
 
 # 生成备份目录名
@@ -150,31 +677,125 @@ def generate_backup_dir(incremental=False):
     return backup_dir
 
 
+# 打开编目库
+_catalog_conn = None
+
+
+def catalog():
+    global _catalog_conn
+
+    if _catalog_conn is None:
+        _catalog_conn = sqlite3.connect(catalog_file, timeout=60)
+        _catalog_conn.executescript(CATALOG_SCHEMA)
+
+        columns = [row[1] for row in _catalog_conn.execute('PRAGMA table_info(backups)')]
+        for name, column_type in CATALOG_ADDED_COLUMNS:
+            if name not in columns:
+                _catalog_conn.execute('ALTER TABLE backups ADD COLUMN {0} {1}'.format(name, column_type))
+
+        # 首次使用时导入已有备份
+        if _catalog_conn.execute("SELECT value FROM catalog_meta WHERE name = 'version'").fetchone() is None:
+            rebuild_catalog()
+
+    return _catalog_conn
+
+
+# 扫描TARGET_PATH重建编目库，用于首次使用或手动修改备份目录后
+def rebuild_catalog():
+    rows = []
+    refs = {}
+    last_dir = None
+
+    for name in sorted(os.listdir(TARGET_PATH)):
+        path = os.path.join(TARGET_PATH, name)
+        if not BACKUP_DIR_PATTERN.match(name) or not os.path.isdir(path):
+            continue
+
+        backup_type = name.rsplit('_', 1)[1]
+        try:
+            from_lsn, to_lsn = get_lsns(path)
+            status = 'success'
+        except (IOError, OSError, ValueError):
+            from_lsn, to_lsn = None, None
+            status = 'error'
+
+        binlog_file, binlog_pos, gtid_executed = get_binlog_pos(path)
+
+        if os.path.exists(os.path.join(path, DEDUP_MANIFEST)):
+            for rel_path, size, digests in read_manifest(path):
+                for digest in digests:
+                    refs[digest] = refs.get(digest, 0) + 1
+
+        rows.append((path, backup_type, last_dir if backup_type == 'incr' else None, from_lsn, to_lsn,
+                     get_dir_size(path), status, name[:15], binlog_file, binlog_pos, gtid_executed))
+        last_dir = path
+
+    conn = catalog()
+    with conn:
+        conn.execute('DELETE FROM backups')
+        conn.executemany('INSERT INTO backups (backup_dir, backup_type, parent, from_lsn, to_lsn, size, status, '
+                         'begin_time, binlog_file, binlog_pos, gtid_executed) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('DELETE FROM chunks')
+        conn.executemany('INSERT INTO chunks (hash, size, refs) VALUES (?, ?, ?)',
+                         [(digest, os.path.getsize(chunk_file(digest)), count) for digest, count in refs.items()
+                          if os.path.exists(chunk_file(digest))])
+        conn.execute("INSERT OR REPLACE INTO catalog_meta (name, value) VALUES ('version', '1')")
+
+    logger.info('Catalog rebuilt, {0} backups'.format(len(rows)))
+
+
+# 更新编目库中一个备份的信息，不存在时插入
+def catalog_update(backup_dir, **fields):
+    conn = catalog()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO backups (backup_dir, backup_type, status) VALUES (?, ?, 'running')",
+                     (backup_dir, 'incr' if backup_dir.endswith('incr') else 'base'))
+        if fields:
+            conn.execute('UPDATE backups SET {0} WHERE backup_dir = ?'.format(
+                ', '.join('{0} = ?'.format(k) for k in sorted(fields))),
+                [fields[k] for k in sorted(fields)] + [backup_dir])
+
+
+# 从编目库删除备份
+def catalog_remove(backup_dir):
+    conn = catalog()
+    with conn:
+        conn.execute('DELETE FROM backups WHERE backup_dir = ?', (backup_dir,))
+
+
+# 查询编目库
+# 返回：[{字段: 值}]，按备份目录升序排列
+def catalog_query(where='1 = 1', args=(), limit=None):
+    sql = 'SELECT {0} FROM backups WHERE {1} ORDER BY backup_dir'.format(', '.join(CATALOG_COLUMNS), where)
+    if limit:
+        sql = 'SELECT * FROM ({0} DESC LIMIT {1}) ORDER BY backup_dir'.format(sql, int(limit))
+    return [dict(zip(CATALOG_COLUMNS, row)) for row in catalog().execute(sql, args)]
+
+
+# 计算目录大小
+def get_dir_size(path):
+    size = 0
+    for root, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
 # 取得所有备份目录，按名称升序排列
 def get_all_backup_dirs():
-    dirs = []
-    for obj in os.listdir(TARGET_PATH):
-        full_path = os.path.join(TARGET_PATH, obj)
-        if os.path.isdir(full_path):
-            dirs.append(full_path)
-    return sorted(dirs)
+    return [row[0] for row in catalog().execute('SELECT backup_dir FROM backups ORDER BY backup_dir')]
 
 
 # 取得最新备份目录
 # 返回：(最新目录,最新base目录,最新incr目录)
 def get_last_backup_dirs():
-    all_dirs = get_all_backup_dirs()
-
-    base_dir = None
-    incr_dir = None
+    last = dict(catalog().execute('SELECT backup_type, MAX(backup_dir) FROM backups GROUP BY backup_type'))
 
-    for path in all_dirs:
-        if path.endswith('base') and (base_dir is None or path > base_dir):
-            base_dir = path
-        if path.endswith('incr') and (incr_dir is None or path > incr_dir):
-            incr_dir = path
+    base_dir = last.get('base')
+    incr_dir = last.get('incr')
 
-    return max(base_dir, incr_dir), base_dir, incr_dir
+    return max(base_dir or '', incr_dir or '') or None, base_dir, incr_dir
 
 
 # 取得一个备份目录对应的LSN
@@ -194,15 +815,28 @@ def get_lsns(backup_dir):
     return from_lsn, to_lsn
 
 
-# 取得指定起止点的全部目录，按名称升序排列
-def list_dirs(from_dir, to_dir):
-    dirs = []
+# 取得一个备份对应的binlog位置
+# 优先读取xtrabackup_binlog_info，stream模式下备份目录中只有xtrabackup_info
+# 返回：(binlog文件名, 位置, GTID)，未开启binlog时均为None
+def get_binlog_pos(backup_dir):
+    path = os.path.join(backup_dir, 'xtrabackup_binlog_info')
+    if os.path.isfile(path):
+        with open(path) as fp:
+            fields = fp.read().strip().split('\t')
+        if len(fields) >= 2:
+            return fields[0], int(fields[1]), fields[2].replace('\n', '') if len(fields) > 2 else None
 
-    for path in get_all_backup_dirs():
-        if from_dir <= path <= to_dir:
-            dirs.append(path)
+    path = os.path.join(backup_dir, 'xtrabackup_info')
+    if os.path.isfile(path):
+        with open(path) as fp:
+            for line in fp:
+                # binlog_pos = filename 'mysql-bin.000003', position '154', GTID of the last change '...'
+                if line.startswith('binlog_pos'):
+                    values = re.findall(r"'([^']*)'", line)
+                    if len(values) >= 2:
+                        return values[0], int(values[1]), values[2] if len(values) > 2 else None
 
-    return sorted(dirs)
+    return None, None, None
 
 
 # 取得除保留备份外所有旧备份目录
@@ -236,9 +870,11 @@ def check_backup_chain(base_dir, incr_dir):
 
     old_to_lsn = 0
 
-    for backup_dir in list_dirs(base_dir, incr_dir):
-        from_lsn, to_lsn = get_lsns(backup_dir)
-        if old_to_lsn != from_lsn:
+    rows = catalog().execute('SELECT backup_dir, from_lsn, to_lsn FROM backups WHERE backup_dir BETWEEN ? AND ? '
+                             'ORDER BY backup_dir', (base_dir, incr_dir))
+
+    for backup_dir, from_lsn, to_lsn in rows:
+        if from_lsn is None or old_to_lsn != from_lsn:
             logger.warning('Backup chain is broken, please check {0}'.format(backup_dir))
             return False
         else:
@@ -247,210 +883,3358 @@ def check_backup_chain(base_dir, incr_dir):
     return True
 
 
-# 执行命令
-def execute_command(command):
-    logger.info('Begin execute command: {0}'.format([cmd for cmd in command if 'password' not in cmd]))
+# 取得MySQL当前LSN，无法连接MySQL时返回None
+def get_current_lsn():
+    try:
+        conn = mysql_connect()
+    except Exception as exc:
+        logger.warning('Cannot connect to MySQL to get current LSN: {0}'.format(exc))
+        return None
 
-    with open(output_file, 'a') as fp:
-        process = subprocess.Popen(command, stdout=fp, stderr=subprocess.STDOUT)
-        process.communicate()
-        if process.returncode != 0:
-            raise ProcessError(command, process.returncode)
+    if conn is None:
+        return None
 
-    logger.info('Command executed')
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SHOW ENGINE INNODB STATUS')
+        row = cursor.fetchone()
+        match = re.search(r'Log sequence number\s+(\d+)', row[2]) if row else None
+        return int(match.group(1)) if match else None
+    except MySQLdb.Error as exc:
+        logger.warning('Cannot get current LSN: {0}'.format(exc))
+        return None
+    finally:
+        conn.close()
 
 
-# 记录执行事件
-def record_event(backup_dir, event_name):
-    with open(index_file, 'a') as f:
-        record = '{0}\t{1}\t{2}\n'.format(
-            backup_dir,
-            event_name,
-            datetime.now().strftime(DATEFMT)
-        )
-        f.write(record)
+# 最近一次恢复的实际速率(MB/s)
+# copy: 解压/复制的字节数 / (stage + copy_back)；apply: 备份链中增量备份大小 / prepare
+# 返回：(copy_rate, apply_rate)，没有恢复记录或无法计算时为None
+def get_restore_rates():
+    last = None
+    if os.path.exists(index_file):
+        with open(index_file) as fp:
+            for line in fp:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > 3 and fields[1] == 'restore_stat':
+                    last = fields
 
+    if last is None:
+        return None, None
 
-# 备份
-def backup(backup_dir, base_dir=None):
-    command = [
-        XTRABACKUP,
-        '--defaults-file=' + MYSQL_CNF,
-        '--backup',
-        '--user=' + MYSQL_USER,
-        '--password=' + MYSQL_PASSWORD,
-        '--target-dir=' + backup_dir
-    ]
+    try:
+        info = json.loads(last[3])
+    except ValueError:
+        return None, None
 
-    if base_dir:
-        command.extend([
-            '--incremental',
-            '--incremental-basedir=' + base_dir
-        ])
+    copy_rate, apply_rate = None, None
+    copy_seconds = info.get('stage', 0) + info.get('copy_back', 0)
+    if info.get('bytes') and copy_seconds > 0:
+        copy_rate = info['bytes'] / 1048576.0 / copy_seconds
 
+    # 恢复的备份链已被删除时无法计算
     try:
-        record_event(backup_dir, 'backup_begin')
-        execute_command(command)
-        record_event(backup_dir, 'backup_end')
-    except Exception as exc:
-        logger.error(exc)
-        record_event(backup_dir, 'backup_error')
-        raise exc
-
+        chain = resolve_chain(last[0])
+        rows = catalog_query('backup_dir BETWEEN ? AND ?', (chain[0], last[0]))
+        incr_bytes = sum(row['size'] or 0 for row in rows[1:])
+    except ProgramError:
+        incr_bytes = 0
+    if incr_bytes and info.get('prepare', 0) > 0:
+        apply_rate = incr_bytes / 1048576.0 / info['prepare']
 
-# 使用scp将备份复制到远端
-def scp(backup_dir):
-    command = [
-        'scp',
-        '-r',
-        backup_dir,
-        '{0}@{1}:{2}'.format(REMOTE_USER, REMOTE_HOST, REMOTE_PATH),
-    ]
+    return copy_rate, apply_rate
 
-    try:
-        record_event(backup_dir, 'copy_begin')
-        execute_command(command)
-        record_event(backup_dir, 'copy_end')
-    except Exception as exc:
-        logger.error(exc)
-        record_event(backup_dir, 'copy_error')
-        raise exc
 
+# 估算备份链base_dir ~ last_dir在本次增量备份之后的恢复时间
+# 本次增量备份的大小按已有增量备份每LSN的字节数及MySQL当前LSN估算（LSN差近似于期间写入的redo字节数），
+# 无法取得当前LSN时按已有增量备份的平均大小估算
+def estimate_restore(base_dir, last_dir):
+    rows = catalog_query('backup_dir BETWEEN ? AND ?', (base_dir, last_dir))
+    base_size = rows[0]['size'] or 0
+    incr_sizes = [row['size'] or 0 for row in rows[1:]]
+    lsn_delta = sum(row['to_lsn'] - row['from_lsn'] for row in rows[1:])
 
-# 获取备份执行信息供监控使用
-def monitor(backup_dir, monitor_key):
-    result = {
-        'backup_date': 0,
-        'backup_time': 0,
-        'backup_type': 0,  # 0-全量 1-增量
-        'backup_success': 0,  # 0-失败 1-成功
-        'backup_elapsed': 0,  # 秒
-        'copy_success': 0,  # 0-失败 1-成功
-        'copy_elapsed': 0  # 秒
-    }
+    current_lsn = get_current_lsn()
+    if current_lsn and lsn_delta > 0 and rows[-1]['to_lsn']:
+        next_size = sum(incr_sizes) * max(0, current_lsn - rows[-1]['to_lsn']) / float(lsn_delta)
+    elif incr_sizes:
+        next_size = sum(incr_sizes) / float(len(incr_sizes))
+    else:
+        next_size = 0
 
-    if monitor_key not in result or (not backup_dir):
-        return 0
+    copy_rate, apply_rate = get_restore_rates()
+    rate_source = 'restore_stat' if copy_rate or apply_rate else 'conf'
+    copy_rate = copy_rate or RESTORE_COPY_RATE
+    apply_rate = apply_rate or RESTORE_APPLY_RATE
 
-    fields = os.path.basename(backup_dir.strip(os.path.sep)).split('_')
-    if len(fields) != 3:
-        return 0
+    incr_bytes = sum(incr_sizes) + next_size
+    prepares = len(rows) + 1
+    seconds = (base_size + incr_bytes) / 1048576.0 / copy_rate + incr_bytes / 1048576.0 / apply_rate + \
+        prepares * RESTORE_PREPARE_OVERHEAD
 
-    result['backup_date'] = int(fields[0])
-    result['backup_time'] = int(fields[1])
-    result['backup_type'] = 0 if fields[2] == 'base' else 1
+    return {
+        'chain': prepares,
+        'base_bytes': base_size,
+        'incr_bytes': int(incr_bytes),
+        'next_incr_bytes': int(next_size),
+        'lsn_delta': lsn_delta,
+        'current_lsn': current_lsn,
+        'size_ratio': round(incr_bytes / float(base_size), 3) if base_size else None,
+        'restore_seconds': int(seconds),
+        'copy_rate': round(copy_rate, 1),
+        'apply_rate': round(apply_rate, 1),
+        'rate_source': rate_source
+    }
 
-    step = {
-        'backup_begin': None,
-        'backup_end': None,
-        'backup_error': None,
-        'copy_begin': None,
-        'copy_end': None,
-        'copy_error': None}
 
-    with open(index_file, 'r') as f:
-        for line in f:
-            if line:
-                dir_name, event_name, occur_time = line.split('\t')
-                if dir_name == backup_dir:
-                    if event_name in step:
-                        step[event_name] = datetime.strptime(occur_time.strip(), DATEFMT)
+# 执行incr时确定是否增量备份
+# 没有全备或备份链不完整、备份链预计恢复时间或增量备份总大小比例超过阈值时改为全量备份，决定及原因记录为backup_decision事件
+# 返回：是否增量备份
+def decide_incremental(cur_dir, base_dir, incr_dir):
+    info = {'requested': 'incr'}
 
-    result['backup_success'] = 1 if step['backup_error'] is None else 0
-    if step['backup_begin'] is None or (step['backup_end'] is None and step['backup_error'] is None):
-        result['backup_elapsed'] = 0
-    else:
-        result['backup_elapsed'] = int(((step['backup_end'] if step['backup_end'] else step['backup_error']) -
-                                        step['backup_begin']).total_seconds())
+    if not check_backup_chain(base_dir, incr_dir):
+        logger.warning('Request a incremental backup, but there is no base full backup or the backup chain is '
+                       'broken. Take full backup instead')
+        info['reason'] = 'no_base' if base_dir is None else 'chain_broken'
+    elif INCR_MAX_RESTORE_TIME or INCR_MAX_SIZE_RATIO:
+        info.update(estimate_restore(base_dir, cur_dir))
+        if INCR_MAX_RESTORE_TIME and info['restore_seconds'] > INCR_MAX_RESTORE_TIME:
+            info['reason'] = 'restore_time'
+        elif INCR_MAX_SIZE_RATIO and info['size_ratio'] is not None and info['size_ratio'] > INCR_MAX_SIZE_RATIO:
+            info['reason'] = 'size_ratio'
 
-    if COPY_TO_REMOTE == 'off':
-        result['copy_success'] = 1
-        result['copy_elapsed'] = 0
-    else:
-        result['copy_success'] = 1 if step['copy_error'] is None else 0
-        if step['copy_begin'] is None or (step['copy_end'] is None and step['copy_error'] is None):
-            result['copy_elapsed'] = 0
+        if 'reason' in info:
+            logger.warning('Backup chain exceeds {0} limit (estimated restore: {1}s, size ratio: {2}, chain: {3}). '
+                           'Take full backup instead'.format(info['reason'], info['restore_seconds'],
+                                                             info['size_ratio'], info['chain']))
         else:
-            result['copy_elapsed'] = int(((step['copy_end'] if step['copy_end'] else step['copy_error']) -
-                                          step['copy_begin']).total_seconds())
+            logger.info('Estimated restore of backup chain: {0}s, size ratio: {1}, chain: {2}'.format(
+                info['restore_seconds'], info['size_ratio'], info['chain']))
 
-    return result[monitor_key]
+    info['decision'] = 'full' if 'reason' in info else 'incr'
+    record_event(cur_dir or TARGET_PATH, 'backup_decision', info)
+    return info['decision'] == 'incr'
 
 
-# 删除过期备份目录
-def remove_old_backup_dirs():
-    for path in get_old_backup_dirs():
-        command = [
-            'rm',
-            '-rf',
-            path
-        ]
+# 执行命令
+# watcher: 可选，命令执行期间对进程进行监控/控制的对象，需实现start(process)/stop()
+def execute_command(command, watcher=None):
+    logger.info('Begin execute command: {0}'.format([cmd for cmd in command if 'password' not in cmd]))
 
+    with open(output_file, 'a') as fp:
+        process = subprocess.Popen(command, stdout=fp, stderr=subprocess.STDOUT)
+        if watcher:
+            watcher.start(process)
         try:
-            execute_command(command)
-        except Exception as exc:
-            logger.error(exc)
-            raise exc
+            process.communicate()
+        finally:
+            if watcher:
+                watcher.stop()
+        if process.returncode != 0:
+            raise ProcessError(command, process.returncode)
 
+    logger.info('Command executed')
 
-# 删除远端过期备份目录
-def remove_old_backup_dirs_ssh():
-    for path in get_old_backup_dirs():
-        base_name = os.path.basename(path)
-        command = [
-            'ssh',
-            '{0}@{1}'.format(REMOTE_USER, REMOTE_HOST),
-            '"rm -rf {0}"'.format(os.path.join(REMOTE_PATH, base_name))
-        ]
 
-        try:
-            execute_command(command)
-        except Exception as exc:
+# 将src的内容写入dst，同时计算md5
+def relay_stream(src, dst, digest):
+    while True:
+        data = src.read(STREAM_BUFFER_SIZE)
+        if not data:
+            break
+        digest.update(data)
+        dst.write(data)
+
+
+# 解析xbstream流，计算流中各文件的md5
+# 按块增量输入，数据部分不缓存直接计算；格式无法识别时放弃计算，不影响备份
+class XbstreamDigest(object):
+    def __init__(self):
+        self.buffer = b''
+        self.files = {}  # path: [md5, 已计算的偏移]
+        self.invalid = set()
+        self.failed = False
+        self.current = None
+        self.remaining = 0
+        self.sparse = None
+        self.payload = []
+
+    def feed(self, data):
+        if self.failed:
+            return
+
+        try:
+            buf = self.buffer + data if self.buffer else data
+            pos = 0
+            while True:
+                if self.remaining:
+                    size = min(self.remaining, len(buf) - pos)
+                    if size <= 0:
+                        break
+                    self.consume(buf[pos:pos + size])
+                    pos += size
+                    self.remaining -= size
+                    if not self.remaining and self.sparse is not None:
+                        self.consume_sparse()
+                    continue
+
+                next_pos = self.parse_header(buf, pos)
+                if next_pos is None:
+                    break
+                pos = next_pos
+            self.buffer = buf[pos:]
+        except (ValueError, struct.error) as exc:
+            logger.warning('Cannot parse xbstream, skip stream checksum: {0}'.format(exc))
+            self.failed = True
+            self.buffer = b''
+
+    # 解析分块头部，数据不完整时返回None
+    def parse_header(self, buf, pos):
+        if len(buf) - pos < 14:
+            return None
+        if buf[pos:pos + 8] != XBSTREAM_MAGIC:
+            raise ValueError('wrong magic at {0}'.format(pos))
+
+        chunk_type = buf[pos + 9:pos + 10]
+        path_len = struct.unpack('<I', buf[pos + 10:pos + 14])[0]
+        p = pos + 14 + path_len
+        if len(buf) < p:
+            return None
+        path = buf[pos + 14:p].decode('utf-8', 'replace')
+
+        if chunk_type == b'E':
+            return p
+
+        sparse_size = None
+        if chunk_type == b'S':
+            if len(buf) < p + 4:
+                return None
+            sparse_size = struct.unpack('<I', buf[p:p + 4])[0]
+            p += 4
+        elif chunk_type != b'P':
+            raise ValueError('unknown chunk type {0!r}'.format(chunk_type))
+
+        if len(buf) < p + 20 + 8 * (sparse_size or 0):
+            return None
+        payload_len, offset = struct.unpack('<QQ', buf[p:p + 16])
+        p += 20
+
+        if sparse_size is not None:
+            self.sparse = [struct.unpack('<II', buf[p + 8 * i:p + 8 * i + 8]) for i in range(sparse_size)]
+            self.payload = []
+            p += 8 * sparse_size
+
+        state = self.files.setdefault(path, [hashlib.md5(), 0])
+        if offset < state[1]:
+            self.invalid.add(path)
+        self.zero_fill(state, offset - state[1])
+
+        self.current = state
+        self.remaining = payload_len
+        if not payload_len and self.sparse is not None:
+            self.consume_sparse()
+        return p
+
+    def consume(self, data):
+        if self.sparse is not None:
+            self.payload.append(data)
+        else:
+            self.current[0].update(data)
+            self.current[1] += len(data)
+
+    # 稀疏分块：按(skip, len)列表跳过空洞后写入数据
+    def consume_sparse(self):
+        payload = b''.join(self.payload)
+        pos = 0
+        for skip, length in self.sparse:
+            self.zero_fill(self.current, skip)
+            self.current[0].update(payload[pos:pos + length])
+            self.current[1] += length
+            pos += length
+        self.sparse = None
+        self.payload = []
+
+    @staticmethod
+    def zero_fill(state, size):
+        while size > 0:
+            length = min(size, STREAM_BUFFER_SIZE)
+            state[0].update(b'\0' * length)
+            state[1] += length
+            size -= length
+
+    # 返回：{path: 字节数}
+    def sizes(self):
+        return dict((path, state[1]) for path, state in self.files.items())
+
+    # 返回：{path: md5}，解析失败时返回None
+    def digests(self):
+        if self.failed or self.buffer or self.remaining:
+            return None
+        return dict((path, state[0].hexdigest()) for path, state in self.files.items() if path not in self.invalid)
+
+
+# 执行备份命令，将其stdout经压缩程序写入归档文件
+# parser: 同时输入xtrabackup输出的对象(如XbstreamDigest)，可选
+# 返回：(压缩前字节数, 归档文件md5)
+def execute_stream(command, archive, watcher=None, parser=None):
+    compress = compress_command()
+    logger.info('Begin execute command: {0} | {1} > {2}'.format(
+        [cmd for cmd in command if 'password' not in cmd], compress, archive))
+
+    raw_bytes = 0
+    digest = hashlib.md5()
+
+    with open(output_file, 'a') as fp, open(archive, 'wb') as archive_fp:
+        compressor = subprocess.Popen(compress, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=fp)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=fp)
+        if watcher:
+            watcher.start(process)
+
+        # 压缩程序的输出经本进程写入归档文件，写入时计算校验和，无需再次读取归档文件
+        writer = threading.Thread(target=relay_stream, args=(compressor.stdout, archive_fp, digest))
+        writer.start()
+
+        try:
+            while True:
+                data = process.stdout.read(STREAM_BUFFER_SIZE)
+                if not data:
+                    break
+                raw_bytes += len(data)
+                compressor.stdin.write(data)
+                if parser:
+                    parser.feed(data)
+        except Exception:
+            # 压缩程序异常退出时终止xtrabackup，避免其阻塞在写管道上
+            process.kill()
+            raise
+        finally:
+            if watcher:
+                watcher.stop()
+            process.stdout.close()
+            compressor.stdin.close()
+            process.wait()
+            writer.join()
+            compressor.wait()
+
+        if process.returncode != 0:
+            raise ProcessError(command, process.returncode)
+        if compressor.returncode != 0:
+            raise ProcessError(compress, compressor.returncode)
+
+    logger.info('Command executed')
+    return raw_bytes, digest.hexdigest()
+
+
+# 读取MySQL配置文件中的参数
+def get_cnf_option(name, sections=('mysqld',)):
+    section = None
+    value = None
+
+    with open(MYSQL_CNF) as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip()
+            elif section in sections and '=' in line:
+                k, v = [x.strip() for x in line.split('=', 1)]
+                if k.replace('_', '-') == name.replace('_', '-'):
+                    value = v.strip('\'"')
+
+    return value
+
+
+# 建立MySQL连接，未安装MySQLdb时返回None
+def mysql_connect():
+    if MySQLdb is None:
+        return None
+
+    socket = get_cnf_option('socket', ('client', 'mysqld'))
+    if socket:
+        return MySQLdb.connect(unix_socket=socket, user=MYSQL_USER, passwd=MYSQL_PASSWORD, connect_timeout=5)
+    else:
+        port = get_cnf_option('port', ('client', 'mysqld')) or 3306
+        return MySQLdb.connect(host='127.0.0.1', port=int(port), user=MYSQL_USER, passwd=MYSQL_PASSWORD,
+                               connect_timeout=5)
+
+
+# 检测MySQL提供的变化页跟踪
+# 返回：{'method': bitmap/page_tracking/None, 'datadir': 数据目录, 'page_size': 页大小}
+def detect_page_tracking():
+    info = {'method': None, 'datadir': None, 'page_size': 16384}
+
+    if CHANGED_PAGE_TRACKING != 'auto':
+        return info
+
+    try:
+        conn = mysql_connect()
+    except Exception as exc:
+        logger.warning('Cannot connect to MySQL to detect changed page tracking: {0}'.format(exc))
+        return info
+
+    if conn is None:
+        logger.warning('MySQLdb is not installed, cannot detect changed page tracking')
+        return info
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT @@datadir, @@innodb_page_size')
+        info['datadir'], info['page_size'] = cursor.fetchone()
+
+        cursor.execute("SHOW GLOBAL VARIABLES LIKE 'innodb_track_changed_pages'")
+        row = cursor.fetchone()
+        if row and row[1].upper() == 'ON':
+            info['method'] = 'bitmap'
+        else:
+            try:
+                cursor.execute("SELECT COUNT(*) FROM mysql.component "
+                               "WHERE component_urn = 'file://component_mysqlbackup'")
+                if cursor.fetchone()[0]:
+                    info['method'] = 'page_tracking'
+            except MySQLdb.Error:
+                pass  # 5.7及以下没有mysql.component表
+    except MySQLdb.Error as exc:
+        logger.warning('Cannot detect changed page tracking: {0}'.format(exc))
+    finally:
+        conn.close()
+
+    logger.info('Changed page tracking: {0}'.format(info['method'] or 'not available'))
+    return info
+
+
+# 记录增量备份查找变化页的方式及页数
+# 实际使用的方式以xtrabackup输出为准（如bitmap不完整时xtrabackup会退回全部扫描）
+# 变化页数根据.delta文件大小计算：每个头部页之后最多跟随page_size / 4 - 1个数据页
+def record_incremental_scan(backup_dir, tracking, log_offset, stream_sizes=None):
+    text = ''
+    if os.path.exists(output_file):
+        with open(output_file) as fp:
+            fp.seek(log_offset)
+            text = fp.read().lower()
+
+    if 'full scan' in text:
+        method = 'full_scan'
+    elif 'changed page bitmap' in text:
+        method = 'bitmap'
+    elif 'page tracking' in text or 'page-tracking' in text:
+        method = 'page_tracking'
+    else:
+        method = tracking['method'] or 'full_scan'
+
+    page_size = int(tracking['page_size'])
+    sizes = stream_sizes
+    if sizes is None:
+        sizes = {}
+        for root, dir_names, file_names in os.walk(backup_dir):
+            for name in file_names:
+                sizes[os.path.join(root, name)] = os.path.getsize(os.path.join(root, name))
+
+    total_pages = sum(size // page_size for name, size in sizes.items() if name.endswith('.delta'))
+    pages_changed = total_pages - (total_pages + page_size // 4 - 1) // (page_size // 4)
+
+    pages_examined = pages_changed
+    if method == 'full_scan':
+        pages_examined = None
+        if tracking['datadir'] and os.path.isdir(tracking['datadir']):
+            data_bytes = 0
+            for root, dir_names, file_names in os.walk(tracking['datadir']):
+                for name in file_names:
+                    if name.endswith('.ibd') or name.startswith('ibdata') or name.startswith('undo'):
+                        data_bytes += os.path.getsize(os.path.join(root, name))
+            pages_examined = data_bytes // page_size
+
+    info = {'method': method, 'pages_changed': pages_changed, 'pages_examined': pages_examined,
+            'page_size': page_size}
+    record_event(backup_dir, 'incremental_scan', info)
+    catalog_update(backup_dir, scan_method=method, pages_changed=pages_changed, pages_examined=pages_examined)
+    logger.info('Incremental scan: {0}'.format(info))
+
+
+# 目录所在块设备在/proc/diskstats中的名称
+def get_block_device(path):
+    dev = os.stat(path).st_dev
+    sys_path = '/sys/dev/block/{0}:{1}'.format(os.major(dev), os.minor(dev))
+    if not os.path.exists(sys_path):
+        return None
+    return os.path.basename(os.path.realpath(sys_path))
+
+
+# 读取块设备累计IO时间（毫秒）
+def get_io_ticks(device):
+    with open('/proc/diskstats') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) > 12 and fields[2] == device:
+                return int(fields[12])
+    return None
+
+
+# 备份限速
+# 每个周期采样负载：超过阈值时运行时间比例减半，否则增加0.1；周期内按比例对xtrabackup发送SIGSTOP/SIGCONT
+class Throttler(object):
+    # xtrabackup开始加锁（阻塞业务写入）的输出，此后暂停进程会延长加锁时间
+    # PXB 8.0在开始复制时即执行LOCK INSTANCE FOR BACKUP（只阻塞DDL），不作为加锁标记，否则8.0上限速不会生效
+    LOCK_MARKERS = ('FLUSH TABLES WITH READ LOCK', 'LOCK TABLES FOR BACKUP')
+
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.process = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.duty = 1.0
+        self.conn = None
+        self.device = None
+        self.io_ticks = None
+        self.sample_time = None
+        self.output_offset = 0
+
+    def start(self, process):
+        self.process = process
+        self.output_offset = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+
+        try:
+            self.conn = mysql_connect()
+            if self.conn is None:
+                logger.warning('MySQLdb is not installed, throttle by disk utilization only')
+        except Exception as exc:
+            logger.warning('Cannot connect to MySQL, throttle by disk utilization only: {0}'.format(exc))
+
+        try:
+            datadir = get_cnf_option('datadir')
+            if not datadir and self.conn:
+                datadir = self.query('SELECT @@datadir')
+            self.device = get_block_device(datadir) if datadir else None
+        except (IOError, OSError) as exc:
+            logger.warning('Cannot find datadir device: {0}'.format(exc))
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.signal(signal.SIGCONT)
+        if self.conn:
+            self.conn.close()
+
+    def signal(self, sig):
+        try:
+            self.process.send_signal(sig)
+        except OSError:
+            pass
+
+    def query(self, sql):
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql)
+            row = cur.fetchone()
+            return row[-1] if row else None
+        finally:
+            cur.close()
+
+    # 采样负载
+    # 返回：{指标: 值}，无法采样的指标为None
+    def sample(self):
+        metrics = {'threads_running': None, 'lag': None, 'disk_util': None}
+
+        if self.conn:
+            try:
+                metrics['threads_running'] = int(self.query("SHOW GLOBAL STATUS LIKE 'Threads_running'"))
+                ts = self.query('SELECT MAX(ts) FROM oputil.heartbeat')
+                if ts:
+                    ts = datetime.strptime(ts[:19], '%Y-%m-%dT%H:%M:%S')
+                    metrics['lag'] = max(0, int((datetime.now() - ts).total_seconds()))
+            except Exception as exc:
+                logger.debug('Sample MySQL metrics failed: {0}'.format(exc))
+
+        if self.device:
+            now = time.time()
+            io_ticks = get_io_ticks(self.device)
+            if io_ticks is not None and self.io_ticks is not None:
+                metrics['disk_util'] = min(100, int((io_ticks - self.io_ticks) / ((now - self.sample_time) * 10.0)))
+            self.io_ticks = io_ticks
+            self.sample_time = now
+
+        return metrics
+
+    # xtrabackup是否已开始加锁
+    def locking(self):
+        with open(output_file) as fp:
+            fp.seek(self.output_offset)
+            output = fp.read()
+        self.output_offset += len(output)
+        return any(marker in output for marker in self.LOCK_MARKERS)
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.locking():
+                if self.duty < 1.0:
+                    self.duty = 1.0
+                    record_event(self.backup_dir, 'throttle', {'duty': self.duty, 'reason': 'locking'})
+                logger.info('xtrabackup is locking, stop throttling')
+                return
+
+            metrics = self.sample()
+            reasons = []
+            if metrics['threads_running'] is not None and metrics['threads_running'] > THROTTLE_MAX_THREADS_RUNNING:
+                reasons.append('threads_running')
+            if metrics['lag'] is not None and metrics['lag'] > THROTTLE_MAX_LAG:
+                reasons.append('lag')
+            if metrics['disk_util'] is not None and metrics['disk_util'] > THROTTLE_MAX_DISK_UTIL:
+                reasons.append('disk_util')
+
+            if reasons:
+                duty = max(THROTTLE_MIN_DUTY, self.duty / 2)
+            else:
+                duty = min(1.0, self.duty + 0.1)
+
+            if round(duty, 2) != round(self.duty, 2):
+                self.duty = duty
+                info = dict(metrics, duty=round(duty, 2), reason=','.join(reasons) or 'recover')
+                record_event(self.backup_dir, 'throttle', info)
+                logger.info('Throttle: {0}'.format(info))
+
+            pause = THROTTLE_INTERVAL * (1 - self.duty)
+            if pause > 0:
+                if self.stopped.wait(THROTTLE_INTERVAL - pause):
+                    break
+                self.signal(signal.SIGSTOP)
+                self.stopped.wait(pause)
+                self.signal(signal.SIGCONT)
+            else:
+                self.stopped.wait(THROTTLE_INTERVAL)
+
+
+# 读取进程IO统计，已wait的子进程的IO计入父进程
+# 返回：{rchar, wchar, read_bytes, write_bytes, ...}，不支持时返回空dict
+def read_proc_io(pid='self'):
+    io = {}
+    try:
+        with open('/proc/{0}/io'.format(pid)) as fp:
+            for line in fp:
+                name, value = line.split(':', 1)
+                io[name.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return io
+
+
+# 读取进程内存(KB)，name为VmRSS(当前)或VmHWM(峰值)，进程已退出时返回0
+def read_proc_memory(pid, name):
+    try:
+        with open('/proc/{0}/status'.format(pid)) as fp:
+            for line in fp:
+                if line.startswith(name + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+# 阶段指标
+# 读写字节数取本进程/proc/self/io的差值（包括已结束的子进程），CPU时间包括本进程及子进程；
+# 内存峰值为采样的本进程内存及被执行进程(xtrabackup)的VmHWM中的最大值；
+# 作为watcher传给execute_command时解析xtrabackup输出的进度，并每PROGRESS_INTERVAL秒写入textfile
+class PhaseMetrics(object):
+    # xtrabackup 2.4/8.0开始、完成复制一个文件及redo扫描位置的输出
+    FILE_BEGIN = re.compile(r'\] (?:Copying|Streaming) (\S+)')
+    FILE_DONE = re.compile(r'Done: (?:Copying|Streaming)|\.\.\.done')
+    LOG_SCANNED = re.compile(r'log scanned up to \((\d+)\)')
+
+    def __init__(self, backup_dir, phase):
+        self.backup_dir = backup_dir
+        self.phase = phase
+        self.process = None
+        self.output_offset = 0
+        self.progress = {}
+        self.peak_rss_kb = 0
+        self.stopped = threading.Event()
+
+        self.begin = time.time()
+        self.io = read_proc_io()
+        self.rusage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start(self, process):
+        self.process = process
+        self.output_offset = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+        self.progress = {'files_started': 0, 'files_done': 0, 'log_scanned_lsn': 0, 'read_bytes': 0}
+
+    def stop(self):
+        self.sample()
+        self.process = None
+
+    def run(self):
+        while not self.stopped.wait(min(PROGRESS_INTERVAL, 1)):
+            self.sample()
+            if self.process and time.time() - self.progress.get('time', self.begin) >= PROGRESS_INTERVAL:
+                self.progress['time'] = time.time()
+                write_textfile(self.phase, self.progress)
+
+    def sample(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, read_proc_memory('self', 'VmRSS'))
+
+        process = self.process
+        if process is None:
+            return
+        self.peak_rss_kb = max(self.peak_rss_kb, read_proc_memory(process.pid, 'VmHWM'))
+        self.progress['read_bytes'] = read_proc_io(process.pid).get('rchar', self.progress['read_bytes'])
+
+        try:
+            with open(output_file) as fp:
+                fp.seek(self.output_offset)
+                output = fp.read()
+        except (IOError, OSError):
+            return
+        # 只处理完整的行
+        output = output[:output.rfind('\n') + 1]
+        self.output_offset += len(output)
+
+        for line in output.splitlines():
+            if self.FILE_BEGIN.search(line):
+                self.progress['files_started'] += 1
+            elif self.FILE_DONE.search(line):
+                self.progress['files_done'] += 1
+            match = self.LOG_SCANNED.search(line)
+            if match:
+                self.progress['log_scanned_lsn'] = int(match.group(1))
+
+    # 阶段结束，记录phase_stat事件、保存至状态文件并写入textfile
+    # processed_bytes: 阶段处理的数据量(备份大小/复制字节数)，用于计算吞吐量，None时使用读取字节数
+    def finish(self, success=True, processed_bytes=None):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+        seconds = time.time() - self.begin
+        io = read_proc_io()
+        rusage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+        cpu = sum((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+                  for before, after in zip(self.rusage, rusage))
+        # 子进程的ru_maxrss为已结束子进程中的最大值，阶段中有所增加时说明是本阶段的子进程
+        if rusage[1].ru_maxrss > self.rusage[1].ru_maxrss:
+            self.peak_rss_kb = max(self.peak_rss_kb, rusage[1].ru_maxrss)
+
+        metrics = {
+            'success': int(success),
+            'seconds': round(seconds, 3),
+            'end_time': int(time.time()),
+            'cpu_seconds': round(cpu, 3),
+            'peak_rss_mb': round(self.peak_rss_kb / 1024.0, 1)
+        }
+        for name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+            if name in io:
+                metrics[name] = io[name] - self.io.get(name, 0)
+        metrics['bytes'] = processed_bytes if processed_bytes is not None else metrics.get('read_bytes', 0)
+        metrics['mb_per_sec'] = round(metrics['bytes'] / 1048576.0 / seconds, 3) if seconds else 0
+        if self.progress:
+            metrics['files'] = self.progress['files_done'] or self.progress['files_started']
+            if self.progress['log_scanned_lsn']:
+                metrics['log_scanned_lsn'] = self.progress['log_scanned_lsn']
+
+        record_event(self.backup_dir, 'phase_stat', dict(metrics, phase=self.phase))
+        try:
+            state = load_state() or {}
+            state.setdefault('metrics', {})[self.phase] = metrics
+            save_state(state)
+            write_textfile()
+        except (IOError, OSError) as exc:
+            logger.warning('Cannot save {0} metrics: {1}'.format(self.phase, exc))
+
+        logger.info('Phase {0}: {1}'.format(self.phase, metrics))
+        return metrics
+
+
+# textfile中各阶段的指标：(名称, 说明)
+TEXTFILE_METRICS = (
+    ('success', 'Whether the latest run of the phase succeeded'),
+    ('seconds', 'Duration of the latest run of the phase'),
+    ('end_time', 'Unix time when the latest run of the phase ended'),
+    ('bytes', 'Bytes processed by the latest run of the phase (backup size, copied bytes)'),
+    ('mb_per_sec', 'Throughput of the latest run of the phase in MB/s'),
+    ('read_bytes', 'Bytes read from storage by the phase, including child processes'),
+    ('write_bytes', 'Bytes written to storage by the phase, including child processes'),
+    ('rchar', 'Bytes read by read syscalls in the phase, including pipes and page cache'),
+    ('wchar', 'Bytes written by write syscalls in the phase, including pipes and page cache'),
+    ('cpu_seconds', 'CPU seconds used by the phase, including child processes'),
+    ('peak_rss_mb', 'Peak resident memory of the phase in MB'),
+    ('files', 'Files copied by xtrabackup in the phase')
+)
+
+# 备份过程中的进度指标：(名称, 说明)
+TEXTFILE_PROGRESS = (
+    ('files_started', 'Files xtrabackup started to copy in the running phase'),
+    ('files_done', 'Files xtrabackup finished copying in the running phase'),
+    ('read_bytes', 'Bytes read by xtrabackup in the running phase'),
+    ('log_scanned_lsn', 'LSN xtrabackup has scanned redo log up to in the running phase')
+)
+
+
+# 写入node_exporter textfile，先写临时文件再rename
+# running_phase/progress: 正在执行的阶段及其进度，阶段结束时不传
+def write_textfile(running_phase=None, progress=None):
+    if not PROMETHEUS_TEXTFILE_DIR:
+        return
+
+    name = INSTANCE_NAME or os.path.basename(TARGET_PATH.rstrip(os.path.sep))
+    instance = name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    metrics = (load_state() or {}).get('metrics', {})
+
+    lines = []
+    for metric, help_text in TEXTFILE_METRICS:
+        samples = ['mysql_backup_phase_{0}{{instance="{1}",phase="{2}"}} {3}'.format(metric, instance, phase,
+                                                                                     metrics[phase][metric])
+                   for phase in sorted(metrics) if metrics[phase].get(metric) is not None]
+        if samples:
+            lines.append('# HELP mysql_backup_phase_{0} {1}'.format(metric, help_text))
+            lines.append('# TYPE mysql_backup_phase_{0} gauge'.format(metric))
+            lines.extend(samples)
+
+    lines.append('# HELP mysql_backup_phase_running Whether a phase is running')
+    lines.append('# TYPE mysql_backup_phase_running gauge')
+    lines.append('mysql_backup_phase_running{{instance="{0}"}} {1}'.format(instance, int(running_phase is not None)))
+    if running_phase and progress:
+        for metric, help_text in TEXTFILE_PROGRESS:
+            lines.append('# HELP mysql_backup_progress_{0} {1}'.format(metric, help_text))
+            lines.append('# TYPE mysql_backup_progress_{0} gauge'.format(metric))
+            lines.append('mysql_backup_progress_{0}{{instance="{1}",phase="{2}"}} {3}'.format(
+                metric, instance, running_phase, progress.get(metric, 0)))
+
+    path = os.path.join(PROMETHEUS_TEXTFILE_DIR, 'mysql_backup_{0}.prom'.format(re.sub(r'[^\w.-]', '_', name)))
+    with open(path + '.tmp', 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.rename(path + '.tmp', path)
+
+
+# 组合多个watcher（Throttler/CopyPipeline/PhaseMetrics），传给execute_command
+class WatcherGroup(object):
+    def __init__(self, watchers):
+        self.watchers = watchers
+
+    def start(self, process):
+        for watcher in self.watchers:
+            watcher.start(process)
+
+    def stop(self):
+        for watcher in self.watchers:
+            watcher.stop()
+
+
+# 记录执行事件
+def record_event(backup_dir, event_name, info=None):
+    occur_time = datetime.now().strftime(DATEFMT)
+
+    with open(index_file, 'a') as f:
+        fields = [
+            backup_dir,
+            event_name,
+            occur_time
+        ]
+        if info:
+            fields.append(json.dumps(info, sort_keys=True))
+        f.write('\t'.join(fields) + '\n')
+
+    update_state(backup_dir, event_name, occur_time)
+
+
+# 备份
+def backup(backup_dir, base_dir=None, pipeline=None):
+    command = [
+        XTRABACKUP,
+        '--defaults-file=' + MYSQL_CNF,
+        '--backup',
+        '--user=' + MYSQL_USER,
+        '--password=' + MYSQL_PASSWORD,
+        '--target-dir=' + backup_dir,
+        '--parallel={0}'.format(get_tuning()['parallel'])
+    ]
+
+    # xtrabackup --throttle的单位为每秒复制10MB的块数
+    if XTRABACKUP_THROTTLE:
+        command.append('--throttle={0}'.format(max(1, int(round(XTRABACKUP_THROTTLE / 10.0)))))
+
+    if base_dir:
+        command.extend([
+            '--incremental',
+            '--incremental-basedir=' + base_dir
+        ])
+
+    # page tracking需要全备时开始跟踪，增量备份时读取
+    tracking = detect_page_tracking()
+    if tracking['method'] == 'page_tracking':
+        command.append('--page-tracking')
+
+    if BACKUP_MODE == 'stream':
+        # xtrabackup_checkpoints写入备份目录，增量备份的--incremental-basedir及备份链检查均依赖该文件
+        command.extend([
+            '--stream=xbstream',
+            '--extra-lsndir=' + backup_dir
+        ])
+
+    begin = datetime.now()
+    checksum = None
+    raw_bytes = None
+    throttler = Throttler(backup_dir) if BACKUP_THROTTLE == 'on' else None
+    metrics = PhaseMetrics(backup_dir, 'backup')
+    watcher = WatcherGroup([w for w in (throttler, pipeline, metrics) if w])
+    stream_digest = XbstreamDigest()
+    log_offset = os.path.getsize(output_file) if os.path.exists(output_file) else 0
+
+    try:
+        record_event(backup_dir, 'backup_begin')
+        record_event(backup_dir, 'tuning', get_tuning())
+        catalog_update(backup_dir, parent=base_dir, status='running', begin_time=begin.strftime(DATEFMT))
+
+        if BACKUP_MODE == 'stream':
+            os.makedirs(backup_dir)
+            archive = os.path.join(backup_dir, ARCHIVE_NAMES[COMPRESSOR])
+            raw_bytes, checksum = execute_stream(command, archive, watcher, stream_digest)
+            record_event(backup_dir, 'backup_end', {
+                'raw_bytes': raw_bytes,
+                'compressed_bytes': os.path.getsize(archive)
+            })
+        else:
+            if pipeline:
+                pipeline.watch()
+            execute_command(command, watcher)
+            record_event(backup_dir, 'backup_end')
+    except Exception as exc:
+        logger.error(exc)
+        if pipeline:
+            pipeline.drain()
+        metrics.finish(success=False)
+        record_event(backup_dir, 'backup_error')
+        catalog_update(backup_dir, status='error', end_time=datetime.now().strftime(DATEFMT),
+                       duration=int((datetime.now() - begin).total_seconds()))
+        raise exc
+
+    size = get_dir_size(backup_dir)
+    metrics.finish(processed_bytes=raw_bytes if raw_bytes is not None else size)
+
+    from_lsn, to_lsn = get_lsns(backup_dir)
+    binlog_file, binlog_pos, gtid_executed = get_binlog_pos(backup_dir)
+    catalog_update(backup_dir, status='success', from_lsn=from_lsn, to_lsn=to_lsn, size=size,
+                   checksum=checksum, end_time=datetime.now().strftime(DATEFMT),
+                   duration=int((datetime.now() - begin).total_seconds()),
+                   binlog_file=binlog_file, binlog_pos=binlog_pos, gtid_executed=gtid_executed)
+
+    if base_dir:
+        try:
+            record_incremental_scan(backup_dir, tracking, log_offset,
+                                    stream_digest.sizes() if BACKUP_MODE == 'stream' else None)
+        except (IOError, OSError) as exc:
+            logger.warning('Cannot record incremental scan: {0}'.format(exc))
+
+    try:
+        write_checksum_manifest(backup_dir, checksum,
+                                stream_digest.digests() if BACKUP_MODE == 'stream' else None)
+    except (IOError, OSError) as exc:
+        logger.warning('Cannot write checksum manifest: {0}'.format(exc))
+
+
+# 生成ssh命令
+# 每个通道使用独立的ControlMaster连接，同一通道的多次传输复用连接，避免重复认证
+def ssh_command(remote_command, channel=0):
+    return [
+        'ssh',
+        '-o', 'BatchMode=yes',
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPersist=60',
+        '-o', 'ControlPath=/tmp/.mysql_backup_{0}_{1}_%r@%h:%p'.format(os.getpid(), channel),
+        '{0}@{1}'.format(REMOTE_USER, REMOTE_HOST),
+        remote_command
+    ]
+
+
+# 带宽限制，所有复制通道共享
+class RateLimiter(object):
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, size):
+        if not self.bytes_per_sec:
+            return
+
+        with self.lock:
+            now = time.time()
+            if self.next_time < now:
+                self.next_time = now
+            wait = self.next_time - now
+            self.next_time += float(size) / self.bytes_per_sec
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+# 远端复制进度文件，记录已校验通过的分块，用于断点续传
+# 位于TARGET_PATH下，不随备份目录复制
+def copy_state_file(backup_dir):
+    return os.path.join(TARGET_PATH, '.{0}.copy'.format(os.path.basename(backup_dir)))
+
+
+def load_copy_state(backup_dir):
+    path = copy_state_file(backup_dir)
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except ValueError:
+        logger.warning('Copy state file is corrupted, ignore it: {0}'.format(path))
+        return {}
+
+
+def save_copy_state(backup_dir, state):
+    path = copy_state_file(backup_dir)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.rename(path + '.tmp', path)
+
+
+# 将备份目录拆分为复制任务
+# 返回：([远端目录], [(相对路径, 文件大小, 偏移量, 长度)])
+def split_copy_jobs(backup_dir):
+    dirs = ['.']
+    jobs = []
+
+    for root, dir_names, file_names in os.walk(backup_dir):
+        for name in sorted(dir_names):
+            dirs.append(os.path.relpath(os.path.join(root, name), backup_dir))
+
+        for name in sorted(file_names):
+            rel_path = os.path.relpath(os.path.join(root, name), backup_dir)
+            jobs.extend(file_copy_jobs(rel_path, os.path.getsize(os.path.join(root, name))))
+
+    # 大文件的分块优先传输，减少最后阶段单通道传输的情况
+    jobs.sort(key=lambda job: job[1], reverse=True)
+    return dirs, jobs
+
+
+# 将一个文件拆分为复制任务
+def file_copy_jobs(rel_path, size):
+    chunk_size = int(COPY_CHUNK_SIZE * 1024 * 1024)
+    jobs = []
+    offset = 0
+    while True:
+        length = min(chunk_size, size - offset)
+        jobs.append((rel_path, size, offset, length))
+        offset += length
+        if offset >= size:
+            break
+    return jobs
+
+
+# 通过ssh通道传输一个分块，写入远端后读回计算md5与本地比较
+# 返回：是否校验通过
+def copy_chunk(local_path, remote_path, size, offset, length, channel, limiter):
+    remote_command = (
+        'dd of={path} bs=1M seek={offset} oflag=seek_bytes conv=notrunc status=none && '
+        'truncate -s {size} {path} && '
+        'dd if={path} bs=1M skip={offset} count={length} iflag=skip_bytes,count_bytes status=none | md5sum'
+    ).format(path=quote(remote_path), offset=offset, size=size, length=length)
+
+    md5 = hashlib.md5()
+
+    with open(output_file, 'a') as log_fp, open(local_path, 'rb') as fp:
+        process = subprocess.Popen(ssh_command(remote_command, channel), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=log_fp)
+        try:
+            fp.seek(offset)
+            remain = length
+            while remain > 0:
+                data = fp.read(min(COPY_BUFFER_SIZE, remain))
+                if not data:
+                    raise ProgramError('File truncated while copying: {0}'.format(local_path))
+                limiter.consume(len(data))
+                md5.update(data)
+                process.stdin.write(data)
+                remain -= len(data)
+        except Exception:
+            process.kill()
+            raise
+        finally:
+            process.stdin.close()
+            output = process.stdout.read()
+            process.wait()
+
+    if process.returncode != 0:
+        raise ProcessError(['ssh', REMOTE_HOST, remote_command], process.returncode)
+
+    return output.split()[0].decode() == md5.hexdigest()
+
+
+# 复制通道，从队列中依次取得分块传输，失败的分块重试COPY_RETRY次，取得None时结束
+def copy_worker(channel, backup_dir, remote_dir, jobs, state, lock, limiter, stats, errors):
+    stat = stats[channel]
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        rel_path, size, offset, length = job
+
+        local_path = os.path.join(backup_dir, rel_path)
+        remote_path = os.path.join(remote_dir, rel_path)
+
+        for attempt in range(COPY_RETRY + 1):
+            begin = time.time()
+            try:
+                if copy_chunk(local_path, remote_path, size, offset, length, channel, limiter):
+                    break
+                logger.warning('Checksum mismatch: {0} offset {1}, attempt {2}'.format(rel_path, offset, attempt + 1))
+            except Exception as exc:
+                logger.warning('Copy failed: {0} offset {1}, attempt {2}: {3}'.format(
+                    rel_path, offset, attempt + 1, exc))
+            finally:
+                stat['seconds'] += time.time() - begin
+            stat['retries'] += 1
+        else:
+            errors.append('{0} offset {1}'.format(rel_path, offset))
+            continue
+
+        stat['bytes'] += length
+        stat['chunks'] += 1
+
+        with lock:
+            state.setdefault(rel_path, {'size': size, 'chunks': []})['chunks'].append(offset)
+            save_copy_state(backup_dir, state)
+
+
+# 备份过程中复制已写完的文件
+# 通过inotify(IN_CLOSE_WRITE)监控备份目录及其子目录，每个文件关闭后拆分为分块放入队列，由COPY_STREAMS个通道传输；
+# 传输结果与scp共用进度文件，备份结束后scp作为最终同步，只传输未复制的及复制后又被修改(大小/mtime变化)的文件
+class CopyPipeline(object):
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.remote_dir = os.path.join(REMOTE_PATH, os.path.basename(backup_dir))
+        self.fd = None
+        self.watches = {}  # wd: 相对路径
+        self.shipped = set()
+        self.jobs = queue.Queue()
+        self.state = {}
+        self.lock = threading.Lock()
+        self.limiter = RateLimiter(COPY_BANDWIDTH * 1024 * 1024)
+        self.stats = [{'stream': i, 'bytes': 0, 'chunks': 0, 'retries': 0, 'seconds': 0.0}
+                      for i in range(COPY_STREAMS)]
+        self.errors = []
+        self.workers = []
+        self.watcher = None
+        self.stopped = threading.Event()
+        self.times = {}
+
+    # 建立监控并启动复制通道，需在xtrabackup启动前调用
+    def watch(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        os.makedirs(self.backup_dir)
+        execute_command(ssh_command('mkdir -p ' + quote(self.remote_dir)))
+        record_event(self.backup_dir, 'copy_begin')
+        catalog_update(self.backup_dir, copy_status='running')
+        self.times['backup_begin'] = time.time()
+        self.watch_dir('.')
+
+        for channel in range(COPY_STREAMS):
+            worker = threading.Thread(target=copy_worker, args=(channel, self.backup_dir, self.remote_dir, self.jobs,
+                                                                self.state, self.lock, self.limiter, self.stats,
+                                                                self.errors))
+            worker.start()
+            self.workers.append(worker)
+
+        self.watcher = threading.Thread(target=self.run)
+        self.watcher.start()
+
+    def watch_dir(self, rel_dir):
+        path = os.path.normpath(os.path.join(self.backup_dir, rel_dir))
+        wd = self.add_watch(self.fd, path.encode(), self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: {0}'.format(path))
+        self.watches[wd] = rel_dir
+
+        if rel_dir != '.':
+            execute_command(ssh_command('mkdir -p ' + quote(os.path.join(self.remote_dir, rel_dir))))
+
+        # 建立监控前已创建的子目录需补充监控，其中已写完的文件由最终同步复制
+        for name in sorted(os.listdir(path)):
+            if os.path.isdir(os.path.join(path, name)):
+                self.watch_dir(os.path.normpath(os.path.join(rel_dir, name)))
+
+    def ship(self, rel_path):
+        # 结束时才写入的元数据文件由最终同步复制
+        if rel_path in self.shipped or is_metadata_file(rel_path):
+            return
+        self.shipped.add(rel_path)
+
+        st = os.stat(os.path.join(self.backup_dir, rel_path))
+        with self.lock:
+            self.state[rel_path] = {'size': st.st_size, 'mtime': st.st_mtime, 'chunks': []}
+        self.times.setdefault('copy_begin', time.time())
+        for job in file_copy_jobs(rel_path, st.st_size):
+            self.jobs.put(job)
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not select.select([self.fd], [], [], 1)[0]:
+                continue
+            buf = os.read(self.fd, 65536)
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = struct.unpack('iIII', buf[pos:pos + 16])
+                name = buf[pos + 16:pos + 16 + length].rstrip(b'\0').decode('utf-8', 'replace')
+                pos += 16 + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    logger.warning('Inotify queue overflow, remaining files will be copied after backup')
+                    continue
+                if wd not in self.watches:
+                    continue
+
+                rel_path = os.path.normpath(os.path.join(self.watches[wd], name))
+                try:
+                    if mask & self.IN_ISDIR:
+                        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                            self.watch_dir(rel_path)
+                    elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                        self.ship(rel_path)
+                except Exception as exc:
+                    # 复制失败的文件由最终同步复制
+                    logger.warning('Pipeline copy of {0} failed: {1}'.format(rel_path, exc))
+
+    # 与Throttler相同的接口，由execute_command调用
+    def start(self, process):
+        pass
+
+    def stop(self):
+        self.times['backup_end'] = time.time()
+        self.stopped.set()
+        if self.watcher:
+            self.watcher.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # 等待已入队的分块传输完成
+    def drain(self):
+        self.stop()
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.times['drain_end'] = time.time()
+
+        if self.errors:
+            logger.warning('Pipeline copy failed for {0} chunks, will be copied again: {1}'.format(
+                len(self.errors), ', '.join(self.errors)))
+
+
+# 将备份复制到远端
+# 备份目录按文件/分块拆分后由COPY_STREAMS个ssh通道并发传输，已校验通过的分块记录在进度文件中，
+# 再次执行时（如copy命令）跳过这些分块
+# pipeline: 备份过程中已开始复制的CopyPipeline，此时只需最终同步
+def scp(backup_dir, pipeline=None):
+    remote_dir = os.path.join(REMOTE_PATH, os.path.basename(backup_dir))
+
+    if os.path.exists(os.path.join(backup_dir, DEDUP_MANIFEST)):
+        raise ProgramError('Backup has been ingested into chunk store, cannot copy: {0}'.format(backup_dir))
+
+    try:
+        if pipeline:
+            pipeline.drain()
+        else:
+            record_event(backup_dir, 'copy_begin')
+            catalog_update(backup_dir, copy_status='running')
+        sync_begin = time.time()
+
+        dirs, all_jobs = split_copy_jobs(backup_dir)
+
+        # 文件大小(或备份过程中复制时记录的mtime)变化时之前的进度作废
+        state = load_copy_state(backup_dir)
+        for rel_path in list(state.keys()):
+            path = os.path.join(backup_dir, rel_path)
+            if not os.path.isfile(path) or os.path.getsize(path) != state[rel_path]['size'] or \
+                    state[rel_path].get('mtime', os.path.getmtime(path)) != os.path.getmtime(path):
+                del state[rel_path]
+
+        jobs = queue.Queue()
+        skipped_bytes = 0
+        for job in all_jobs:
+            if job[0] in state and job[2] in state[job[0]]['chunks']:
+                skipped_bytes += job[3]
+            else:
+                jobs.put(job)
+        pending_chunks = jobs.qsize()
+        for _ in range(COPY_STREAMS):
+            jobs.put(None)
+
+        logger.info('Copy {0} to {1}@{2}:{3}, {4} chunks, {5} streams, resume {6} bytes'.format(
+            backup_dir, REMOTE_USER, REMOTE_HOST, remote_dir, pending_chunks, COPY_STREAMS, skipped_bytes))
+
+        execute_command(ssh_command('mkdir -p ' + ' '.join(quote(os.path.join(remote_dir, d)) for d in dirs)))
+
+        lock = threading.Lock()
+        limiter = RateLimiter(COPY_BANDWIDTH * 1024 * 1024)
+        stats = [{'stream': i, 'bytes': 0, 'chunks': 0, 'retries': 0, 'seconds': 0.0} for i in range(COPY_STREAMS)]
+        errors = []
+
+        workers = []
+        for channel in range(COPY_STREAMS):
+            worker = threading.Thread(target=copy_worker,
+                                      args=(channel, backup_dir, remote_dir, jobs, state, lock, limiter, stats, errors))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        for stat in stats:
+            stat['seconds'] = round(stat['seconds'], 3)
+            stat['mb_per_sec'] = round(stat['bytes'] / 1024.0 / 1024.0 / stat['seconds'], 3) if stat['seconds'] else 0
+            record_event(backup_dir, 'copy_stat', stat)
+
+        if errors:
+            raise ProgramError('Copy failed after {0} retries, run copy command to resume: {1}'.format(
+                COPY_RETRY, ', '.join(errors)))
+
+        if pipeline:
+            record_pipeline_stat(backup_dir, pipeline, sync_begin, sum(stat['bytes'] for stat in stats))
+
+        record_event(backup_dir, 'copy_end', {
+            'bytes': sum(stat['bytes'] for stat in stats),
+            'resumed_bytes': skipped_bytes
+        })
+        catalog_update(backup_dir, copy_status='success')
+        if os.path.exists(copy_state_file(backup_dir)):
+            os.remove(copy_state_file(backup_dir))
+        return sum(stat['bytes'] for stat in stats)
+    except Exception as exc:
+        logger.error(exc)
+        record_event(backup_dir, 'copy_error')
+        catalog_update(backup_dir, copy_status='error')
+        raise exc
+
+
+# 复制备份至远端
+def copy_backup(backup_dir, pipeline=None):
+    metrics = PhaseMetrics(backup_dir, 'copy')
+    try:
+        if COPY_TO_REMOTE == 's3':
+            copied_bytes = s3_copy(backup_dir)
+        else:
+            copied_bytes = scp(backup_dir, pipeline)
+    except Exception:
+        metrics.finish(success=False)
+        raise
+    metrics.finish(processed_bytes=copied_bytes)
+
+
+# S3客户端，线程间共用
+def s3_client():
+    return boto3.client('s3', endpoint_url=S3_ENDPOINT, region_name=S3_REGION,
+                        aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY,
+                        config=botocore.config.Config(max_pool_connections=COPY_STREAMS + 2,
+                                                      retries={'max_attempts': 3}))
+
+
+# 备份目录在对象存储中的前缀
+def s3_key(backup_dir, rel_path=''):
+    return '/'.join(p for p in (S3_PREFIX.strip('/'), os.path.basename(backup_dir), rel_path) if p)
+
+
+# 列出前缀下的对象
+# 返回：{对象名: 大小}
+def s3_list(client, prefix):
+    objects = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj['Size']
+    return objects
+
+
+# 上传一个对象或分片，读取的数据随请求发送Content-MD5，由对象存储校验，失败时重试COPY_RETRY次
+# job: (相对路径, 文件大小, 分片号(整个文件上传时为None), 偏移量, 长度, upload_id)
+# 返回：(job, ETag, 重试次数, 耗时)
+def s3_upload(args):
+    client, backup_dir, job, limiter = args
+    rel_path, size, part_number, offset, length, upload_id = job
+    key = s3_key(backup_dir, rel_path)
+    begin = time.time()
+
+    for attempt in range(COPY_RETRY + 1):
+        try:
+            with open(os.path.join(backup_dir, rel_path), 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read(length)
+            if len(data) != length:
+                raise ProgramError('File truncated while copying: {0}'.format(rel_path))
+            limiter.consume(length)
+
+            content_md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+            if part_number is None:
+                response = client.put_object(Bucket=S3_BUCKET, Key=key, Body=data, ContentMD5=content_md5,
+                                             Metadata={'mtime': str(os.path.getmtime(fp.name))})
+            else:
+                response = client.upload_part(Bucket=S3_BUCKET, Key=key, Body=data, ContentMD5=content_md5,
+                                              PartNumber=part_number, UploadId=upload_id)
+            return job, response['ETag'], attempt, time.time() - begin
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, IOError, ProgramError) as exc:
+            logger.warning('Upload failed: {0} part {1}, attempt {2}: {3}'.format(
+                rel_path, part_number or 1, attempt + 1, exc))
+            time.sleep(min(2 ** attempt, 30))
+
+    return job, None, COPY_RETRY + 1, time.time() - begin
+
+
+# 上传备份至对象存储
+# 大于S3_PART_SIZE的文件使用分片上传，各文件的分片一起由COPY_STREAMS个线程并发上传，某个文件的分片全部完成后合并；
+# 对象存储中大小相同且mtime一致的文件跳过（再次执行copy时续传未完成的文件）
+def s3_copy(backup_dir):
+    if os.path.exists(os.path.join(backup_dir, DEDUP_MANIFEST)):
+        raise ProgramError('Backup has been ingested into chunk store, cannot copy: {0}'.format(backup_dir))
+
+    client = s3_client()
+    part_size = max(5, S3_PART_SIZE) * 1024 * 1024
+    uploads = {}
+
+    try:
+        record_event(backup_dir, 'copy_begin')
+        catalog_update(backup_dir, copy_status='running')
+        begin = time.time()
+
+        existing = s3_list(client, s3_key(backup_dir) + '/')
+        jobs = []
+        skipped_bytes = 0
+        for root, dir_names, file_names in os.walk(backup_dir):
+            for name in file_names:
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, backup_dir)
+                size = os.path.getsize(path)
+                key = s3_key(backup_dir, rel_path)
+
+                if existing.get(key) == size and client.head_object(Bucket=S3_BUCKET, Key=key).get(
+                        'Metadata', {}).get('mtime') == str(os.path.getmtime(path)):
+                    skipped_bytes += size
+                    continue
+
+                if size <= part_size:
+                    jobs.append((rel_path, size, None, 0, size, None))
+                    continue
+
+                upload_id = client.create_multipart_upload(Bucket=S3_BUCKET, Key=key, Metadata={
+                    'mtime': str(os.path.getmtime(path))})['UploadId']
+                uploads[rel_path] = {'upload_id': upload_id, 'parts': {}, 'count': (size + part_size - 1) // part_size}
+                for i in range(uploads[rel_path]['count']):
+                    jobs.append((rel_path, size, i + 1, i * part_size, min(part_size, size - i * part_size), upload_id))
+
+        # 大文件的分片优先上传，减少最后阶段单线程上传的情况
+        jobs.sort(key=lambda job: job[1], reverse=True)
+        logger.info('Copy {0} to s3://{1}/{2}, {3} objects, {4} parts, {5} streams, resume {6} bytes'.format(
+            backup_dir, S3_BUCKET, s3_key(backup_dir), len(set(job[0] for job in jobs)), len(jobs), COPY_STREAMS,
+            skipped_bytes))
+
+        limiter = RateLimiter(COPY_BANDWIDTH * 1024 * 1024)
+        stat = {'target': 's3', 'bytes': 0, 'parts': 0, 'objects': 0, 'retries': 0, 'seconds': 0.0}
+        errors = []
+
+        pool = ThreadPool(COPY_STREAMS)
+        try:
+            for job, etag, retries, seconds in pool.imap_unordered(
+                    s3_upload, [(client, backup_dir, job, limiter) for job in jobs]):
+                rel_path, part_number = job[0], job[2]
+                stat['retries'] += retries
+                stat['seconds'] += seconds
+                if etag is None:
+                    errors.append('{0} part {1}'.format(rel_path, part_number or 1))
+                    continue
+
+                stat['bytes'] += job[4]
+                stat['parts'] += 1
+                if part_number is None:
+                    stat['objects'] += 1
+                    continue
+
+                upload = uploads[rel_path]
+                upload['parts'][part_number] = etag
+                if len(upload['parts']) == upload['count']:
+                    client.complete_multipart_upload(
+                        Bucket=S3_BUCKET, Key=s3_key(backup_dir, rel_path), UploadId=upload['upload_id'],
+                        MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': upload['parts'][n]}
+                                                   for n in sorted(upload['parts'])]})
+                    del uploads[rel_path]
+                    stat['objects'] += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        stat['seconds'] = round(stat['seconds'], 3)
+        elapsed = time.time() - begin
+        stat['mb_per_sec'] = round(stat['bytes'] / 1024.0 / 1024.0 / elapsed, 3) if elapsed else 0
+        record_event(backup_dir, 'copy_stat', stat)
+
+        if errors:
+            raise ProgramError('Copy failed after {0} retries, run copy command to resume: {1}'.format(
+                COPY_RETRY, ', '.join(errors)))
+
+        record_event(backup_dir, 'copy_end', {
+            'bytes': stat['bytes'],
+            'resumed_bytes': skipped_bytes
+        })
+        catalog_update(backup_dir, copy_status='success')
+        return stat['bytes']
+    except Exception as exc:
+        logger.error(exc)
+        # 未完成的分片上传会继续占用存储空间，放弃
+        for rel_path, upload in uploads.items():
+            try:
+                client.abort_multipart_upload(Bucket=S3_BUCKET, Key=s3_key(backup_dir, rel_path),
+                                              UploadId=upload['upload_id'])
+            except Exception as abort_exc:
+                logger.warning('Cannot abort multipart upload of {0}: {1}'.format(rel_path, abort_exc))
+        record_event(backup_dir, 'copy_error')
+        catalog_update(backup_dir, copy_status='error')
+        raise exc
+
+
+# 记录备份过程中复制与备份的重叠情况
+# overlap_seconds: 备份与复制同时进行的时间；saved_seconds: 与备份结束后才开始复制相比节省的时间(估算)
+def record_pipeline_stat(backup_dir, pipeline, sync_begin, sync_bytes):
+    times = pipeline.times
+    end = time.time()
+    copy_begin = times.get('copy_begin', sync_begin)
+    pipeline_bytes = sum(stat['bytes'] for stat in pipeline.stats)
+
+    info = {
+        'backup_seconds': round(times['backup_end'] - times['backup_begin'], 3),
+        'pipeline_files': len(pipeline.shipped),
+        'pipeline_bytes': pipeline_bytes,
+        'drain_seconds': round(times['drain_end'] - times['backup_end'], 3),
+        'sync_seconds': round(end - sync_begin, 3),
+        'sync_bytes': sync_bytes,
+        'overlap_seconds': round(max(0.0, times['backup_end'] - copy_begin), 3),
+        'total_seconds': round(end - times['backup_begin'], 3)
+    }
+    # 不重叠时总时间为备份时间加全部复制时间，备份过程中的复制时间取各通道传输时间的最大值
+    copy_seconds = max(stat['seconds'] for stat in pipeline.stats) + info['sync_seconds']
+    info['saved_seconds'] = round(max(0.0, info['backup_seconds'] + copy_seconds - info['total_seconds']), 3)
+
+    record_event(backup_dir, 'pipeline_stat', info)
+    logger.info('Pipeline copy: {0}'.format(info))
+
+
+# 是否为去重存储保留在备份目录中的元数据文件
+def is_metadata_file(rel_path):
+    return os.path.dirname(rel_path) == '' and \
+        (rel_path.startswith('xtrabackup_') or rel_path in ('backup-my.cnf', DEDUP_MANIFEST, CHECKSUM_MANIFEST))
+
+
+# 块文件路径，按sha256前两位分目录
+def chunk_file(digest):
+    return os.path.join(chunk_path, digest[:2], digest)
+
+
+# 读取清单
+# 返回：[(相对路径, 文件大小, [块sha256])]
+def read_manifest(backup_dir):
+    entries = []
+    with open(os.path.join(backup_dir, DEDUP_MANIFEST)) as fp:
+        for line in fp:
+            rel_path, size, digests = line.rstrip('\n').split('\t')
+            entries.append((rel_path, int(size), digests.split(',') if digests else []))
+    return entries
+
+
+# 将备份目录中的数据文件导入块存储，备份目录中只保留元数据文件及清单
+# 先增加引用计数再写清单、删除原文件，中途失败只会多保留块，不会误删被引用的块
+def ingest_backup(backup_dir, workers):
+    chunk_size = int(DEDUP_CHUNK_SIZE * 1024 * 1024)
+    begin = time.time()
+
+    files = []
+    for root, dir_names, file_names in os.walk(backup_dir):
+        for name in file_names:
+            rel_path = os.path.relpath(os.path.join(root, name), backup_dir)
+            if not is_metadata_file(rel_path):
+                files.append(rel_path)
+
+    lock = threading.Lock()
+    seen = set()
+    stat = {'files': len(files), 'logical_bytes': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0}
+
+    def ingest_file(rel_path):
+        digests = []
+        with open(os.path.join(backup_dir, rel_path), 'rb') as fp:
+            while True:
+                data = fp.read(chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                digests.append(digest)
+
+                path = chunk_file(digest)
+                with lock:
+                    stat['logical_bytes'] += len(data)
+                    stat['chunks'] += 1
+                    new = digest not in seen and not os.path.exists(path)
+                    seen.add(digest)
+                if new:
+                    if not os.path.isdir(os.path.dirname(path)):
+                        try:
+                            os.makedirs(os.path.dirname(path))
+                        except OSError:
+                            pass
+                    with open(path + '.tmp', 'wb') as chunk_fp:
+                        chunk_fp.write(data)
+                    os.rename(path + '.tmp', path)
+                    with lock:
+                        stat['new_chunks'] += 1
+                        stat['new_bytes'] += len(data)
+        return rel_path, os.path.getsize(os.path.join(backup_dir, rel_path)), digests
+
+    pool = ThreadPool(workers)
+    try:
+        entries = pool.map(ingest_file, files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    refs = {}
+    sizes = {}
+    for rel_path, size, digests in entries:
+        for i, digest in enumerate(digests):
+            refs[digest] = refs.get(digest, 0) + 1
+            sizes[digest] = min(chunk_size, size - i * chunk_size)
+
+    conn = catalog()
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO chunks (hash, size, refs) VALUES (?, ?, 0)',
+                         [(digest, sizes[digest]) for digest in refs])
+        conn.executemany('UPDATE chunks SET refs = refs + ? WHERE hash = ?',
+                         [(count, digest) for digest, count in refs.items()])
+
+    manifest = os.path.join(backup_dir, DEDUP_MANIFEST)
+    with open(manifest + '.tmp', 'w') as fp:
+        for rel_path, size, digests in sorted(entries):
+            fp.write('{0}\t{1}\t{2}\n'.format(rel_path, size, ','.join(digests)))
+    os.rename(manifest + '.tmp', manifest)
+
+    for rel_path in files:
+        os.remove(os.path.join(backup_dir, rel_path))
+    for root, dir_names, file_names in os.walk(backup_dir, topdown=False):
+        if root != backup_dir and not os.listdir(root):
+            os.rmdir(root)
+
+    stat['seconds'] = round(time.time() - begin, 3)
+    stat['mb_per_sec'] = round(stat['logical_bytes'] / 1024.0 / 1024.0 / (stat['seconds'] or 1), 3)
+    stat['dedup_ratio'] = round(float(stat['logical_bytes']) / (stat['new_bytes'] or 1), 3)
+    store_logical, store_bytes = conn.execute('SELECT SUM(size * refs), SUM(size) FROM chunks').fetchone()
+    stat['store_logical_bytes'] = store_logical or 0
+    stat['store_bytes'] = store_bytes or 0
+    stat['store_dedup_ratio'] = round(float(store_logical or 0) / (store_bytes or 1), 3)
+
+    record_event(backup_dir, 'dedup_stat', stat)
+    logger.info('Ingested {0} into chunk store: {1}'.format(backup_dir, stat))
+
+
+# 减少过期备份清单引用的块计数，引用为0的块移入回收目录
+def release_chunks(dirs):
+    refs = {}
+    for backup_dir in dirs:
+        if not os.path.exists(os.path.join(backup_dir, DEDUP_MANIFEST)):
+            continue
+        for rel_path, size, digests in read_manifest(backup_dir):
+            for digest in digests:
+                refs[digest] = refs.get(digest, 0) + 1
+
+    if not refs:
+        return 0
+
+    conn = catalog()
+    with conn:
+        conn.executemany('UPDATE chunks SET refs = refs - ? WHERE hash = ?',
+                         [(count, digest) for digest, count in refs.items()])
+        garbage = [row[0] for row in conn.execute('SELECT hash FROM chunks WHERE refs <= 0')]
+
+        gc_dir = os.path.join(trash_path, 'chunks.{0}'.format(int(time.time() * 1000)))
+        if garbage:
+            os.makedirs(gc_dir)
+        for digest in garbage:
+            if os.path.exists(chunk_file(digest)):
+                os.rename(chunk_file(digest), os.path.join(gc_dir, digest))
+        conn.executemany('DELETE FROM chunks WHERE hash = ?', [(digest,) for digest in garbage])
+
+    logger.info('Released {0} chunks, {1} chunks unreferenced'.format(len(refs), len(garbage)))
+    return len(garbage)
+
+
+# 根据清单从块存储还原备份文件，元数据文件直接复制
+def materialize_backup(backup_dir, dest_dir, workers):
+    entries = read_manifest(backup_dir)
+    parallel_copy(backup_dir, dest_dir, workers, exclude=(DEDUP_MANIFEST,))
+
+    def restore_file(entry):
+        rel_path, size, digests = entry
+        dest = os.path.join(dest_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(dest)):
+            try:
+                os.makedirs(os.path.dirname(dest))
+            except OSError:
+                pass
+        with open(dest, 'wb') as fp:
+            for digest in digests:
+                with open(chunk_file(digest), 'rb') as chunk_fp:
+                    shutil.copyfileobj(chunk_fp, fp, COPY_BUFFER_SIZE)
+        if os.path.getsize(dest) != size:
+            raise ProgramError('Size mismatch after restore from chunk store: {0}'.format(dest))
+        return size
+
+    pool = ThreadPool(workers)
+    try:
+        return sum(pool.map(restore_file, sorted(entries, key=lambda e: e[1], reverse=True), chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# 计算文件md5，文件由多个部分(如去重存储的块)依次组成时按顺序读取
+# 在进程池中执行
+def md5_file(job):
+    rel_path, paths = job
+    digest = hashlib.md5()
+    size = 0
+    try:
+        for path in paths:
+            with open(path, 'rb') as fp:
+                while True:
+                    data = fp.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    size += len(data)
+    except (IOError, OSError):
+        return rel_path, None, size
+    return rel_path, digest.hexdigest(), size
+
+
+# 解压归档文件并解析xbstream，计算流中各文件的md5，在进程池中执行
+def md5_archive(archive):
+    compressor = [name for name, archive_name in ARCHIVE_NAMES.items() if archive.endswith(archive_name)][0]
+    parser = XbstreamDigest()
+    size = 0
+
+    process = subprocess.Popen([spawn.find_executable(compressor), '-dc', archive], stdout=subprocess.PIPE)
+    while True:
+        data = process.stdout.read(STREAM_BUFFER_SIZE)
+        if not data:
+            break
+        parser.feed(data)
+        size += len(data)
+    process.wait()
+
+    return parser.digests() if process.returncode == 0 else None, size
+
+
+# 读取md5sum格式的清单
+# 返回：{相对路径: md5}
+def read_checksums(path):
+    checksums = {}
+    with open(path) as fp:
+        for line in fp:
+            if line.strip():
+                checksums[line[34:].rstrip('\n')] = line[:32]
+    return checksums
+
+
+def write_checksums(path, checksums):
+    with open(path + '.tmp', 'w') as fp:
+        for rel_path in sorted(checksums):
+            fp.write('{0}  {1}\n'.format(checksums[rel_path], rel_path))
+    os.rename(path + '.tmp', path)
+
+
+# 生成备份目录的校验清单
+# stream模式归档文件的md5在写入时已计算，流中各文件的md5由XbstreamDigest在写入时计算；
+# dir模式由xtrabackup直接写文件，需重新读取全部文件，DIR_CHECKSUM = 'on'时备份完成后立即多进程计算（数据可能仍在page cache中）
+def write_checksum_manifest(backup_dir, archive_checksum=None, stream_digests=None):
+    if stream_digests is None and DIR_CHECKSUM.lower() != 'on':
+        logger.info('DIR_CHECKSUM is off, skip checksum manifest')
+        return
+
+    begin = time.time()
+    archive = get_archive(backup_dir)
+    jobs = []
+
+    for root, dir_names, file_names in os.walk(backup_dir):
+        for name in file_names:
+            rel_path = os.path.relpath(os.path.join(root, name), backup_dir)
+            if rel_path not in (CHECKSUM_MANIFEST, STREAM_MANIFEST) and \
+                    not (archive_checksum and os.path.join(root, name) == archive):
+                jobs.append((rel_path, [os.path.join(root, name)]))
+
+    pool = multiprocessing.Pool(min(len(jobs), get_tuning()['cpus']) or 1)
+    try:
+        checksums = dict((rel_path, digest) for rel_path, digest, size in pool.imap_unordered(md5_file, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+    if archive_checksum:
+        checksums[os.path.basename(archive)] = archive_checksum
+    write_checksums(os.path.join(backup_dir, CHECKSUM_MANIFEST), checksums)
+
+    if stream_digests is not None:
+        write_checksums(os.path.join(backup_dir, STREAM_MANIFEST), stream_digests)
+
+    logger.info('Checksum manifest written, {0} files{1}, {2:.1f}s'.format(
+        len(checksums), ', {0} files in stream'.format(len(stream_digests)) if stream_digests is not None else '',
+        time.time() - begin))
+
+
+# 校验本地备份，每个文件一个任务，由进程池并发计算
+# deep: stream模式同时解压归档文件校验其中各文件
+# 返回：{files, bytes, failed}
+def verify_local(backup_dir, workers, deep=False):
+    checksums = read_checksums(os.path.join(backup_dir, CHECKSUM_MANIFEST))
+
+    dedup = {}
+    if os.path.exists(os.path.join(backup_dir, DEDUP_MANIFEST)):
+        dedup = dict((rel_path, [chunk_file(digest) for digest in digests])
+                     for rel_path, size, digests in read_manifest(backup_dir))
+
+    jobs = [(rel_path, dedup.get(rel_path, [os.path.join(backup_dir, rel_path)])) for rel_path in checksums]
+    stat = {'files': len(jobs), 'bytes': 0, 'failed': []}
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        archive = get_archive(backup_dir)
+        stream_result = None
+        if deep and archive and os.path.exists(os.path.join(backup_dir, STREAM_MANIFEST)):
+            stream_result = pool.apply_async(md5_archive, (archive,))
+
+        for rel_path, digest, size in pool.imap_unordered(md5_file, sorted(jobs, key=lambda j: -len(j[1])),
+                                                          chunksize=1):
+            stat['bytes'] += size
+            if digest != checksums[rel_path]:
+                stat['failed'].append(rel_path)
+
+        if stream_result:
+            expected = read_checksums(os.path.join(backup_dir, STREAM_MANIFEST))
+            digests, size = stream_result.get()
+            stat['stream_files'] = len(expected)
+            stat['bytes'] += size
+            for rel_path in sorted(expected):
+                if digests is None or digests.get(rel_path) != expected[rel_path]:
+                    stat['failed'].append('{0}:{1}'.format(os.path.basename(archive), rel_path))
+    finally:
+        pool.close()
+        pool.join()
+
+    return stat
+
+
+# 校验远端备份，清单通过stdin传入，远端使用xargs -P并发执行md5sum
+# xargs返回123表示部分文件md5sum失败（如文件不存在），作为文件校验失败；ssh失败(255)、cd失败等其他错误抛出异常
+def verify_remote(backup_dir, workers):
+    checksums = read_checksums(os.path.join(backup_dir, CHECKSUM_MANIFEST))
+    remote_dir = os.path.join(REMOTE_PATH, os.path.basename(backup_dir))
+    remote_command = 'cd {0} && tr "\\n" "\\0" | xargs -0 -r -P {1} -n 8 md5sum --'.format(quote(remote_dir), workers)
+
+    process = subprocess.Popen(ssh_command(remote_command), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = process.communicate(''.join(rel_path + '\n' for rel_path in checksums).encode())[0]
+    if process.returncode not in (0, 123):
+        raise ProcessError(ssh_command(remote_command), process.returncode)
+
+    remote = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if line.strip():
+            remote[line[34:]] = line[:32]
+
+    failed = [rel_path for rel_path in sorted(checksums) if remote.get(rel_path) != checksums[rel_path]]
+    return {'files': len(checksums), 'failed': failed}
+
+
+# 校验备份：本地及已复制至远端的备份，结果记录为verify_end/verify_error事件
+def verify(backup_dir, workers, deep=False):
+    if not os.path.exists(os.path.join(backup_dir, CHECKSUM_MANIFEST)):
+        raise ProgramError('Cannot find checksum manifest in {0}, dir mode backups have one only when '
+                           'DIR_CHECKSUM is on'.format(backup_dir))
+
+    begin = time.time()
+    info = {'local': verify_local(backup_dir, workers, deep)}
+
+    rows = catalog_query('backup_dir = ?', (backup_dir,))
+    if COPY_TO_REMOTE.lower() == 'scp' and rows and rows[0]['copy_status'] == 'success':
+        try:
+            info['remote'] = verify_remote(backup_dir, workers)
+        except ProcessError as exc:
+            info['local']['failed'] = info['local']['failed'][:20]
+            info['remote'] = {'error': str(exc)}
+            record_event(backup_dir, 'verify_error', info)
+            raise exc
+
+    info['seconds'] = round(time.time() - begin, 3)
+    failed = sum(len(result['failed']) for result in info.values() if isinstance(result, dict))
+    for result in info.values():
+        if isinstance(result, dict):
+            result['failed'] = result['failed'][:20]
+
+    record_event(backup_dir, 'verify_error' if failed else 'verify_end', info)
+    if failed:
+        raise ProgramError('Verify {0} failed: {1}'.format(backup_dir, info))
+    logger.info('Verify {0} succeeded: {1}'.format(backup_dir, info))
+
+
+# 解析恢复指定备份需要的备份链
+# 返回：[全备目录, 增量目录...]
+def resolve_chain(until_dir):
+    row = catalog().execute("SELECT MAX(backup_dir) FROM backups WHERE backup_type = 'base' AND backup_dir <= ?",
+                            (until_dir,)).fetchone()
+    base_dir = row[0] if row else None
+
+    if not base_dir or not catalog_query('backup_dir = ?', (until_dir,)):
+        raise ProgramError('Cannot find backup or its base backup in catalog: {0}'.format(until_dir))
+
+    if not check_backup_chain(base_dir, until_dir):
+        raise ProgramError('Backup chain is broken: {0} -> {1}'.format(base_dir, until_dir))
+
+    return [r['backup_dir'] for r in catalog_query('backup_dir BETWEEN ? AND ?', (base_dir, until_dir))]
+
+
+# 依次执行管道连接的多个命令
+def execute_pipeline(commands):
+    logger.info('Begin execute command: {0}'.format(' | '.join(' '.join(command) for command in commands)))
+
+    with open(output_file, 'a') as fp:
+        processes = []
+        stdin = None
+        for i, command in enumerate(commands):
+            stdout = subprocess.PIPE if i < len(commands) - 1 else fp
+            process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=fp)
+            if stdin:
+                stdin.close()  # 只由下游进程持有管道读端，下游异常退出时上游可收到SIGPIPE
+            stdin = process.stdout
+            processes.append(process)
+
+        for command, process in zip(commands, processes):
+            process.wait()
+            if process.returncode != 0:
+                raise ProcessError(command, process.returncode)
+
+    logger.info('Command executed')
+
+
+# 并发复制/移动目录下的文件
+# 返回：文件总字节数
+def parallel_copy(src_dir, dest_dir, workers, move=False, exclude=()):
+    files = []
+    for root, dir_names, file_names in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        if not os.path.isdir(os.path.join(dest_dir, rel_root)):
+            os.makedirs(os.path.join(dest_dir, rel_root))
+        for name in file_names:
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if rel_path not in exclude:
+                files.append((os.path.getsize(os.path.join(root, name)), rel_path))
+
+    def copy_file(job):
+        src = os.path.join(src_dir, job[1])
+        dest = os.path.join(dest_dir, job[1])
+        if move:
+            shutil.move(src, dest)
+        else:
+            shutil.copy2(src, dest)
+        return job[0]
+
+    # 大文件优先，避免最后阶段只有一个线程在复制大文件
+    pool = ThreadPool(workers)
+    try:
+        return sum(pool.map(copy_file, sorted(files, reverse=True), chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# 将备份解压/复制到工作目录
+# dir模式的增量备份prepare时只读，直接使用备份目录
+# 返回：可用于prepare的目录
+def stage_backup(backup_dir, dest_dir, workers):
+    archive = get_archive(backup_dir)
+
+    if archive:
+        compressor = [name for name, archive_name in ARCHIVE_NAMES.items() if archive.endswith(archive_name)][0]
+        xbstream = spawn.find_executable('xbstream')
+        if xbstream is None:
+            raise ProgramError('Cannot find xbstream')
+
+        os.makedirs(dest_dir)
+        execute_pipeline([
+            [spawn.find_executable(compressor), '-dc', archive],
+            [xbstream, '-x', '-C', dest_dir, '--parallel={0}'.format(workers)]
+        ])
+        return dest_dir
+
+    if os.path.exists(os.path.join(backup_dir, DEDUP_MANIFEST)):
+        os.makedirs(dest_dir)
+        materialize_backup(backup_dir, dest_dir, workers)
+        return dest_dir
+
+    if backup_dir.endswith('incr'):
+        return backup_dir
+
+    os.makedirs(dest_dir)
+    parallel_copy(backup_dir, dest_dir, workers)
+    return dest_dir
+
+
+# 并发暂存多个备份，jobs: [(备份目录, 暂存目录)]
+# 同时最多workers个，workers在并发的备份间平分，避免长备份链同时启动大量解压管道及复制线程
+# 返回：[暂存后的目录]，与jobs顺序一致
+def stage_backups(jobs, workers):
+    if not jobs:
+        return []
+
+    concurrency = min(workers, len(jobs))
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(lambda job: stage_backup(job[0], job[1], max(1, workers // concurrency)), jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# prepare备份
+def prepare_backup(target_dir, incremental_dir=None, apply_log_only=False):
+    command = [
+        XTRABACKUP,
+        '--prepare',
+        '--target-dir=' + target_dir,
+        '--use-memory={0}'.format(get_tuning()['use_memory']),
+        '--parallel={0}'.format(get_tuning()['parallel'])
+    ]
+
+    if apply_log_only:
+        command.append('--apply-log-only')
+
+    if incremental_dir:
+        command.append('--incremental-dir=' + incremental_dir)
+
+    execute_command(command)
+
+
+# 恢复备份至指定数据目录
+# 阶段：stage（并发解压/复制备份链）、prepare（依次应用全备及增量）、copy_back（并发复制/移动至数据目录）
+def restore(target, until_dir, work_dir, workers, move=False):
+    target = os.path.abspath(target)
+    work_dir = os.path.abspath(work_dir or target.rstrip(os.path.sep) + '_restore')
+
+    if os.path.exists(target) and os.listdir(target):
+        raise ProgramError('Restore target is not empty: {0}'.format(target))
+    if os.path.exists(work_dir):
+        raise ProgramError('Restore work dir already exists: {0}'.format(work_dir))
+
+    chain = resolve_chain(until_dir)
+    logger.info('Restore {0} to {1}, chain: {2}, workers: {3}'.format(
+        until_dir, target, ' -> '.join(os.path.basename(d) for d in chain), workers))
+
+    timing = {}
+    begin = time.time()
+
+    # 备份链中各备份互不依赖，并发解压/复制
+    staged = stage_backups([(d, os.path.join(work_dir, os.path.basename(d))) for d in chain], workers)
+    timing['stage'] = time.time() - begin
+
+    phase_begin = time.time()
+    base_dir, incr_dirs = staged[0], staged[1:]
+    prepare_backup(base_dir, apply_log_only=bool(incr_dirs))
+    for i, incr_dir in enumerate(incr_dirs):
+        prepare_backup(base_dir, incremental_dir=incr_dir, apply_log_only=(i < len(incr_dirs) - 1))
+    timing['prepare'] = time.time() - phase_begin
+
+    phase_begin = time.time()
+    # 与xtrabackup --copy-back一致，保留xtrabackup_binlog_info/xtrabackup_info，基于时间点恢复时从中读取binlog位置
+    exclude = ['xtrabackup_checkpoints', 'xtrabackup_logfile', 'backup-my.cnf']
+    restored_bytes = parallel_copy(base_dir, target, workers, move=move, exclude=exclude)
+    timing['copy_back'] = time.time() - phase_begin
+
+    shutil.rmtree(work_dir)
+    timing['total'] = time.time() - begin
+
+    info = dict((k, round(v, 3)) for k, v in timing.items())
+    info.update({'target': target, 'bytes': restored_bytes, 'chain': len(chain), 'workers': workers})
+    record_event(until_dir, 'restore_stat', info)
+
+    for phase in ('stage', 'prepare', 'copy_back', 'total'):
+        logger.info('Restore {0}: {1:.1f}s'.format(phase, timing[phase]))
+    logger.info('Restore completed, please check owner of {0} (chown -R mysql:mysql) before starting MySQL'.format(
+        target))
+
+
+# 合成全备：将until_dir所在备份链合并为新的全备
+# 全备及各增量依次以--apply-log-only prepare，结果仍可作为后续增量备份的incremental-basedir及恢复时的全备
+# dir模式直接在新备份目录中prepare，stream模式在工作目录prepare后经xbstream -c重新打包压缩
+# 返回：新备份目录
+def synthesize(until_dir, workers):
+    chain = resolve_chain(until_dir)
+    backup_dir = generate_backup_dir()
+    work_dir = backup_dir + '_synthesize'
+    begin = datetime.now()
+    checksum = None
+    stream_digest = XbstreamDigest()
+
+    logger.info('Synthesize {0} from chain: {1}'.format(
+        backup_dir, ' -> '.join(os.path.basename(d) for d in chain)))
+
+    try:
+        record_event(backup_dir, 'backup_begin')
+        catalog_update(backup_dir, status='running', begin_time=begin.strftime(DATEFMT))
+
+        staged = stage_backups([(chain[0], backup_dir if BACKUP_MODE == 'dir' else os.path.join(work_dir, 'base'))] +
+                               [(d, os.path.join(work_dir, os.path.basename(d))) for d in chain[1:]], workers)
+        base_dir, incr_dirs = staged[0], staged[1:]
+
+        prepare_backup(base_dir, apply_log_only=True)
+        for incr_dir in incr_dirs:
+            prepare_backup(base_dir, incremental_dir=incr_dir, apply_log_only=True)
+
+        # binlog位置以最后一个增量备份为准
+        for name in ('xtrabackup_binlog_info', 'xtrabackup_info'):
+            if incr_dirs and os.path.exists(os.path.join(incr_dirs[-1], name)):
+                shutil.copy2(os.path.join(incr_dirs[-1], name), os.path.join(base_dir, name))
+
+        if BACKUP_MODE == 'stream':
+            os.makedirs(backup_dir)
+            for name in ('xtrabackup_checkpoints', 'xtrabackup_info', 'xtrabackup_binlog_info'):
+                if os.path.exists(os.path.join(base_dir, name)):
+                    shutil.copy2(os.path.join(base_dir, name), os.path.join(backup_dir, name))
+
+            files = []
+            for root, dir_names, file_names in os.walk(base_dir):
+                files.extend(os.path.relpath(os.path.join(root, name), base_dir) for name in file_names)
+
+            # 文件列表经xargs分批传给xbstream -c，避免文件数很多（如file-per-table的大量表）时超过ARG_MAX；
+            # xbstream流没有全局头尾，多次输出直接拼接即为完整的流
+            file_list = os.path.join(work_dir, 'xbstream.files')
+            with open(file_list, 'w') as fp:
+                fp.write(''.join(name + '\0' for name in sorted(files)))
+            xbstream = spawn.find_executable('xbstream')
+            raw_bytes, checksum = execute_stream(['xargs', '-0', '-a', file_list, xbstream, '-c', '-C', base_dir],
+                                                 os.path.join(backup_dir, ARCHIVE_NAMES[COMPRESSOR]),
+                                                 parser=stream_digest)
+
+        if os.path.exists(work_dir):
+            shutil.rmtree(work_dir)
+
+        record_event(backup_dir, 'backup_end', {
+            'synthetic': [os.path.basename(d) for d in chain],
+            'seconds': int((datetime.now() - begin).total_seconds())
+        })
+    except Exception as exc:
+        logger.error(exc)
+        record_event(backup_dir, 'backup_error')
+        catalog_update(backup_dir, status='error', end_time=datetime.now().strftime(DATEFMT),
+                       duration=int((datetime.now() - begin).total_seconds()))
+        raise exc
+
+    from_lsn, to_lsn = get_lsns(backup_dir)
+    binlog_file, binlog_pos, gtid_executed = get_binlog_pos(backup_dir)
+    catalog_update(backup_dir, status='success', from_lsn=from_lsn, to_lsn=to_lsn, size=get_dir_size(backup_dir),
+                   checksum=checksum, end_time=datetime.now().strftime(DATEFMT),
+                   duration=int((datetime.now() - begin).total_seconds()),
+                   binlog_file=binlog_file, binlog_pos=binlog_pos, gtid_executed=gtid_executed)
+
+    try:
+        write_checksum_manifest(backup_dir, checksum,
+                                stream_digest.digests() if BACKUP_MODE == 'stream' else None)
+    except (IOError, OSError) as exc:
+        logger.warning('Cannot write checksum manifest: {0}'.format(exc))
+
+    return backup_dir
+
+
+# 解析Previous_gtids事件内容
+# 格式：sid数量(8) + [uuid(16) + 区间数量(8) + [start(8) + end(8, 不含)]...]...，末尾可能有4字节校验和
+def decode_gtid_set(body):
+    n_sids = struct.unpack('<Q', body[:8])[0]
+    pos = 8
+    sids = []
+
+    for _ in range(n_sids):
+        uuid = binascii.hexlify(body[pos:pos + 16]).decode()
+        uuid = '-'.join((uuid[:8], uuid[8:12], uuid[12:16], uuid[16:20], uuid[20:]))
+        n_intervals = struct.unpack('<Q', body[pos + 16:pos + 24])[0]
+        pos += 24
+
+        intervals = []
+        for _ in range(n_intervals):
+            start, end = struct.unpack('<QQ', body[pos:pos + 16])
+            intervals.append(str(start) if end - 1 == start else '{0}-{1}'.format(start, end - 1))
+            pos += 16
+
+        sids.append(':'.join([uuid] + intervals))
+
+    return ','.join(sids)
+
+
+# 读取binlog文件信息
+# 返回：{'end_pos': 文件大小, 'first_time'/'last_time': 第一个/最后一个事件时间, 'gtid_begin': 文件开始时已执行的GTID}
+def read_binlog_info(path):
+    size = os.path.getsize(path)
+    info = {'end_pos': size, 'first_time': None, 'last_time': None, 'gtid_begin': ''}
+
+    with open(path, 'rb') as fp:
+        if fp.read(4) != b'\xfebin':
+            raise ProgramError('Not a binlog file: {0}'.format(path))
+
+        pos = 4
+        while pos + 19 <= size:
+            fp.seek(pos)
+            timestamp, type_code, server_id, event_size, log_pos, flags = struct.unpack('<IBIIIH', fp.read(19))
+            if event_size < 19 or pos + event_size > size:
+                break
+
+            # 人为生成的事件（如Rotate）时间为0
+            if timestamp:
+                event_time = datetime.fromtimestamp(timestamp).strftime(DATEFMT)
+                info['first_time'] = info['first_time'] or event_time
+                info['last_time'] = event_time
+
+            if type_code == PREVIOUS_GTIDS_EVENT:
+                info['gtid_begin'] = decode_gtid_set(fp.read(event_size - 19))
+
+            pos += event_size
+
+    return info
+
+
+# 备份目录中的binlog文件
+# 返回：(未压缩的binlog文件名列表, 已压缩的binlog文件名列表)，均按文件名升序排列
+def list_local_binlogs():
+    raw = []
+    archived = []
+
+    for name in sorted(os.listdir(BINLOG_PATH)):
+        for ext in BINLOG_EXTS.values():
+            if name.endswith(ext) and BINLOG_NAME_PATTERN.match(name[:-len(ext)]):
+                archived.append(name[:-len(ext)])
+                break
+        else:
+            if BINLOG_NAME_PATTERN.match(name):
+                raw.append(name)
+
+    return raw, archived
+
+
+# 压缩已关闭的binlog，记录位置/时间/GTID范围
+# mysqlbinlog按顺序写入，除最新文件外都已关闭；下一文件开始时的GTID即为本文件结束时的GTID
+def archive_binlogs():
+    raw, archived = list_local_binlogs()
+
+    for name, next_name in zip(raw[:-1], raw[1:]):
+        path = os.path.join(BINLOG_PATH, name)
+        archive = path + BINLOG_EXTS[COMPRESSOR]
+
+        info = read_binlog_info(path)
+        info['gtid_end'] = read_binlog_info(os.path.join(BINLOG_PATH, next_name))['gtid_begin']
+
+        with open(path, 'rb') as src, open(archive + '.tmp', 'wb') as dest:
+            process = subprocess.Popen(compress_command(), stdin=src, stdout=dest)
+            process.wait()
+            if process.returncode != 0:
+                raise ProcessError(compress_command(), process.returncode)
+        os.rename(archive + '.tmp', archive)
+        os.remove(path)
+
+        conn = catalog()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO binlogs ({0}) VALUES ({1})'.format(
+                ', '.join(BINLOG_COLUMNS), ', '.join('?' * len(BINLOG_COLUMNS))),
+                [name, archive] + [info[k] for k in BINLOG_COLUMNS[2:]])
+
+        info['file'] = name
+        info['start_pos'] = 4
+        record_event(archive, 'binlog_archived', info)
+        logger.info('Binlog archived: {0}'.format(archive))
+
+
+# 保存binlog备份状态，monitor读取其中的同步时间计算延迟
+def save_binlog_state(state):
+    with open(binlog_state_file + '.tmp', 'w') as fp:
+        json.dump(state, fp, sort_keys=True)
+    os.rename(binlog_state_file + '.tmp', binlog_state_file)
+
+
+# 检查本地binlog与MySQL当前binlog位置，二者一致时更新同步时间
+def check_binlog_lag(conn, state):
+    cur = conn.cursor()
+    try:
+        cur.execute('SHOW MASTER STATUS')
+        row = cur.fetchone()
+    finally:
+        cur.close()
+
+    raw, archived = list_local_binlogs()
+    local_file = raw[-1] if raw else (archived[-1] if archived else None)
+    local_pos = os.path.getsize(os.path.join(BINLOG_PATH, local_file)) if raw else None
+
+    state.update({
+        'server_file': row[0],
+        'server_pos': int(row[1]),
+        'local_file': local_file,
+        'local_pos': local_pos
+    })
+
+    if local_file == row[0] and local_pos is not None and local_pos >= int(row[1]):
+        state['synced_at'] = time.time()
+
+    save_binlog_state(state)
+
+
+# 确定mysqlbinlog开始拉取的文件：最新的未压缩文件（重新拉取）、最新已压缩文件的下一个文件或MySQL上最早的文件
+def binlog_start_file(conn):
+    raw, archived = list_local_binlogs()
+    if raw:
+        return raw[-1]
+
+    cur = conn.cursor()
+    try:
+        cur.execute('SHOW BINARY LOGS')
+        server_files = [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+    if archived:
+        for name in server_files:
+            if name > archived[-1]:
+                return name
+        return server_files[-1]
+
+    return server_files[0]
+
+
+# Binlog备份常驻进程
+def binlog_daemon():
+    if MySQLdb is None:
+        raise ProgramError('Binlog backup requires MySQLdb')
+    if MYSQLBINLOG is None or not os.path.exists(MYSQLBINLOG):
+        raise ProgramError('Cannot find mysqlbinlog: {0}'.format(MYSQLBINLOG))
+    if compressor_path() is None:
+        raise ProgramError('Cannot find compressor: {0}'.format(COMPRESSOR))
+
+    if not os.path.isdir(BINLOG_PATH):
+        os.makedirs(BINLOG_PATH)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    conn = None  # MySQL不可用时为None，重连成功后才使用
+    retry_interval = BINLOG_INTERVAL
+    state = {'synced_at': time.time()}
+    process = None
+
+    try:
+        while not stopped.is_set():
+            # 已拉取的binlog在MySQL不可用时也压缩归档
+            try:
+                archive_binlogs()
+            except Exception as exc:
+                logger.error(exc)
+
+            try:
+                if conn is None:
+                    conn = mysql_connect()
+                    logger.info('Connected to MySQL')
+                if process is None or process.poll() is not None:
+                    if process is not None:
+                        logger.error('mysqlbinlog exited, return code: {0}, restart it'.format(process.returncode))
+                    process = start_mysqlbinlog(binlog_start_file(conn))
+                check_binlog_lag(conn, state)
+                retry_interval = BINLOG_INTERVAL
+            except Exception as exc:
+                logger.error('{0}, retry in {1}s'.format(exc, retry_interval))
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+                stopped.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, BINLOG_RETRY_MAX)
+                continue
+
+            stopped.wait(BINLOG_INTERVAL)
+    finally:
+        if process is not None and process.poll() is None:
+            process.terminate()
+            process.wait()
+        if conn is not None:
+            conn.close()
+
+    logger.info('Binlog backup stopped')
+
+
+# 启动mysqlbinlog持续拉取binlog，从start_file开始
+def start_mysqlbinlog(start_file):
+    command = [
+        MYSQLBINLOG,
+        '--read-from-remote-server',
+        '--raw',
+        '--stop-never',
+        '--stop-never-slave-server-id={0}'.format(BINLOG_SERVER_ID),
+        '--user=' + MYSQL_USER,
+        '--password=' + MYSQL_PASSWORD,
+        '--result-file=' + BINLOG_PATH + os.path.sep
+    ]
+
+    socket = get_cnf_option('socket', ('client', 'mysqld'))
+    if socket:
+        command.append('--socket=' + socket)
+    else:
+        command.extend(['--host=127.0.0.1', '--port={0}'.format(
+            get_cnf_option('port', ('client', 'mysqld')) or 3306)])
+    command.append(start_file)
+
+    logger.info('Begin execute command: {0}'.format([cmd for cmd in command if 'password' not in cmd]))
+    with open(output_file, 'a') as fp:
+        return subprocess.Popen(command, stdout=fp, stderr=subprocess.STDOUT)
+
+
+# 删除最早保留的全备之前的binlog
+def remove_old_binlogs():
+    if not os.path.isdir(BINLOG_PATH):
+        return
+
+    row = catalog().execute("SELECT binlog_file FROM backups WHERE backup_type = 'base' AND binlog_file IS NOT NULL "
+                            "ORDER BY backup_dir LIMIT 1").fetchone()
+    if not row:
+        return
+
+    paths = []
+    for name, path in catalog().execute('SELECT file, path FROM binlogs WHERE file < ? ORDER BY file', (row[0],)):
+        logger.info('Remove old binlog: {0}'.format(path))
+        if os.path.exists(path):
+            move_to_trash(path)
+            paths.append(path)
+        conn = catalog()
+        with conn:
+            conn.execute('DELETE FROM binlogs WHERE file = ?', (name,))
+
+    if paths:
+        start_purge()
+
+
+# 解析GTID集合
+# 返回：{uuid: [(start, end)]}，区间包含end
+def parse_gtid_set(text):
+    gtid_set = {}
+
+    for item in (text or '').replace('\n', '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        fields = item.split(':')
+        intervals = gtid_set.setdefault(fields[0].lower(), [])
+        for interval in fields[1:]:
+            start, _, end = interval.partition('-')
+            intervals.append((int(start), int(end or start)))
+
+    return gtid_set
+
+
+# GTID集合a是否包含于b
+def gtid_subset(a, b):
+    for uuid, intervals in a.items():
+        for start, end in intervals:
+            if not any(b_start <= start and end <= b_end for b_start, b_end in b.get(uuid, [])):
+                return False
+    return True
+
+
+# 选择基于时间点/GTID恢复使用的备份：目标之前最新的、备份链完整的备份
+def select_pitr_backup(to_time=None, to_gtid=None):
+    target_gtid = parse_gtid_set(to_gtid)
+
+    for row in reversed(catalog_query("status = 'success'")):
+        if to_time and not (row['end_time'] and row['end_time'] <= to_time.strftime(DATEFMT)):
+            continue
+        if to_gtid and not (row['gtid_executed'] and gtid_subset(parse_gtid_set(row['gtid_executed']), target_gtid)):
+            continue
+
+        try:
+            resolve_chain(row['backup_dir'])
+        except ProgramError as exc:
+            logger.warning(exc)
+            continue
+
+        return row['backup_dir']
+
+    raise ProgramError('Cannot find backup before {0}'.format(to_time or to_gtid))
+
+
+# 取得恢复需要应用的binlog：从start_file开始，到第一个事件晚于目标时间或开始时GTID已包含目标GTID的文件之前
+# 返回：[(文件名, 备份文件路径)]
+def pitr_binlogs(start_file, to_time=None, to_gtid=None):
+    files = [(row[0], row[1], row[2], row[3]) for row in catalog().execute(
+        'SELECT file, path, first_time, gtid_begin FROM binlogs WHERE file >= ? ORDER BY file', (start_file,))]
+
+    # binlog备份进程正在写入的文件尚未压缩及记录到编目库
+    for name in list_local_binlogs()[0]:
+        if name >= start_file and name not in [f[0] for f in files]:
+            info = read_binlog_info(os.path.join(BINLOG_PATH, name))
+            files.append((name, os.path.join(BINLOG_PATH, name), info['first_time'], info['gtid_begin']))
+
+    if not files or files[0][0] != start_file:
+        raise ProgramError('Cannot find binlog {0} in {1}'.format(start_file, BINLOG_PATH))
+
+    target_gtid = parse_gtid_set(to_gtid)
+    result = []
+
+    for name, path, first_time, gtid_begin in sorted(files):
+        if result:
+            if int(name.rsplit('.', 1)[1]) != int(result[-1][0].rsplit('.', 1)[1]) + 1:
+                raise ProgramError('Binlog is missing between {0} and {1}'.format(result[-1][0], name))
+            if to_time and first_time and first_time > to_time.strftime(DATEFMT):
+                break
+            if to_gtid and gtid_begin and gtid_subset(target_gtid, parse_gtid_set(gtid_begin)):
+                break
+        result.append((name, path))
+
+    return result
+
+
+# 解析一个binlog为SQL文件，压缩的binlog先解压至工作目录
+# 返回：(SQL文件, binlog字节数, 耗时)
+def decode_binlog(name, path, work_dir, start_pos=None, to_time=None, to_gtid=None):
+    begin = time.time()
+    binlog = os.path.join(work_dir, name)
+
+    if path.endswith(name):
+        binlog = path
+    else:
+        compressor = [c for c, ext in BINLOG_EXTS.items() if path.endswith(ext)][0]
+        with open(binlog, 'wb') as fp:
+            process = subprocess.Popen([spawn.find_executable(compressor), '-dc', path], stdout=fp)
+            process.wait()
+            if process.returncode != 0:
+                raise ProcessError([compressor, '-dc', path], process.returncode)
+
+    command = [MYSQLBINLOG, binlog]
+    if start_pos:
+        command.append('--start-position={0}'.format(start_pos))
+    if to_time:
+        command.append('--stop-datetime={0}'.format(to_time.strftime('%Y-%m-%d %H:%M:%S')))
+    if to_gtid:
+        command.append('--include-gtids={0}'.format(to_gtid))
+
+    sql_file = os.path.join(work_dir, name + '.sql')
+    with open(sql_file, 'wb') as fp, open(output_file, 'a') as log_fp:
+        process = subprocess.Popen(command, stdout=fp, stderr=log_fp)
+        process.wait()
+        if process.returncode != 0:
+            raise ProcessError(command, process.returncode)
+
+    binlog_bytes = os.path.getsize(binlog)
+    if binlog != path:
+        os.remove(binlog)
+
+    return sql_file, binlog_bytes, time.time() - begin
+
+
+# 将binlog应用至恢复后的MySQL
+# 多个binlog由线程池并发解析，按顺序依次应用，应用当前文件时后续文件继续解析；
+# 除正在应用的文件外，解析中及已解析待应用的binlog最多workers个（SQL文件通常为binlog的数倍），应用后立即删除SQL文件
+def replay_binlogs(target, socket, workers, to_time=None, to_gtid=None):
+    start_file, start_pos, gtid_executed = get_binlog_pos(target)
+    if not start_file:
+        raise ProgramError('Cannot find binlog position in {0}'.format(target))
+
+    if MYSQL_CLIENT is None or MYSQLBINLOG is None:
+        raise ProgramError('Cannot find mysql client or mysqlbinlog')
+
+    binlogs = pitr_binlogs(start_file, to_time, to_gtid)
+    logger.info('Replay binlogs from {0}:{1} to {2}: {3}'.format(
+        start_file, start_pos, to_time or to_gtid, ', '.join(name for name, path in binlogs)))
+    if gtid_executed:
+        logger.info('GTID of the backup: {0}, please make sure gtid_purged of the restored MySQL contains it'.format(
+            gtid_executed))
+
+    work_dir = target.rstrip(os.path.sep) + '_replay'
+    os.makedirs(work_dir)
+
+    stat = {'binlogs': len(binlogs), 'decode_bytes': 0, 'decode_seconds': 0.0, 'apply_bytes': 0,
+            'apply_seconds': 0.0}
+    begin = time.time()
+    command = [
+        MYSQL_CLIENT,
+        '--binary-mode',
+        '--user=' + MYSQL_USER,
+        '--password=' + MYSQL_PASSWORD,
+        '--socket=' + socket
+    ]
+
+    pool = ThreadPool(workers)
+
+    def decode(i):
+        return pool.apply_async(decode_binlog, (binlogs[i][0], binlogs[i][1], work_dir,
+                                                start_pos if i == 0 else None, to_time, to_gtid))
+
+    try:
+        decoding = [decode(i) for i in range(min(workers, len(binlogs)))]
+        for i in range(len(binlogs)):
+            sql_file, binlog_bytes, decode_seconds = decoding.pop(0).get()
+            if i + workers < len(binlogs):
+                decoding.append(decode(i + workers))
+
+            stat['decode_bytes'] += binlog_bytes
+            stat['decode_seconds'] += decode_seconds
+
+            apply_begin = time.time()
+            logger.info('Apply {0}'.format(sql_file))
+            with open(sql_file, 'rb') as fp, open(output_file, 'a') as log_fp:
+                process = subprocess.Popen(command, stdin=fp, stdout=log_fp, stderr=log_fp)
+                process.wait()
+                if process.returncode != 0:
+                    raise ProcessError([c for c in command if 'password' not in c], process.returncode)
+            stat['apply_seconds'] += time.time() - apply_begin
+            stat['apply_bytes'] += os.path.getsize(sql_file)
+            os.remove(sql_file)
+    finally:
+        pool.close()
+        pool.join()
+
+    shutil.rmtree(work_dir)
+
+    stat['total_seconds'] = time.time() - begin
+    stat['decode_mb_per_sec'] = stat['decode_bytes'] / 1024.0 / 1024.0 / (stat['decode_seconds'] or 1)
+    stat['apply_mb_per_sec'] = stat['apply_bytes'] / 1024.0 / 1024.0 / (stat['apply_seconds'] or 1)
+    stat['replay_mb_per_sec'] = stat['decode_bytes'] / 1024.0 / 1024.0 / (stat['total_seconds'] or 1)
+    stat = dict((k, round(v, 3) if isinstance(v, float) else v) for k, v in stat.items())
+    stat['target'] = target
+
+    record_event(os.path.join(BINLOG_PATH, start_file), 'replay_stat', stat)
+    logger.info('Replay completed: {0}'.format(stat))
+
+
+# 根据备份各阶段事件时间计算监控信息
+def compute_result(backup_dir, step):
+    result = {
+        'backup_date': 0,
+        'backup_time': 0,
+        'backup_type': 0,  # 0-全量 1-增量
+        'backup_success': 0,  # 0-失败 1-成功
+        'backup_elapsed': 0,  # 秒
+        'copy_success': 0,  # 0-失败 1-成功
+        'copy_elapsed': 0  # 秒
+    }
+
+    if not backup_dir:
+        return result
+
+    fields = os.path.basename(backup_dir.strip(os.path.sep)).split('_')
+    if len(fields) != 3:
+        return result
+
+    result['backup_date'] = int(fields[0])
+    result['backup_time'] = int(fields[1])
+    result['backup_type'] = 0 if fields[2] == 'base' else 1
+
+    step = dict((k, datetime.strptime(v, DATEFMT) if v else None) for k, v in step.items())
+
+    result['backup_success'] = 1 if step['backup_error'] is None else 0
+    if step['backup_begin'] is None or (step['backup_end'] is None and step['backup_error'] is None):
+        result['backup_elapsed'] = 0
+    else:
+        result['backup_elapsed'] = int(((step['backup_end'] if step['backup_end'] else step['backup_error']) -
+                                        step['backup_begin']).total_seconds())
+
+    if COPY_TO_REMOTE == 'off':
+        result['copy_success'] = 1
+        result['copy_elapsed'] = 0
+    else:
+        result['copy_success'] = 1 if step['copy_error'] is None else 0
+        if step['copy_begin'] is None or (step['copy_end'] is None and step['copy_error'] is None):
+            result['copy_elapsed'] = 0
+        else:
+            result['copy_elapsed'] = int(((step['copy_end'] if step['copy_end'] else step['copy_error']) -
+                                          step['copy_begin']).total_seconds())
+
+    return result
+
+
+# 将事件计入各阶段事件时间，阶段重新开始（如copy续传）时清除该阶段之前的结果
+def apply_event(step, event_name, occur_time):
+    if event_name not in step:
+        return
+
+    if event_name.endswith('_begin'):
+        phase = event_name[:-len('_begin')]
+        step[phase + '_end'] = None
+        step[phase + '_error'] = None
+
+    step[event_name] = occur_time
+
+
+# 从index文件读取备份各阶段事件时间，需要扫描整个index文件，仅在状态文件不存在时使用
+def scan_index(backup_dir):
+    step = dict.fromkeys(STEP_EVENTS)
+
+    if not os.path.exists(index_file):
+        return step
+
+    with open(index_file, 'r') as f:
+        for line in f:
+            if line:
+                dir_name, event_name, occur_time = line.rstrip('\n').split('\t')[:3]
+                if dir_name == backup_dir:
+                    apply_event(step, event_name, occur_time.strip())
+
+    return step
+
+
+# 读取状态文件，不存在时返回None
+def load_state():
+    try:
+        with open(state_file) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# 写入状态文件，先写临时文件再rename，读取方不会读到不完整的内容
+def save_state(state):
+    with open(state_file + '.tmp', 'w') as fp:
+        json.dump(state, fp, sort_keys=True)
+    os.rename(state_file + '.tmp', state_file)
+
+
+# 更新最新备份的状态
+def update_state(backup_dir, event_name, occur_time):
+    # 最近一次校验结果，可以是任一备份
+    if event_name in VERIFY_EVENTS:
+        state = load_state() or {}
+        state['verify'] = {'backup_dir': backup_dir, 'success': int(event_name == 'verify_end'), 'time': occur_time}
+        save_state(state)
+        return
+
+    if event_name not in STEP_EVENTS:
+        return
+
+    state = load_state() or {}
+    last_dir = state.get('backup_dir')
+
+    # 旧备份的事件（如对旧备份执行copy）不影响最新备份的状态
+    if last_dir and backup_dir < last_dir:
+        return
+
+    if last_dir == backup_dir:
+        step = state['step']
+    else:
+        step = dict.fromkeys(STEP_EVENTS)
+
+    apply_event(step, event_name, occur_time)
+
+    state['backup_dir'] = backup_dir
+    state['step'] = step
+    state['result'] = compute_result(backup_dir, step)
+    save_state(state)
+
+
+# 调度监控信息
+# scheduler_queue/scheduler_running/scheduler_failed: 排队/执行中/失败的实例数
+# scheduler_wait: 实例排队等待的最长秒数，scheduler_elapsed: 最近一次调度执行的秒数（执行中时为已执行秒数）
+def scheduler_result(scheduler):
+    instances = list(scheduler['instances'].values())
+    end = time.time() if scheduler.get('end_time') is None else scheduler['end_time']
+    waits = [(instance.get('started') or time.time()) - instance['queued'] for instance in instances]
+
+    return {
+        'scheduler_queue': sum(1 for instance in instances if instance['status'] == 'queued'),
+        'scheduler_running': sum(1 for instance in instances if instance['status'] == 'running'),
+        'scheduler_failed': sum(1 for instance in instances if instance['status'] == 'error'),
+        'scheduler_wait': int(max(waits or [0])),
+        'scheduler_elapsed': int(end - scheduler['begin_time'])
+    }
+
+
+# 获取备份执行信息供监控使用
+# monitor_key为all时返回json格式的全部监控信息，scheduler返回json格式的调度状态（含各实例排队/执行时间）
+def monitor(monitor_key):
+    # 调度信息只读取调度状态文件，与实例无关
+    if monitor_key.startswith('scheduler'):
+        scheduler = load_scheduler_state()
+        if scheduler is None:
+            return 0
+        if monitor_key == 'scheduler':
+            return json.dumps(scheduler, sort_keys=True)
+        return scheduler_result(scheduler).get(monitor_key, 0)
+
+    state = load_state()
+
+    if state is None or 'result' not in state:
+        # 状态文件不存在（如升级后尚未执行过备份），扫描备份目录及index文件生成
+        backup_dir = get_last_backup_dirs()[0]
+        step = scan_index(backup_dir)
+        state = dict(state or {}, backup_dir=backup_dir, step=step, result=compute_result(backup_dir, step))
+        try:
+            save_state(state)
+        except (IOError, OSError):
+            pass
+
+    result = dict(state['result'])
+
+    # binlog备份延迟：当前时间与最近一次同步时间的差，binlog备份进程停止时延迟持续增长
+    try:
+        with open(binlog_state_file) as fp:
+            result['binlog_lag'] = int(time.time() - json.load(fp)['synced_at'])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    # 最近一次校验结果及距今秒数，未校验过时不返回
+    if state.get('verify'):
+        result['verify_success'] = state['verify']['success']
+        result['verify_age'] = int(time.time() - time.mktime(
+            datetime.strptime(state['verify']['time'], DATEFMT).timetuple()))
+
+    # 各阶段最近一次的吞吐量等指标，如backup_mb_per_sec/copy_cpu_seconds
+    for phase, metrics in (state.get('metrics') or {}).items():
+        for name in ('mb_per_sec', 'bytes', 'read_bytes', 'write_bytes', 'cpu_seconds', 'peak_rss_mb'):
+            if name in metrics:
+                result['{0}_{1}'.format(phase, name)] = metrics[name]
+
+    if monitor_key == 'all':
+        scheduler = load_scheduler_state()
+        if scheduler is not None:
+            result.update(scheduler_result(scheduler))
+        return json.dumps(result, sort_keys=True)
+
+    return result.get(monitor_key, 0)
+
+
+# 读取调度状态文件
+def load_scheduler_state():
+    try:
+        with open(scheduler_state_file) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# 写入调度状态文件，先写临时文件再rename
+def save_scheduler_state(scheduler):
+    with open(scheduler_state_file + '.tmp', 'w') as fp:
+        json.dump(scheduler, fp, sort_keys=True)
+    os.rename(scheduler_state_file + '.tmp', scheduler_state_file)
+
+
+# 调度多个实例的备份
+# 每个实例由子进程执行（mysql_backup.py --instance <name> <command>），同时最多concurrency个；
+# throttle(MB/s)为所有实例的IO预算，按同时执行的实例数上限min(concurrency, 实例数)平均分配(--io-limit)；
+# 每个实例的份额在启动时确定，xtrabackup运行中不能调整，其他实例结束后不会增加
+def schedule(instances_path, command, concurrency, throttle=None):
+    instances = load_instances(instances_path)
+    acquire_lock(scheduler_lock_file)
+
+    now = time.time()
+    scheduler = {
+        'command': command,
+        'concurrency': concurrency,
+        'throttle': throttle,
+        'begin_time': now,
+        'end_time': None,
+        'instances': dict((instance['name'], {'status': 'queued', 'queued': now}) for instance in instances)
+    }
+    lock = threading.Lock()
+    save_scheduler_state(scheduler)
+
+    def run(name):
+        info = scheduler['instances'][name]
+        with lock:
+            info.update(status='running', started=time.time())
+            info['wait_seconds'] = round(info['started'] - info['queued'], 3)
+            save_scheduler_state(scheduler)
+        logger.info('Instance {0}: start {1} backup, waited {2:.1f}s'.format(name, command, info['wait_seconds']))
+
+        child = [sys.executable, os.path.abspath(__file__), '--instances', instances_path, '--instance', name,
+                 command]
+        if throttle:
+            child.extend(['--io-limit', str(float(throttle) / min(concurrency, len(instances)))])
+        with open(os.devnull, 'wb') as devnull:
+            process = subprocess.Popen(child, stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+            output = process.communicate()[1]
+
+        with lock:
+            info.update(status='success' if process.returncode == 0 else 'error', ended=time.time())
+            info['duration'] = round(info['ended'] - info['started'], 3)
+            if process.returncode != 0:
+                # 子进程的日志同时写入实例TARGET_PATH下的日志文件，这里只保留最后一行错误信息
+                lines = output.decode('utf-8', 'replace').strip().splitlines()
+                info['error'] = lines[-1] if lines else 'Return code: {0}'.format(process.returncode)
+            save_scheduler_state(scheduler)
+        logger.info('Instance {0}: {1} in {2:.1f}s'.format(name, info['status'], info['duration']))
+        return info['status']
+
+    pool = ThreadPool(concurrency)
+    try:
+        statuses = pool.map(run, [instance['name'] for instance in instances], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    with lock:
+        scheduler['end_time'] = time.time()
+        save_scheduler_state(scheduler)
+
+    failed = [name for name, status in zip([instance['name'] for instance in instances], statuses)
+              if status != 'success']
+    logger.info('Schedule {0} backup of {1} instances in {2:.1f}s, failed: {3}'.format(
+        command, len(instances), scheduler['end_time'] - scheduler['begin_time'], failed or 'none'))
+    if failed:
+        raise ProgramError('Backup failed on instances: {0}'.format(', '.join(failed)))
+
+
+# 移入回收目录，同名时增加时间戳后缀
+def move_to_trash(path):
+    if not os.path.isdir(trash_path):
+        os.makedirs(trash_path)
+
+    dest = os.path.join(trash_path, os.path.basename(path))
+    if os.path.exists(dest):
+        dest = '{0}.{1}'.format(dest, int(time.time() * 1000))
+    os.rename(path, dest)
+
+
+# 启动后台删除进程，不等待其结束
+def start_purge():
+    command = [sys.executable, os.path.abspath(__file__)] + _instance_args + ['purge']
+    if spawn.find_executable('ionice'):
+        command = ['ionice', '-c3'] + command
+    command = ['nice', '-n19'] + command
+
+    logger.info('Start purge process: {0}'.format(' '.join(command)))
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid)
+
+
+# 删除回收目录中的文件，限速并逐步截断大文件
+# 同时只有一个删除进程，释放锁后回收目录仍不为空(其他进程刚移入)则继续删除
+def purge_trash():
+    limiter = RateLimiter(PURGE_BANDWIDTH * 1024 * 1024)
+    step = int(PURGE_TRUNCATE_SIZE * 1024 * 1024)
+
+    while os.path.isdir(trash_path) and os.listdir(trash_path):
+        with open(purge_lock_file, 'a') as lock_fp:
+            try:
+                fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.info('Another purge process is running')
+                return
+
+            begin = time.time()
+            files, total_bytes = 0, 0
+            for root, dir_names, file_names in os.walk(trash_path, topdown=False):
+                for name in file_names:
+                    path = os.path.join(root, name)
+                    size = os.lstat(path).st_size
+                    total_bytes += size
+                    files += 1
+
+                    if step and size > step and not os.path.islink(path):
+                        with open(path, 'r+b') as fp:
+                            while size > step:
+                                size -= step
+                                fp.truncate(size)
+                                limiter.consume(step)
+                    os.remove(path)
+                    limiter.consume(size)
+
+                if root != trash_path:
+                    os.rmdir(root)
+
+            logger.info('Purged {0} files, {1} bytes in {2:.1f}s'.format(files, total_bytes, time.time() - begin))
+
+
+# 删除过期备份目录
+# 移入回收目录后即从编目库删除，实际删除由后台进程完成，不阻塞本次及下次备份
+# 去重存储的备份先减少块引用计数，不再被引用的块一并回收
+def remove_old_backup_dirs(dirs):
+    release_chunks(dirs)
+
+    for path in dirs:
+        try:
+            logger.info('Remove old backup: {0}'.format(path))
+            move_to_trash(path)
+            catalog_remove(path)
+        except Exception as exc:
             logger.error(exc)
             raise exc
 
+    if dirs:
+        start_purge()
+
+
+# 删除远端过期备份目录
+# 一个ssh会话完成：移入远端回收目录后在远端后台以最低IO优先级删除
+def remove_old_backup_dirs_ssh(dirs):
+    if not dirs:
+        return
+
+    remote_trash = os.path.join(REMOTE_PATH, '.trash')
+    names = ' '.join(quote(os.path.join(REMOTE_PATH, os.path.basename(path))) for path in dirs)
+    remote_command = 'mkdir -p {0} && for d in {1}; do if [ -e "$d" ]; then mv "$d" {0}/; fi; done && ' \
+                     '(nohup sh -c "(ionice -c3 true 2>/dev/null && exec ionice -c3 nice -n19 rm -rf {0}/*) || ' \
+                     'exec nice -n19 rm -rf {0}/*" >/dev/null 2>&1 &)'.format(quote(remote_trash), names)
+
+    try:
+        execute_command(ssh_command(remote_command))
+    except Exception as exc:
+        logger.error(exc)
+        raise exc
+
+
+# 删除对象存储中的过期备份
+# 每次请求最多删除1000个对象，同时放弃这些备份未完成的分片上传
+def remove_old_backup_dirs_s3(dirs):
+    if not dirs:
+        return
+
+    client = s3_client()
+    try:
+        keys = []
+        for path in dirs:
+            prefix = s3_key(path) + '/'
+            keys.extend(s3_list(client, prefix))
+            for page in client.get_paginator('list_multipart_uploads').paginate(Bucket=S3_BUCKET, Prefix=prefix):
+                for upload in page.get('Uploads', []):
+                    client.abort_multipart_upload(Bucket=S3_BUCKET, Key=upload['Key'], UploadId=upload['UploadId'])
+
+        for i in range(0, len(keys), 1000):
+            response = client.delete_objects(Bucket=S3_BUCKET, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+            if response.get('Errors'):
+                raise ProgramError('Cannot delete objects: {0}'.format(response['Errors'][:10]))
+        logger.info('Removed {0} objects of {1} old backups from s3://{2}'.format(len(keys), len(dirs), S3_BUCKET))
+    except Exception as exc:
+        logger.error(exc)
+        raise exc
+
+
+# 输出Table样式结果
+def print_table(rows):
+    widths = [len(max(columns, key=len)) for columns in zip(*rows)]
+
+    header, data = rows[0], rows[1:]
+    print(' | '.join(format(title, '%ds' % width) for width, title in zip(widths, header)))
+    print('-+-'.join('-' * width for width in widths))
+    for row in data:
+        print(' | '.join(format(cdata, '%ds' % width) for width, cdata in zip(widths, row)))
+
+
+# 查看编目库
+def show_catalog(args):
+    if args.action == 'rebuild':
+        rebuild_catalog()
+        return
+
+    if args.action == 'show':
+        if not args.backup_dir:
+            raise ProgramError('Please specify backup_dir')
+
+        backup_dir = os.path.join(TARGET_PATH, os.path.basename(args.backup_dir.rstrip(os.path.sep)))
+        rows = catalog_query('backup_dir = ?', (backup_dir,))
+        if not rows:
+            raise ProgramError('Backup not found in catalog: {0}'.format(backup_dir))
+
+        for column in CATALOG_COLUMNS:
+            print('{0:<14}: {1}'.format(column, rows[0][column]))
+
+        # 恢复该备份需要的备份链
+        chain = []
+        while rows:
+            chain.insert(0, os.path.basename(rows[0]['backup_dir']))
+            rows = catalog_query('backup_dir = ?', (rows[0]['parent'],)) if rows[0]['parent'] else []
+        print('{0:<14}: {1}'.format('chain', ' -> '.join(chain)))
+        return
+
+    where = ['1 = 1']
+    where_args = []
+    if args.type:
+        where.append('backup_type = ?')
+        where_args.append(args.type)
+    if args.status:
+        where.append('status = ?')
+        where_args.append(args.status)
+    if args.since:
+        where.append('backup_dir >= ?')
+        where_args.append(os.path.join(TARGET_PATH, args.since))
+
+    rows = [('backup_dir', 'type', 'from_lsn', 'to_lsn', 'size_mb', 'duration', 'status', 'copy_status')]
+    for row in catalog_query(' AND '.join(where), where_args, args.limit):
+        rows.append((os.path.basename(row['backup_dir']),
+                     row['backup_type'],
+                     str(row['from_lsn']),
+                     str(row['to_lsn']),
+                     '{0:.1f}'.format(row['size'] / 1024.0 / 1024.0) if row['size'] is not None else 'None',
+                     str(row['duration']),
+                     row['status'],
+                     str(row['copy_status'])))
+    print_table(rows)
+
+
+# 解析参数
+def parse_args():
+    parser = argparse.ArgumentParser(description='MySQL Backup')
+    parser.add_argument('--instance',
+                        help='instance name in instances file, override conf of the instance')
+    parser.add_argument('--instances',
+                        default=INSTANCES_FILE,
+                        help='instances file, default: {0}'.format(INSTANCES_FILE))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    full_parser = subparsers.add_parser('full',
+                                        help='full backup, synthesize from backup chain if SYNTHETIC_FULL is on')
+    incr_parser = subparsers.add_parser('incr',
+                                        help='incremental backup, take full backup if the backup chain is broken')
+    for backup_parser in (full_parser, incr_parser):
+        backup_parser.add_argument('--io-limit',
+                                   type=float,
+                                   help='xtrabackup read rate limit (MB/s), default: XTRABACKUP_THROTTLE')
+
+    schedule_parser = subparsers.add_parser('schedule', help='backup all instances in instances file')
+    schedule_parser.add_argument('backup_type',
+                                 choices=('full', 'incr'))
+    schedule_parser.add_argument('--concurrency',
+                                 type=int,
+                                 default=1,
+                                 help='instances to backup at the same time, default: 1')
+    schedule_parser.add_argument('--throttle',
+                                 type=float,
+                                 help='total xtrabackup read rate limit (MB/s), split evenly by '
+                                      'min(concurrency, instances)')
+
+    monitor_parser = subparsers.add_parser('monitor', help='latest backup information for zabbix')
+    monitor_parser.add_argument('key',
+                                nargs='?',
+                                help='monitor key, all: all keys in json')
+
+    copy_parser = subparsers.add_parser('copy', help='copy (resume) a backup to remote')
+    copy_parser.add_argument('backup_dir',
+                             nargs='?',
+                             help='backup dir to copy, default: latest backup')
+
+    restore_parser = subparsers.add_parser('restore', help='restore backup chain to a datadir')
+    restore_parser.add_argument('target',
+                                help='datadir to restore to, should be empty')
+    restore_parser.add_argument('--until',
+                                help='backup dir to restore, default: latest backup')
+    restore_parser.add_argument('--work-dir',
+                                help='dir to prepare backups, default: <target>_restore')
+    restore_parser.add_argument('--workers',
+                                type=int,
+                                help='parallel workers to extract/copy files, default: cpu count')
+    restore_parser.add_argument('--move',
+                                action='store_true',
+                                help='move prepared files into target instead of copy')
+    restore_parser.add_argument('--to-time',
+                                type=lambda v: datetime.strptime(v, '%Y-%m-%d %H:%M:%S'),
+                                help='point in time recovery, format: "YYYY-MM-DD HH:MM:SS"')
+    restore_parser.add_argument('--to-gtid',
+                                help='point in time recovery, GTID set to recover to (included)')
+    restore_parser.add_argument('--replay-only',
+                                action='store_true',
+                                help='replay binlogs into MySQL started on restored target (with --to-time/--to-gtid)')
+    restore_parser.add_argument('--socket',
+                                help='socket of MySQL started on restored target, required by --replay-only')
+
+    subparsers.add_parser('binlog', help='run binlog backup daemon')
+    synthesize_parser = subparsers.add_parser('synthesize',
+                                              help='merge latest base and incremental backups into a new base')
+    synthesize_parser.add_argument('--workers',
+                                   type=int,
+                                   help='stage threads, default: CPU count')
+
+    subparsers.add_parser('purge', help='remove expired backups in trash, started in background after full backup')
+
+    verify_parser = subparsers.add_parser('verify', help='verify local and remote copy of a backup by checksums')
+    verify_parser.add_argument('backup_dir',
+                               nargs='?',
+                               help='backup dir to verify, default: latest backup')
+    verify_parser.add_argument('--workers',
+                               type=int,
+                               help='verify processes, default: CPU count')
+    verify_parser.add_argument('--deep',
+                               action='store_true',
+                               help='stream mode: also decompress archive and verify files in it')
+
+    catalog_parser = subparsers.add_parser('catalog', help='list or query backup catalog')
+    catalog_parser.add_argument('action',
+                                nargs='?',
+                                default='list',
+                                choices=('list', 'show', 'rebuild'),
+                                help='default: list')
+    catalog_parser.add_argument('backup_dir',
+                                nargs='?',
+                                help='backup dir to show')
+    catalog_parser.add_argument('--type',
+                                choices=('base', 'incr'),
+                                help='list backups of this type')
+    catalog_parser.add_argument('--status',
+                                choices=('running', 'success', 'error'),
+                                help='list backups of this status')
+    catalog_parser.add_argument('--since',
+                                help='list backups since, format: YYYYMMDD[_HHMMSS]')
+    catalog_parser.add_argument('--limit',
+                                type=int,
+                                help='list latest N backups')
+
+    return parser.parse_args()
+
 
 # 入口
 def main():
+    global XTRABACKUP_THROTTLE
+
+    args = parse_args()
+
+    if args.instance:
+        instance = [i for i in load_instances(args.instances) if i['name'] == args.instance]
+        if not instance:
+            raise ProgramError('Cannot find instance {0} in {1}'.format(args.instance, args.instances))
+        apply_conf(instance[0])
+        _instance_args[:] = ['--instances', os.path.abspath(args.instances), '--instance', args.instance]
+
+    # monitor由zabbix频繁调用，只读取状态文件，不检查配置及扫描备份目录
+    if args.command == 'monitor':
+        print(monitor(args.key) if args.key else 0)
+        return
+
+    # 调度进程不执行备份，各实例的配置由子进程检查
+    if args.command == 'schedule':
+        if args.concurrency < 1:
+            raise ProgramError('Wrong concurrency: {0}'.format(args.concurrency))
+        schedule(args.instances, args.backup_type, args.concurrency, args.throttle)
+        return
+
     check_conf()
 
+    if args.command == 'catalog':
+        show_catalog(args)
+        return
+
+    if args.command == 'purge':
+        setup_log()
+        purge_trash()
+        return
+
+    # 备份/复制/合成时对实例及备份目录加锁，避免重叠执行的任务争用磁盘
+    if args.command in ('full', 'incr', 'synthesize', 'copy'):
+        acquire_lock(instance_lock_file())
+        acquire_lock(target_lock_file)
+        if getattr(args, 'io_limit', None) is not None:
+            XTRABACKUP_THROTTLE = args.io_limit
+
     cur_dir, cur_base_dir, cur_incr_dir = get_last_backup_dirs()
 
-    arg = sys.argv[1].lower()
+    if args.command == 'copy':
+        # 重新复制（续传）指定备份目录，默认最新备份
+        setup_log()
+        backup_dir = os.path.join(TARGET_PATH, os.path.basename(args.backup_dir.rstrip(os.path.sep))) \
+            if args.backup_dir else cur_dir
+        copy_backup(backup_dir)
+        if STORAGE_BACKEND == 'dedup':
+            ingest_backup(backup_dir, get_tuning()['cpus'])
+    elif args.command == 'binlog':
+        setup_log()
+        binlog_daemon()
+    elif args.command == 'verify':
+        setup_log()
+        backup_dir = os.path.join(TARGET_PATH, os.path.basename(args.backup_dir.rstrip(os.path.sep))) \
+            if args.backup_dir else cur_dir
+        verify(backup_dir, args.workers or get_tuning()['cpus'], args.deep)
+    elif args.command == 'restore':
+        setup_log()
+        workers = args.workers or get_tuning()['cpus']
+        pitr = args.to_time or args.to_gtid
 
-    if arg == 'monitor':
-        if len(sys.argv) < 3:
-            print(0)
-            sys.exit(0)
+        if args.replay_only:
+            # 基于时间点恢复第二步：数据目录已恢复且MySQL已启动，应用binlog
+            if not pitr or not args.socket:
+                raise ProgramError('--replay-only requires --to-time/--to-gtid and --socket')
+            replay_binlogs(os.path.abspath(args.target), args.socket, workers, args.to_time, args.to_gtid)
+            return
 
-        monitor_key = sys.argv[2]
+        if pitr:
+            until_dir = select_pitr_backup(args.to_time, args.to_gtid)
+        elif args.until:
+            until_dir = os.path.join(TARGET_PATH, os.path.basename(args.until.rstrip(os.path.sep)))
+        else:
+            until_dir = cur_dir
+        restore(args.target, until_dir, args.work_dir, workers, args.move)
 
-        print(monitor(cur_dir, monitor_key))
+        if pitr:
+            logger.info('Start MySQL on {0} (skip-slave-start), then replay binlogs using: {1} restore {0} '
+                        '--replay-only {2} --socket <socket>'.format(
+                            os.path.abspath(args.target), ' '.join([os.path.abspath(__file__)] + _instance_args),
+                            '--to-time "{0}"'.format(args.to_time) if args.to_time else
+                            '--to-gtid {0}'.format(args.to_gtid)))
     else:
         setup_log()  # 备份时才将日志写入文件
 
-        incremental = (arg == 'incr')
-
-        if incremental and (not check_backup_chain(cur_base_dir, cur_incr_dir)):
-            logger.warning('Request a incremental backup, but there is no base full backup or the backup chain is '
-                           'broken. Take full backup instead')
-            incremental = False
+        incremental = (args.command == 'incr') and decide_incremental(cur_dir, cur_base_dir, cur_incr_dir)
 
-        backup_dir = generate_backup_dir(incremental)
+        synthetic = args.command == 'synthesize' or (not incremental and SYNTHETIC_FULL == 'on')
+        if synthetic and not (cur_incr_dir and cur_base_dir and cur_incr_dir > cur_base_dir and
+                              check_backup_chain(cur_base_dir, cur_incr_dir)):
+            if args.command == 'synthesize':
+                logger.warning('No incremental backups after the latest base backup, nothing to synthesize')
+                return
+            logger.warning('Cannot synthesize full backup from the backup chain. Take full backup instead')
+            synthetic = False
 
-        if incremental:
-            backup(backup_dir, cur_dir)
+        pipeline = None
+        if synthetic:
+            backup_dir = synthesize(cur_dir, getattr(args, 'workers', None) or get_tuning()['cpus'])
         else:
-            backup(backup_dir)
+            backup_dir = generate_backup_dir(incremental)
+            if COPY_TO_REMOTE.lower() == 'scp' and COPY_PIPELINE == 'on' and BACKUP_MODE == 'dir':
+                pipeline = CopyPipeline(backup_dir)
+
+            if incremental:
+                backup(backup_dir, cur_dir, pipeline)
+            else:
+                backup(backup_dir, pipeline=pipeline)
+
+        if COPY_TO_REMOTE.lower() != 'off':
+            copy_backup(backup_dir, pipeline)
 
-        if COPY_TO_REMOTE.lower() == 'scp':
-            scp(backup_dir)
+        # 复制至远端后再导入块存储，远端保存完整的备份文件
+        if STORAGE_BACKEND == 'dedup':
+            ingest_backup(backup_dir, get_tuning()['cpus'])
 
         # 全备完成后删除过期备份
         if not incremental:
-            remove_old_backup_dirs()
+            old_dirs = get_old_backup_dirs()
+            remove_old_backup_dirs(old_dirs)
             if COPY_TO_REMOTE.lower() == 'scp':
-                remove_old_backup_dirs_ssh()
+                remove_old_backup_dirs_ssh(old_dirs)
+            elif COPY_TO_REMOTE.lower() == 's3':
+                remove_old_backup_dirs_s3(old_dirs)
+            if old_dirs:
+                remove_old_binlogs()
 
 
 if __name__ == '__main__':
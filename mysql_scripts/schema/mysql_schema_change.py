@@ -7,6 +7,10 @@ import getpass
 import re
 import logging
 import subprocess
+import io
+import time
+import copy
+import threading
 from distutils import spawn
 from datetime import datetime
 
@@ -21,6 +25,28 @@ import MySQLdb
 #   4. MySQL表结构修改成本很高，对一个表的多处修改应尽量整合为一条SQL
 #   5. 序号为0的脚本作为基线，不执行
 #   6. 不检查变更脚本的内容，其正确性&危险性由变更脚本的开发人员负责（使用适当授权的用户可以降低风险）
+#   7. 默认（--executor native）在已建立的连接中执行变更脚本：按DELIMITER拆分语句（跳过注释，保留/*! */，
+#      正确处理引号内的分隔符），以autocommit方式逐条执行并输出每条语句的进度；--executor mysql时使用mysql客户端执行
+#   8. --targets指定目标列表文件时（每行一个目标：host[:port]/database，#开头为注释），将变更依次应用至各目标
+#      （指定端口的目标通过TCP连接，localhost连接127.0.0.1，以区分同一主机上的多个实例；未指定端口时使用--port/--socket），
+#      由--workers个线程并发执行，同一主机同时最多--per-host个；每个目标使用各自的变更记录表，
+#      一个目标失败不影响其他目标，结束时输出每个目标的状态、执行的变更及耗时
+#   9. --online时（仅native），有主键的表上的ALTER TABLE以影子表方式执行：建立按变更修改的_<table>_new表及同步触发器，
+#      按主键分块INSERT ... SELECT复制数据，每块耗时目标为--chunk-time秒，Threads_running或从库延迟（--replicas上
+#      oputil.heartbeat的ts，pt-heartbeat写入）超过阈值的一半时分块减半，超过阈值时暂停复制；复制完成后RENAME TABLE原子替换，
+#      删除触发器及原表。进度/预计剩余时间/暂停输出至日志，变更记录表有progress列时同时写入该列。
+#      包含RENAME/分区/外键/主键/唯一键修改（INSERT IGNORE会丢弃重复行）或ALGORITHM=INSTANT的ALTER，以及无主键、
+#      有外键或被其他表的外键引用（CREATE TABLE LIKE不复制外键，RENAME后子表外键指向原表）、已有触发器的表直接执行；
+#      复制时除主键重复外的警告（如缩短列长度导致的截断）视为错误，删除影子表后退出
+#  10. native时连续的只修改同一个表的ALTER TABLE变更脚本合并为一条ALTER TABLE执行（减少表重建次数），
+#      合并的每个变更仍分别记录；后面的变更修改前面变更已修改过的列/索引/约束，或包含未命名的索引/约束、
+#      外键、ALGORITHM/LOCK/分区/表改名等时不合并。
+#      --plan输出执行计划（合并的语句及减少的重建次数）后退出，--no-coalesce时逐个执行变更脚本
+#  11. --dry-run按执行计划估算各变更的耗时及锁影响后退出：从information_schema.TABLES读取涉及的表的大小，
+#      在_<table>_probe表（CREATE TABLE LIKE，以READ COMMITTED复制--sample-rows行样本，不写binlog）上依次尝试ALGORITHM=INSTANT、
+#      INPLACE(LOCK=NONE)、INPLACE(LOCK=SHARED)、COPY，以第一个成功的方式及其在样本上的耗时按行数估算全表耗时，
+#      按估算耗时从长到短输出（--online时可影子表执行的ALTER按COPY估算，不含暂停时间）。
+#      需要关闭binlog的权限（sql_log_bin），探测表已存在时不执行
 
 # 定义常量
 CREATE = '''CREATE TABLE {database}.{table} (
@@ -29,6 +55,7 @@ CREATE = '''CREATE TABLE {database}.{table} (
   apply_at datetime NOT NULL,
   complete_at datetime NULL,
   success char(1) NOT NULL,
+  progress varchar(255) NULL,
   PRIMARY KEY (change_id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8'''
 
@@ -36,8 +63,81 @@ INSERT = "INSERT INTO {database}.{table} (change_id, description, apply_at, succ
 
 UPDATE = 'UPDATE {database}.{table} SET complete_at = %s, success = %s WHERE change_id = %s'
 
+UPDATE_PROGRESS = 'UPDATE {database}.{table} SET progress = %s WHERE change_id = %s'
+
 NAME_PATTERN = re.compile('^(\d+)[_\-][0-9a-zA-Z_]*\.sql$')
 
+# mysql客户端的DELIMITER命令（行首，不区分大小写）
+DELIMITER_PATTERN = re.compile(r'[ \t]*delimiter[ \t]+(\S+)[^\n]*', re.IGNORECASE)
+
+# 目标格式：host[:port]/database
+TARGET_PATTERN = re.compile(r'^([^:/\s]+)(?::(\d+))?/(\w+)$')
+
+# 日志中显示的语句长度
+STATEMENT_PREVIEW = 80
+
+# 表名：[database.]table
+TABLE_NAME = r'(?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?'
+
+# ALTER TABLE语句：(表名, 修改内容)
+ALTER_PATTERN = re.compile(r'^ALTER\s+TABLE\s+({0})\s+(.+)$'.format(TABLE_NAME), re.IGNORECASE | re.DOTALL)
+
+# CREATE INDEX语句：(索引类型, 索引名, 表名, 索引定义)
+CREATE_INDEX_PATTERN = re.compile(r'^CREATE\s+(?:(UNIQUE|FULLTEXT|SPATIAL)\s+)?INDEX\s+(`[^`]+`|\w+)\s+'
+                                  r'(?:USING\s+\w+\s+)?ON\s+({0})\s*(\(.+)$'.format(TABLE_NAME),
+                                  re.IGNORECASE | re.DOTALL)
+
+# DROP INDEX语句：(索引名, 表名)
+DROP_INDEX_PATTERN = re.compile(r'^DROP\s+INDEX\s+(`[^`]+`|\w+)\s+ON\s+({0})'.format(TABLE_NAME), re.IGNORECASE)
+
+# 其他涉及表的语句：(语句类型, 表名)
+TABLE_STATEMENT_PATTERN = re.compile(r'^(CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|'
+                                     r'TRUNCATE(?:\s+TABLE)?|RENAME\s+TABLE|OPTIMIZE\s+TABLE|UPDATE(?:\s+IGNORE)?|'
+                                     r'DELETE(?:\s+IGNORE)?\s+FROM|(?:INSERT|REPLACE)(?:\s+IGNORE)?\s+INTO)\s+'
+                                     r'({0})'.format(TABLE_NAME), re.IGNORECASE)
+
+# 不能以影子表方式执行的修改
+ONLINE_UNSAFE_PATTERN = re.compile(r'\bRENAME\s+(?!COLUMN\b|INDEX\b|KEY\b)|\bPARTITION|\bFOREIGN\s+KEY\b|'
+                                   r'\bPRIMARY\s+KEY\b|\bUNIQUE\b|\bTABLESPACE\b|\bALGORITHM\s*=\s*INSTANT\b',
+                                   re.IGNORECASE)
+
+# 列改名：CHANGE [COLUMN] old new ... / RENAME COLUMN old TO new
+CHANGE_COLUMN_PATTERN = re.compile(r'\bCHANGE\s+(?:COLUMN\s+)?`?(\w+)`?\s+`?(\w+)`?', re.IGNORECASE)
+RENAME_COLUMN_PATTERN = re.compile(r'\bRENAME\s+COLUMN\s+`?(\w+)`?\s+TO\s+`?(\w+)`?', re.IGNORECASE)
+
+# ALTER TABLE中不能与其他变更合并的修改
+UNMERGEABLE_ACTIONS = ('ALGORITHM', 'LOCK', 'ORDER', 'DISCARD', 'IMPORT', 'PARTITION', 'REMOVE', 'COALESCE',
+                       'REORGANIZE', 'EXCHANGE', 'ANALYZE', 'CHECK', 'OPTIMIZE', 'REBUILD', 'REPAIR', 'TRUNCATE',
+                       'UPGRADE')
+
+# 分块大小范围（行）
+CHUNK_SIZE_MIN = 100
+CHUNK_SIZE_MAX = 100000
+
+# 暂停时检查负载的间隔（秒）
+THROTTLE_CHECK_INTERVAL = 1
+
+# 输出复制进度的间隔（秒）
+PROGRESS_INTERVAL = 30
+
+# 建立触发器/RENAME TABLE等待元数据锁的时间（秒）
+ONLINE_LOCK_WAIT_TIMEOUT = 10
+
+# --dry-run不在探测表上执行的修改（表改名/分区）
+PROBE_UNSAFE_PATTERN = re.compile(r'\bRENAME\s+(?!COLUMN\b|INDEX\b|KEY\b)|\bPARTITION', re.IGNORECASE)
+
+# --dry-run依次尝试的执行方式：(ALGORITHM, LOCK)
+PROBE_ALGORITHMS = [('INSTANT', None), ('INPLACE', 'NONE'), ('INPLACE', 'SHARED'), ('COPY', 'SHARED')]
+
+# 执行方式对应的锁影响
+LOCK_IMPACT = {
+    'INSTANT': 'metadata lock only',
+    'NONE': 'concurrent DML',
+    'SHARED': 'writes blocked',
+    'EXCLUSIVE': 'reads/writes blocked',
+    'ONLINE': 'concurrent DML (shadow copy)'
+}
+
 LOGGER = logging.getLogger('apply_schema_change')
 
 
@@ -59,6 +159,24 @@ class ApplyError(Exception):
         super(ApplyError, self).__init__(msg)
 
 
+class FleetError(Exception):
+    def __init__(self, failed, total):
+        msg = '{0} of {1} targets failed, see the summary above'.format(failed, total)
+        super(FleetError, self).__init__(msg)
+
+
+class OnlineError(Exception):
+    def __init__(self, table, message):
+        msg = 'online alter of {0} failed: {1}'.format(table, message)
+        super(OnlineError, self).__init__(msg)
+
+
+class DryRunError(Exception):
+    def __init__(self, message):
+        msg = 'dry run aborted: {0}'.format(message)
+        super(DryRunError, self).__init__(msg)
+
+
 class StateError(Exception):
     def __init__(self, change_id, description):
         msg = 'change #{0}: {1} previously failed, please fix it manually (undo this change --> ' \
@@ -101,22 +219,116 @@ def parse_args():
                         help='change log table name, default: {0}'.format(default_table))
 
     default_last = None
+    default_charset = 'utf8mb4'
+    parser.add_argument('--charset',
+                        default=default_charset,
+                        help='connection character set, default: {0}'.format(default_charset))
+
+    default_executor = 'native'
+    parser.add_argument('--executor',
+                        choices=['native', 'mysql'],
+                        default=default_executor,
+                        help='run scripts over the existing connection (native) or with mysql client (mysql), '
+                             'default: {0}'.format(default_executor))
+
     parser.add_argument('--last',
                         type=int,
                         default=default_last,
                         help='last change id to apply (included), default: None (all changes)')
 
+    parser.add_argument('--online',
+                        action='store_true',
+                        help='run ALTER TABLE as a throttled shadow table copy (native executor only)')
+
+    default_chunk_size = 1000
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=default_chunk_size,
+                        help='initial rows per chunk of online copy, default: {0}'.format(default_chunk_size))
+
+    default_chunk_time = 0.5
+    parser.add_argument('--chunk-time',
+                        type=float,
+                        default=default_chunk_time,
+                        help='target seconds per chunk of online copy, default: {0}'.format(default_chunk_time))
+
+    default_max_threads_running = 25
+    parser.add_argument('--max-threads-running',
+                        type=int,
+                        default=default_max_threads_running,
+                        help='pause online copy when Threads_running exceeds it, default: {0}'.format(
+                            default_max_threads_running))
+
+    default_max_lag = 1.0
+    parser.add_argument('--max-lag',
+                        type=float,
+                        default=default_max_lag,
+                        help='pause online copy when replica lag (seconds) exceeds it, default: {0}'.format(
+                            default_max_lag))
+
+    parser.add_argument('--replicas',
+                        default='',
+                        help='comma separated host[:port] of replicas to check lag on, default: no')
+
+    default_heartbeat = 'oputil.heartbeat'
+    parser.add_argument('--heartbeat',
+                        default=default_heartbeat,
+                        help='pt-heartbeat table on replicas, default: {0}'.format(default_heartbeat))
+
+    parser.add_argument('--no-coalesce',
+                        action='store_true',
+                        help="don't merge ALTER TABLE on the same table across consecutive changes")
+
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='print the execution plan of pending changes (merged ALTERs) and exit')
+
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='estimate run time and lock impact of pending changes by probing ALGORITHM, and exit')
+
+    default_sample_rows = 100000
+    parser.add_argument('--sample-rows',
+                        type=int,
+                        default=default_sample_rows,
+                        help='rows copied to probe tables to measure rebuild speed in --dry-run, default: {0}'.format(
+                            default_sample_rows))
+
+    parser.add_argument('--targets',
+                        help='file listing targets (host[:port]/database per line) to apply changes to, '
+                             'instead of a single database; a target with explicit port is connected via TCP '
+                             '(localhost as 127.0.0.1), otherwise --port/--socket are used')
+
+    default_workers = 8
+    parser.add_argument('--workers',
+                        type=int,
+                        default=default_workers,
+                        help='targets applied concurrently, default: {0}'.format(default_workers))
+
+    default_per_host = 2
+    parser.add_argument('--per-host',
+                        type=int,
+                        default=default_per_host,
+                        help='targets applied concurrently on one host, default: {0}'.format(default_per_host))
+
     parser.add_argument('--debug',
                         action='store_true',
                         help='enable debug')
 
     parser.add_argument('database',
-                        help='database name to apply changes')
+                        nargs='?',
+                        help='database name to apply changes (omitted with --targets)')
     parser.add_argument('directory',
                         help='directory holding change scripts (absolute path)')
 
     args = parser.parse_args()
 
+    if bool(args.database) == bool(args.targets):
+        raise ValueError('either database or --targets should be specified')
+    if args.workers < 1 or args.per_host < 1:
+        raise ValueError('--workers and --per-host should be positive')
+    if args.online and args.executor != 'native':
+        raise ValueError('--online requires --executor native')
     if not os.path.isabs(args.directory):
         raise ValueError('directory should be absolute path')
     if not os.path.exists(args.directory):
@@ -135,9 +347,12 @@ def parse_args():
 def connect(args):
     if args.host == 'localhost' and args.socket:
         conn = MySQLdb.connect(host=args.host, unix_socket=args.socket, user=args.user, passwd=args.password,
-                               db=args.database)
+                               db=args.database, charset=args.charset)
     else:
-        conn = MySQLdb.connect(host=args.host, port=args.port, user=args.user, passwd=args.password, db=args.database)
+        # libmysqlclient对localhost总是使用socket，忽略端口，需改用127.0.0.1
+        host = '127.0.0.1' if args.host == 'localhost' else args.host
+        conn = MySQLdb.connect(host=host, port=args.port, user=args.user, passwd=args.password, db=args.database,
+                               charset=args.charset)
 
     LOGGER.debug('database connection created')
     return conn
@@ -199,14 +414,15 @@ def binary_path(name):
         return path
 
 
-# 执行变更脚本
-def apply_change(args, mysql_client, file_path):
+# 使用mysql客户端执行变更脚本
+def apply_change_client(args, mysql_client, file_path):
     command = [
         mysql_client,
         '--host={0}'.format(args.host),
         '--user={0}'.format(args.user),
         '--password={0}'.format(args.password),
-        '--database={0}'.format(args.database)
+        '--database={0}'.format(args.database),
+        '--default-character-set={0}'.format(args.charset)
     ]
 
     if args.host == 'localhost' and args.socket:
@@ -224,7 +440,8 @@ def apply_change(args, mysql_client, file_path):
 
     LOGGER.debug('command: {0} {1}'.format(' '.join([c for c in command if '--password' not in c]), execute))
 
-    child = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    child = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
     stdout, stderr = child.communicate(execute)
 
     LOGGER.debug('stdout: {0}'.format(stdout))
@@ -234,6 +451,884 @@ def apply_change(args, mysql_client, file_path):
         raise ApplyError(file_path, stderr if stderr else stdout)
 
 
+# 按mysql客户端的规则将脚本拆分为语句
+# 返回：[(起始行号, 语句)]
+def split_statements(text):
+    statements = []
+    delimiter = ';'
+    buf = []
+    start = None  # 当前语句起始位置
+    quote = None  # 当前所在的引号
+    line, line_pos = 1, 0  # 已计算行号的位置
+    i, n = 0, len(text)
+
+    def emit():
+        sql = ''.join(buf).strip()
+        if sql:
+            statements.append((line + text.count('\n', line_pos, start), sql))
+        del buf[:]
+
+    while i < n:
+        c = text[i]
+
+        if quote:
+            buf.append(c)
+            if c == '\\' and quote != '`' and i + 1 < n:
+                buf.append(text[i + 1])
+                i += 2
+                continue
+            if c == quote:
+                if text[i + 1:i + 2] == quote:  # 连续两个引号表示引号本身
+                    buf.append(text[i + 1])
+                    i += 2
+                    continue
+                quote = None
+            i += 1
+            continue
+
+        # DELIMITER命令只在语句之外的行首识别（语句内以delimiter开头的行，如同名列定义，属于语句本身）
+        if start is None and (i == 0 or text[i - 1] == '\n'):
+            match = DELIMITER_PATTERN.match(text, i)
+            if match:
+                if buf and not ''.join(buf).strip():
+                    del buf[:]
+                delimiter = match.group(1)
+                i = match.end()
+                continue
+
+        if text.startswith(delimiter, i):
+            if start is not None:
+                emit()
+                line += text.count('\n', line_pos, start)
+                line_pos = start
+            start = None
+            i += len(delimiter)
+            continue
+
+        if c in ('\'', '"', '`'):
+            quote = c
+        elif c == '#' or (text.startswith('--', i) and (i + 2 == n or text[i + 2].isspace())):
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+            continue
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            if text.startswith('/*!', i) or text.startswith('/*+', i):  # 可执行注释及优化器提示保留
+                if start is None:
+                    start = i
+                buf.append(text[i:end])
+            else:
+                buf.append(' ')
+            i = end
+            continue
+
+        if start is None and not c.isspace():
+            start = i
+        buf.append(c)
+        i += 1
+
+    if start is not None:
+        emit()
+
+    return statements
+
+
+def quote_name(name):
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
+# 拆分[database.]table，指定default_database时补全数据库名
+def split_table_name(text, default_database=None):
+    names = [n.strip().strip('`') for n in re.findall(r'`[^`]+`|[^.`]+', text)]
+    if len(names) == 1 and default_database:
+        names.insert(0, default_database)
+    return names
+
+
+# 以影子表方式执行ALTER TABLE：
+# 建立影子表及触发器 --> 按主键分块复制（根据耗时及负载调整分块大小，负载过高时暂停） --> RENAME TABLE替换 --> 删除原表
+class OnlineAlter(object):
+    def __init__(self, conn, args, change_id, schema, table, clauses):
+        self.conn = conn
+        self.args = args
+        self.change_id = change_id
+        self.schema = schema
+        self.table = table
+        self.clauses = clauses
+        self.name = '{0}.{1}'.format(schema, table)
+
+        self.new_table = '_{0}_new'.format(table)
+        self.old_table = '_{0}_old'.format(table)
+        self.triggers = ['_{0}_{1}'.format(table, action) for action in ('ins', 'upd', 'del')]
+
+        self.replicas = []  # [(host:port, 连接)]
+        self.master_id = None
+        self.chunk_size = args.chunk_size
+        self.copied = 0
+        self.paused = 0.0  # 累计暂停秒数
+
+    def query(self, sql, sql_args=None):
+        LOGGER.debug('online: {0} {1}'.format(sql, sql_args if sql_args else ''))
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql, sql_args)
+            return cur.fetchall(), cur.rowcount
+        finally:
+            cur.close()
+
+    def full_name(self, table):
+        return '{0}.{1}'.format(quote_name(self.schema), quote_name(table))
+
+    def columns(self, table):
+        rows, _ = self.query('SELECT COLUMN_NAME, EXTRA FROM information_schema.COLUMNS '
+                             'WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION',
+                             (self.schema, table))
+        return [r[0] for r in rows if 'GENERATED' not in r[1].upper()]
+
+    def primary_key(self, table):
+        rows, _ = self.query("SELECT COLUMN_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s "
+                             "AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY' ORDER BY SEQ_IN_INDEX",
+                             (self.schema, table))
+        return [r[0] for r in rows]
+
+    # 不能以影子表方式执行时返回原因
+    def unsupported(self):
+        if ONLINE_UNSAFE_PATTERN.search(self.clauses):
+            return 'unsupported clause'
+        if not self.primary_key(self.table):
+            return 'no primary key'
+        rows, _ = self.query('SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s '
+                             'AND TABLE_NAME IN (%s, %s)', (self.schema, self.new_table, self.old_table))
+        if rows:
+            return '{0} exists, remove it after checking no online alter is running'.format(rows[0][0])
+        rows, _ = self.query('SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS '
+                             'WHERE (CONSTRAINT_SCHEMA = %s AND TABLE_NAME = %s) '
+                             'OR (UNIQUE_CONSTRAINT_SCHEMA = %s AND REFERENCED_TABLE_NAME = %s) LIMIT 1',
+                             (self.schema, self.table, self.schema, self.table))
+        if rows:
+            return 'foreign key {0} on or referencing the table'.format(rows[0][0])
+        rows, _ = self.query('SELECT TRIGGER_NAME FROM information_schema.TRIGGERS '
+                             'WHERE EVENT_OBJECT_SCHEMA = %s AND EVENT_OBJECT_TABLE = %s LIMIT 1',
+                             (self.schema, self.table))
+        if rows:
+            return 'table has trigger {0}'.format(rows[0][0])
+        return None
+
+    # 建立从库连接，读取各从库延迟时使用主库的server_id
+    def connect_replicas(self):
+        self.master_id = self.query('SELECT @@server_id')[0][0][0]
+        for replica in [r.strip() for r in self.args.replicas.split(',') if r.strip()]:
+            host, _, port = replica.partition(':')
+            conn = MySQLdb.connect(host=host, port=int(port) if port else self.args.port, user=self.args.user,
+                                   passwd=self.args.password, connect_timeout=10)
+            conn.autocommit(True)
+            self.replicas.append((replica, conn))
+            if self.replica_lag(conn) is None:
+                raise OnlineError(self.name, 'no heartbeat of server_id {0} in {1} on {2}'.format(
+                    self.master_id, self.args.heartbeat, replica))
+
+    def close_replicas(self):
+        for _, conn in self.replicas:
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        self.replicas = []
+
+    def replica_lag(self, conn):
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT TIMESTAMPDIFF(MICROSECOND, REPLACE(ts, 'T', ' '), NOW(6)) / 1000000 "
+                        "FROM {0} WHERE server_id = %s".format(self.args.heartbeat), (self.master_id,))
+            row = cur.fetchone()
+            return float(row[0]) if row and row[0] is not None else None
+        finally:
+            cur.close()
+
+    # 当前负载：(Threads_running, 最大从库延迟, 最大延迟的从库)
+    def load(self):
+        rows, _ = self.query("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+        threads_running = int(rows[0][1])
+
+        lag, lag_replica = 0.0, None
+        for replica, conn in self.replicas:
+            replica_lag = self.replica_lag(conn)
+            if replica_lag is None:
+                replica_lag = float('inf')  # heartbeat记录消失时按延迟处理
+            if replica_lag > lag:
+                lag, lag_replica = replica_lag, replica
+
+        return threads_running, lag, lag_replica
+
+    def overloaded(self, threads_running, lag):
+        return threads_running > self.args.max_threads_running or lag > self.args.max_lag
+
+    # 负载超过阈值时暂停，直到负载恢复
+    def throttle(self):
+        threads_running, lag, lag_replica = self.load()
+        if not self.overloaded(threads_running, lag):
+            return threads_running, lag
+
+        start = time.time()
+        message = 'paused: Threads_running {0}, lag {1:.1f}s{2}'.format(
+            threads_running, lag, ' ({0})'.format(lag_replica) if lag_replica else '')
+        LOGGER.warning('{0} {1}'.format(self.name, message))
+        self.record_progress(message)
+
+        while self.overloaded(threads_running, lag):
+            time.sleep(THROTTLE_CHECK_INTERVAL)
+            threads_running, lag, lag_replica = self.load()
+
+        self.paused += time.time() - start
+        LOGGER.info('{0} resumed after {1:.1f}s'.format(self.name, time.time() - start))
+        return threads_running, lag
+
+    # 根据上一块的耗时及负载调整分块大小
+    def adapt_chunk_size(self, elapsed, threads_running, lag):
+        size = int(self.chunk_size * self.args.chunk_time / max(elapsed, 0.001))
+        size = min(size, self.chunk_size * 2)  # 避免突增
+        if threads_running * 2 > self.args.max_threads_running or lag * 2 > self.args.max_lag:
+            size = min(size, self.chunk_size // 2)
+        self.chunk_size = max(CHUNK_SIZE_MIN, min(size, CHUNK_SIZE_MAX))
+
+    def record_progress(self, message):
+        if self.change_id is not None:
+            record_progress(self.conn, self.args, self.change_id, '{0} {1}'.format(self.name, message))
+
+    def create_shadow(self, columns, pk):
+        self.query('CREATE TABLE {0} LIKE {1}'.format(self.full_name(self.new_table), self.full_name(self.table)))
+        self.query('ALTER TABLE {0} {1}'.format(self.full_name(self.new_table), self.clauses))
+
+        # 旧列名 -> 新列名
+        renames = dict((old.lower(), new) for old, new in
+                       CHANGE_COLUMN_PATTERN.findall(self.clauses) + RENAME_COLUMN_PATTERN.findall(self.clauses))
+        new_columns = dict((c.lower(), c) for c in self.columns(self.new_table))
+        mapping = []  # [(旧列, 新列)]
+        for column in columns:
+            new_column = new_columns.get(renames.get(column.lower(), column).lower())
+            if new_column:
+                mapping.append((column, new_column))
+
+        new_pk = [renames.get(c.lower(), c).lower() for c in pk]
+        if new_pk != [c.lower() for c in self.primary_key(self.new_table)]:
+            raise OnlineError(self.name, 'primary key changed')
+        return mapping
+
+    def create_triggers(self, mapping, pk):
+        new_table = self.full_name(self.new_table)
+        old_names = ', '.join(quote_name(o) for o, _ in mapping)
+        new_names = ', '.join(quote_name(n) for _, n in mapping)
+        new_values = ', '.join('NEW.{0}'.format(quote_name(o)) for o, _ in mapping)
+        renames = dict(mapping)
+        where = ' AND '.join('{0} = OLD.{1}'.format(quote_name(renames[c]), quote_name(c)) for c in pk)
+
+        replace = 'REPLACE INTO {0} ({1}) VALUES ({2})'.format(new_table, new_names, new_values)
+        delete = 'DELETE IGNORE FROM {0} WHERE {1}'.format(new_table, where)
+        bodies = [replace, 'BEGIN {0}; {1}; END'.format(delete, replace), delete]
+
+        self.query('SET SESSION lock_wait_timeout = %s', (ONLINE_LOCK_WAIT_TIMEOUT,))
+        for trigger, event, body in zip(self.triggers, ('INSERT', 'UPDATE', 'DELETE'), bodies):
+            self.query('CREATE TRIGGER {0} AFTER {1} ON {2} FOR EACH ROW {3}'.format(
+                self.full_name(trigger), event, self.full_name(self.table), body))
+
+        LOGGER.debug('{0} copy columns: {1} -> {2}'.format(self.name, old_names, new_names))
+
+    def drop_triggers(self):
+        for trigger in self.triggers:
+            self.query('DROP TRIGGER IF EXISTS {0}'.format(self.full_name(trigger)))
+
+    # INSERT IGNORE将截断/转换错误降为警告，除主键重复(1062)外均视为错误，避免缩短列等修改静默损坏数据
+    def check_warnings(self):
+        rows, _ = self.query('SHOW WARNINGS')
+        for level, code, message in rows:
+            if int(code) != 1062:
+                raise OnlineError(self.name, 'copy {0} {1}: {2}'.format(level, code, message))
+
+    # 按主键分块复制数据
+    def copy_rows(self, mapping, pk):
+        rows, _ = self.query('SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s '
+                             'AND TABLE_NAME = %s', (self.schema, self.table))
+        estimated = max(int(rows[0][0] or 0), 1)
+
+        pk_names = ', '.join(quote_name(c) for c in pk)
+        pk_tuple = '({0})'.format(pk_names)
+        params = '({0})'.format(', '.join(['%s'] * len(pk)))
+        boundary_sql = 'SELECT {0} FROM {1} FORCE INDEX (PRIMARY) {{0}} ORDER BY {0} LIMIT %s, 1'.format(
+            pk_names, self.full_name(self.table))
+        copy_sql = 'INSERT LOW_PRIORITY IGNORE INTO {0} ({1}) SELECT {2} FROM {3} FORCE INDEX (PRIMARY) {{0}} ' \
+                   'LOCK IN SHARE MODE'.format(self.full_name(self.new_table),
+                                               ', '.join(quote_name(n) for _, n in mapping),
+                                               ', '.join(quote_name(o) for o, _ in mapping),
+                                               self.full_name(self.table))
+
+        start = last_progress = time.time()
+        lower = None  # 上一块的最大主键
+        while True:
+            threads_running, lag = self.throttle()
+
+            lower_sql = 'WHERE {0} > {1}'.format(pk_tuple, params) if lower else ''
+            lower_args = tuple(lower) if lower else ()
+            rows, _ = self.query(boundary_sql.format(lower_sql), lower_args + (self.chunk_size - 1,))
+            upper = rows[0] if rows else None
+
+            conditions = ['{0} > {1}'.format(pk_tuple, params)] if lower else []
+            if upper:
+                conditions.append('{0} <= {1}'.format(pk_tuple, params))
+            where = 'WHERE {0}'.format(' AND '.join(conditions)) if conditions else ''
+
+            chunk_start = time.time()
+            _, count = self.query(copy_sql.format(where), lower_args + (tuple(upper) if upper else ()))
+            self.check_warnings()
+            elapsed = time.time() - chunk_start
+            self.copied += max(count, 0)
+
+            if not upper:
+                break
+
+            lower = upper
+            self.adapt_chunk_size(elapsed, threads_running, lag)
+
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.time()
+                rate = self.copied / max(time.time() - start - self.paused, 0.001)
+                message = 'copied {0}/~{1} rows ({2:.1f}%), {3:.0f} rows/s, chunk {4}, paused {5:.0f}s, ' \
+                          'eta {6:.0f}s'.format(self.copied, estimated, min(self.copied * 100.0 / estimated, 99.9),
+                                                rate, self.chunk_size, self.paused,
+                                                max(estimated - self.copied, 0) / max(rate, 1))
+                LOGGER.info('{0} {1}'.format(self.name, message))
+                self.record_progress(message)
+
+        return time.time() - start
+
+    def swap(self):
+        self.query('SET SESSION lock_wait_timeout = %s', (ONLINE_LOCK_WAIT_TIMEOUT,))
+        self.query('RENAME TABLE {0} TO {1}, {2} TO {0}'.format(
+            self.full_name(self.table), self.full_name(self.old_table), self.full_name(self.new_table)))
+        self.drop_triggers()
+        self.query('DROP TABLE {0}'.format(self.full_name(self.old_table)))
+
+    def cleanup(self):
+        for sql in ['DROP TRIGGER IF EXISTS {0}'.format(self.full_name(t)) for t in self.triggers] + \
+                ['DROP TABLE IF EXISTS {0}'.format(self.full_name(self.new_table))]:
+            try:
+                self.query(sql)
+            except MySQLdb.Error as exc:
+                LOGGER.error('cleanup of {0} failed, run manually: {1} ({2})'.format(self.name, sql, exc))
+
+    # 返回：False表示不能以影子表方式执行
+    def run(self):
+        reason = self.unsupported()
+        if reason:
+            LOGGER.warning('{0} not altered online ({1}), running ALTER directly'.format(self.name, reason))
+            return False
+
+        pk = self.primary_key(self.table)
+        columns = self.columns(self.table)
+        self.connect_replicas()
+        try:
+            mapping = self.create_shadow(columns, pk)
+            self.create_triggers(mapping, pk)
+            elapsed = self.copy_rows(mapping, pk)
+            self.swap()
+        except Exception:
+            self.cleanup()
+            raise
+        finally:
+            self.close_replicas()
+
+        message = 'done: copied {0} rows in {1:.1f}s, paused {2:.0f}s'.format(self.copied, elapsed, self.paused)
+        LOGGER.info('{0} {1}'.format(self.name, message))
+        self.record_progress(message)
+        return True
+
+
+# 在当前连接中以影子表方式执行ALTER TABLE
+# 返回：False表示不是ALTER TABLE或不能以影子表方式执行
+def apply_online(conn, args, change_id, sql):
+    match = ALTER_PATTERN.match(sql)
+    if not match:
+        return False
+
+    names = split_table_name(match.group(1))
+    if len(names) == 1:
+        cur = conn.cursor()
+        try:
+            cur.execute('SELECT DATABASE()')
+            names.insert(0, cur.fetchone()[0])
+        finally:
+            cur.close()
+
+    return OnlineAlter(conn, args, change_id, names[0], names[1], match.group(2).strip()).run()
+
+
+# 在已建立的连接中执行变更脚本
+def apply_change_native(conn, args, file_path, change_id=None):
+    with io.open(file_path, encoding='utf-8') as fp:
+        statements = split_statements(fp.read())
+
+    LOGGER.debug('{0} statements in {1}'.format(len(statements), file_path))
+    execute_statements(conn, args, file_path, statements, change_id)
+
+
+# 在已建立的连接中依次执行语句，source为错误信息中的语句来源
+def execute_statements(conn, args, source, statements, change_id=None):
+    conn.autocommit(True)  # 与mysql客户端一致
+    cur = conn.cursor()
+    try:
+        for index, (line, sql) in enumerate(statements, 1):
+            preview = ' '.join(sql.split())
+            if len(preview) > STATEMENT_PREVIEW:
+                preview = preview[:STATEMENT_PREVIEW - 3] + '...'
+
+            LOGGER.debug('statement #{0} (line {1}): {2}'.format(index, line, sql))
+            start = time.time()
+            try:
+                if args.online and apply_online(conn, args, change_id, sql):
+                    rows = 0
+                else:
+                    cur.execute(sql)
+                    rows = cur.rowcount
+                    while cur.nextset() is not None:  # 存储过程等可能返回多个结果集
+                        pass
+            except (MySQLdb.Error, OnlineError) as exc:
+                raise ApplyError(source, 'statement #{0} (line {1}): {2}\n{3}'.format(index, line, sql, exc))
+
+            LOGGER.info('[{0}/{1}] {2:.3f}s, {3} rows: {4}'.format(
+                index, len(statements), time.time() - start, rows, preview))
+    finally:
+        cur.close()
+
+    conn.select_db(args.database)  # 脚本中可能使用USE切换数据库
+
+
+# 执行变更脚本
+def apply_change(conn, args, mysql_client, file_path, change_id=None):
+    if args.executor == 'native':
+        apply_change_native(conn, args, file_path, change_id)
+    else:
+        apply_change_client(args, mysql_client, file_path)
+
+
+# 按顶层逗号拆分ALTER TABLE的修改内容
+def split_clauses(text):
+    res = []
+    buf = []
+    depth = 0
+    quote = None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == '\\' and quote != '`':
+                buf.append(text[i:i + 2])
+                i += 2
+                continue
+            if c == quote:
+                quote = None
+        elif c in ('\'', '"', '`'):
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            res.append(''.join(buf).strip())
+            buf = []
+            i += 1
+            continue
+        buf.append(c)
+        i += 1
+
+    res.append(''.join(buf).strip())
+    return [c for c in res if c]
+
+
+# 修改涉及的列/索引
+# 返回：[(column|index, 小写名称)]，不能与其他变更合并时返回None
+def clause_targets(clause):
+    tokens = [t.strip('`') for t in re.findall(r'`[^`]*`|\w+|\S', clause)]
+    words = [t.upper() for t in tokens] + ['', '', '']
+    action = words[0]
+
+    if action in UNMERGEABLE_ACTIONS or words[1] in ('PARTITION', 'PARTITIONING'):
+        return None
+
+    # 未命名的索引/约束名称由MySQL生成，后面的变更可能按生成的名称修改，不合并；
+    # 添加外键（foreign_key_checks开启时只能COPY，且子表数据不满足时失败）使合并后的整条语句重建表或失败，不合并
+    if action == 'ADD':
+        if words[1] == 'CONSTRAINT':
+            if words[2] in ('PRIMARY', 'UNIQUE', 'FOREIGN', 'CHECK') or words[3] == 'FOREIGN':
+                return None
+            name = tokens[2].lower()
+            targets = [('constraint', name), ('index', name)]  # 唯一约束同时建立同名索引
+            return targets + [('index', 'primary')] if words[3] == 'PRIMARY' else targets
+        if words[1] == 'PRIMARY':
+            return [('index', 'primary')]
+        if words[1] in ('FOREIGN', 'CHECK'):
+            return None
+        if words[1] in ('INDEX', 'KEY', 'UNIQUE', 'FULLTEXT', 'SPATIAL'):
+            i = 3 if words[2] in ('INDEX', 'KEY') else 2
+            name = tokens[i] if i < len(tokens) and words[i] not in ('(', 'USING') else None
+            return [('index', name.lower())] if name else None
+        name = tokens[2] if words[1] == 'COLUMN' else tokens[1]
+        return None if name == '(' else [('column', name.lower())]  # ADD (c1 ..., c2 ...)不解析
+
+    if action == 'DROP':
+        if words[1] in ('INDEX', 'KEY'):
+            return [('index', tokens[2].lower())]
+        if words[1] == 'PRIMARY':
+            return [('index', 'primary')]
+        if words[1] == 'FOREIGN':
+            return [('constraint', tokens[3].lower())]
+        if words[1] in ('CHECK', 'CONSTRAINT'):
+            return [('constraint', tokens[2].lower()), ('index', tokens[2].lower())]
+        return [('column', (tokens[2] if words[1] == 'COLUMN' else tokens[1]).lower())]
+
+    if action in ('MODIFY', 'ALTER'):
+        if action == 'ALTER' and words[1] in ('INDEX', 'KEY'):
+            return [('index', tokens[2].lower())]
+        if action == 'ALTER' and words[1] in ('CHECK', 'CONSTRAINT'):
+            return [('constraint', tokens[2].lower())]
+        return [('column', (tokens[2] if words[1] == 'COLUMN' else tokens[1]).lower())]
+
+    if action == 'CHANGE':
+        i = 2 if words[1] == 'COLUMN' else 1
+        return [('column', tokens[i].lower()), ('column', tokens[i + 1].lower())]
+
+    if action == 'RENAME':
+        if words[1] in ('COLUMN', 'INDEX', 'KEY'):
+            kind = 'column' if words[1] == 'COLUMN' else 'index'
+            return [(kind, tokens[2].lower()), (kind, tokens[4].lower())]
+        return None  # 表改名
+
+    return []  # 表选项（ENGINE/CHARSET/COMMENT等）
+
+
+# 解析只包含对同一个表的ALTER TABLE的变更脚本
+# 返回：[(表名, 显示的表名, [修改])]，包含其他语句、其他表或不能合并的修改时返回None
+def parse_alters(args, file_path):
+    with io.open(file_path, encoding='utf-8') as fp:
+        statements = split_statements(fp.read())
+
+    res = []
+    for _, sql in statements:
+        match = ALTER_PATTERN.match(sql)
+        if not match:
+            return None
+
+        names = split_table_name(match.group(1), args.database)
+        clauses = split_clauses(match.group(2))
+        if any(clause_targets(c) is None for c in clauses):
+            return None
+
+        res.append(('.'.join(names).lower(), '.'.join(quote_name(n) for n in names), clauses))
+
+    if not res or len(set(key for key, _, _ in res)) > 1:
+        return None
+    return res
+
+
+# 执行计划：合并连续的只修改同一个表的ALTER TABLE变更，合并后为一条语句，整体成功或失败
+# 返回：[{'change_ids': [...], 'file_path': 不合并时的脚本, 'alters': [(显示的表名, [修改])], 'saved': 减少的重建次数}]
+def plan_changes(args, pending):
+    plan = []
+    group = []  # [(change_id, file_path, alters)]
+
+    def flush():
+        statements = sum(len(alters) for _, _, alters in group)
+        tables = []  # 按首次出现的顺序
+        merged = {}
+        for _, _, alters in group:
+            for key, display, clauses in alters:
+                if key not in merged:
+                    tables.append(key)
+                    merged[key] = (display, [])
+                merged[key][1].extend(clauses)
+
+        if len(group) > 1 and len(tables) < statements:
+            plan.append({'change_ids': [c for c, _, _ in group], 'file_path': None,
+                         'alters': [merged[t] for t in tables], 'saved': statements - len(tables)})
+        else:
+            for change_id, file_path, _ in group:
+                plan.append({'change_ids': [change_id], 'file_path': file_path, 'alters': [], 'saved': 0})
+        del group[:]
+
+    # 变更中修改的列/索引与组内前面的变更修改过的重叠时不能合并
+    def conflicts(alters):
+        touched = set()
+        for _, _, group_alters in group:
+            for key, _, clauses in group_alters:
+                for clause in clauses:
+                    touched.update((key,) + t for t in clause_targets(clause))
+        for key, _, clauses in alters:
+            for clause in clauses:
+                if any((key,) + t in touched for t in clause_targets(clause)):
+                    return True
+        return False
+
+    coalesce = args.executor == 'native' and not args.no_coalesce
+    for change_id, file_path in pending:
+        alters = parse_alters(args, file_path) if coalesce else None
+        if alters is None:
+            flush()
+            plan.append({'change_ids': [change_id], 'file_path': file_path, 'alters': [], 'saved': 0})
+            continue
+
+        if group and (group[0][2][0][0] != alters[0][0] or conflicts(alters)):
+            flush()
+        group.append((change_id, file_path, alters))
+
+    flush()
+    return plan
+
+
+def merged_sql(alter):
+    return 'ALTER TABLE {0} {1}'.format(alter[0], ', '.join(alter[1]))
+
+
+# 输出执行计划
+def print_plan(plan):
+    for index, step in enumerate(plan, 1):
+        ids = ', '.join('#{0}'.format(c) for c in step['change_ids'])
+        if step['file_path']:
+            print('{0}. {1}: {2}'.format(index, ids, step['file_path']))
+        else:
+            print('{0}. {1}: merged, {2} rebuilds saved'.format(index, ids, step['saved']))
+            for alter in step['alters']:
+                print('    {0};'.format(merged_sql(alter)))
+
+    print('{0} changes in {1} steps, {2} rebuilds saved'.format(
+        sum(len(s['change_ids']) for s in plan), len(plan), sum(s['saved'] for s in plan)))
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return '{0:.1f}s'.format(seconds)
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}h{1:02d}m{2:02d}s'.format(hours, minutes, seconds) if hours else '{0}m{1:02d}s'.format(minutes, seconds)
+
+
+# 估算执行计划中各语句的耗时及锁影响：在表结构相同、只包含样本数据的探测表上执行修改，
+# 以第一个成功的ALGORITHM及其耗时按行数估算；探测表随各步骤依次修改，结束时删除
+class CostEstimator(object):
+    def __init__(self, conn, args):
+        self.conn = conn
+        self.args = args
+        self.tables = {}  # 表名 -> (行数, 字节数)，不存在时为None
+        self.probes = {}  # 表名 -> (探测表, 样本行数)
+
+    def query(self, sql, sql_args=None):
+        LOGGER.debug('dry run: {0} {1}'.format(sql, sql_args if sql_args else ''))
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql, sql_args)
+            return cur.fetchall(), cur.rowcount
+        finally:
+            cur.close()
+
+    def table_info(self, schema, table):
+        key = (schema.lower(), table.lower())
+        if key not in self.tables:
+            rows, _ = self.query('SELECT TABLE_ROWS, DATA_LENGTH + INDEX_LENGTH FROM information_schema.TABLES '
+                                 'WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s', (schema, table))
+            self.tables[key] = (int(rows[0][0] or 0), int(rows[0][1] or 0)) if rows else None
+        return self.tables[key]
+
+    def has_primary_key(self, schema, table):
+        rows, _ = self.query("SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s "
+                             "AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY' LIMIT 1", (schema, table))
+        return bool(rows)
+
+    # 建立探测表并复制样本
+    # 返回：(探测表, 样本行数)
+    def probe_table(self, schema, table):
+        key = (schema.lower(), table.lower())
+        if key not in self.probes:
+            probe = '{0}.{1}'.format(quote_name(schema), quote_name('_{0}_probe'.format(table)))
+            source = '{0}.{1}'.format(quote_name(schema), quote_name(table))
+            rows, _ = self.query('SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s',
+                                 (schema, '_{0}_probe'.format(table)))
+            if rows:
+                raise DryRunError('{0} exists, remove it after checking it is a leftover probe table'.format(probe))
+            self.query('CREATE TABLE {0} LIKE {1}'.format(probe, source))
+            self.probes[key] = (probe, 0)
+
+            rows, _ = self.query('SELECT COLUMN_NAME, EXTRA FROM information_schema.COLUMNS '
+                                 'WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION',
+                                 (schema, table))
+            columns = ', '.join(quote_name(r[0]) for r in rows if 'GENERATED' not in r[1].upper())
+            _, sample = self.query('INSERT INTO {0} ({1}) SELECT {1} FROM {2} LIMIT %s'.format(probe, columns, source),
+                                   (self.args.sample_rows,))
+            self.probes[key] = (probe, max(sample, 0))
+        return self.probes[key]
+
+    def drop_probes(self):
+        for probe, _ in self.probes.values():
+            try:
+                self.query('DROP TABLE IF EXISTS {0}'.format(probe))
+            except MySQLdb.Error as exc:
+                LOGGER.error('failed to drop {0}, drop it manually: {1}'.format(probe, exc))
+        self.probes = {}
+
+    # 在探测表上依次尝试各执行方式
+    # 返回：(ALGORITHM, LOCK, 样本上的耗时, 错误)
+    def probe(self, schema, table, clauses, online):
+        candidates = PROBE_ALGORITHMS
+        options = {}
+        for clause in clauses:
+            match = re.match(r'^(ALGORITHM|LOCK)\s*=?\s*(\w+)$', clause, re.IGNORECASE)
+            if match:
+                options[match.group(1).upper()] = match.group(2).upper()
+        clauses = [c for c in clauses if not re.match(r'^(ALGORITHM|LOCK)\b', c, re.IGNORECASE)]
+
+        if online:  # 影子表复制与COPY相当
+            candidates = [('COPY', 'SHARED')]
+        elif 'ALGORITHM' in options or 'LOCK' in options:
+            candidates = [(a, options.get('LOCK', l)) for a, l in candidates
+                          if options.get('ALGORITHM', a) in (a, 'DEFAULT')]
+
+        probe, _ = self.probe_table(schema, table)
+        error = None
+        for algorithm, lock in candidates:
+            options = ['ALGORITHM={0}'.format(algorithm)] + (['LOCK={0}'.format(lock)] if lock else [])
+            sql = 'ALTER TABLE {0} {1}'.format(probe, ', '.join(clauses + options))
+            start = time.time()
+            try:
+                self.query(sql)
+                return algorithm, lock, time.time() - start, None
+            except MySQLdb.Error as exc:
+                error = exc
+        return None, None, 0, error
+
+    # 语句涉及的表及修改
+    # 返回：(语句类型, database, table, [修改])，不涉及表时返回None，不是ALTER时[修改]为None
+    def parse(self, sql):
+        match = ALTER_PATTERN.match(sql)
+        if match:
+            return ('ALTER TABLE',) + tuple(split_table_name(match.group(1), self.args.database)) + (
+                split_clauses(match.group(2)),)
+
+        match = CREATE_INDEX_PATTERN.match(sql)
+        if match:
+            kind = '{0} '.format(match.group(1).upper()) if match.group(1) else ''
+            clause = 'ADD {0}INDEX {1} {2}'.format(kind, match.group(2), match.group(4).strip())
+            return ('CREATE INDEX',) + tuple(split_table_name(match.group(3), self.args.database)) + ([clause],)
+
+        match = DROP_INDEX_PATTERN.match(sql)
+        if match:
+            clause = 'DROP INDEX {0}'.format(match.group(1))
+            return ('DROP INDEX',) + tuple(split_table_name(match.group(2), self.args.database)) + ([clause],)
+
+        match = TABLE_STATEMENT_PATTERN.match(sql)
+        if match:
+            kind = ' '.join(match.group(1).upper().split())
+            clauses = ['FORCE'] if kind == 'OPTIMIZE TABLE' else None  # InnoDB的OPTIMIZE TABLE即重建表
+            return (kind,) + tuple(split_table_name(match.group(2), self.args.database)) + (clauses,)
+
+        return None
+
+    # 估算一条语句
+    def estimate_statement(self, sql):
+        res = {'kind': sql.split()[0].upper(), 'table': '', 'rows': 0, 'bytes': 0, 'algorithm': '-', 'lock': '-',
+               'seconds': 0.0, 'mb_per_sec': None, 'note': ''}
+
+        parsed = self.parse(sql)
+        if not parsed:
+            return res
+
+        kind, schema, table, clauses = parsed
+        res.update({'kind': kind, 'table': '{0}.{1}'.format(schema, table)})
+        info = self.table_info(schema, table)
+        if info is None:
+            res['note'] = 'table not found' if kind != 'CREATE TABLE' else ''
+            return res
+
+        res['rows'], res['bytes'] = info
+        if clauses is None:
+            if kind.startswith(('UPDATE', 'DELETE', 'INSERT', 'REPLACE')):
+                res.update({'lock': 'row locks', 'note': 'DML, run time depends on rows matched'})
+            else:
+                res.update({'lock': 'metadata lock only'})
+            return res
+
+        if PROBE_UNSAFE_PATTERN.search(', '.join(clauses)):
+            res['note'] = 'not probed (rename/partition clauses)'
+            return res
+
+        online = (self.args.online and kind == 'ALTER TABLE' and not ONLINE_UNSAFE_PATTERN.search(', '.join(clauses))
+                  and self.has_primary_key(schema, table))
+        algorithm, lock, elapsed, error = self.probe(schema, table, clauses, online)
+        if not algorithm:
+            res['note'] = 'probe failed: {0}'.format(error)
+            return res
+
+        _, sample = self.probe_table(schema, table)
+        if algorithm != 'INSTANT' and sample:
+            res['seconds'] = elapsed * max(res['rows'], sample) / float(sample)
+            res['mb_per_sec'] = res['bytes'] * min(float(sample) / max(res['rows'], 1), 1) / 1024.0 / 1024 / \
+                max(elapsed, 0.001)
+
+        if online:
+            res.update({'algorithm': 'ONLINE', 'lock': LOCK_IMPACT['ONLINE'], 'note': 'excluding throttle pauses'})
+        else:
+            res.update({'algorithm': algorithm, 'lock': LOCK_IMPACT.get(lock or algorithm, lock)})
+        return res
+
+    # 估算执行计划
+    # 返回：[{'order': 步骤序号, 'change_ids': [...], ...语句估算}]
+    def estimate(self, plan):
+        # 探测表不复制至从库，不能关闭binlog时不执行
+        try:
+            self.query('SET SESSION sql_log_bin = 0')
+        except MySQLdb.Error as exc:
+            raise DryRunError('failed to disable binlog, probe tables would be replicated: {0}'.format(exc))
+
+        # 复制样本时使用一致性读，不对原表加锁
+        self.conn.autocommit(True)
+        self.query('SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED')
+
+        res = []
+        try:
+            for order, step in enumerate(plan, 1):
+                if step['file_path']:
+                    with io.open(step['file_path'], encoding='utf-8') as fp:
+                        statements = [sql for _, sql in split_statements(fp.read())]
+                else:
+                    statements = [merged_sql(alter) for alter in step['alters']]
+
+                for sql in statements:
+                    estimate = self.estimate_statement(sql)
+                    estimate.update({'order': order, 'change_ids': step['change_ids']})
+                    LOGGER.debug('estimate: {0}'.format(estimate))
+                    res.append(estimate)
+        finally:
+            self.drop_probes()
+
+        return res
+
+
+# 按估算耗时从长到短输出
+def print_estimates(estimates):
+    header = ('step', 'changes', 'statement', 'table', 'size_mb', 'rows', 'algorithm', 'lock', 'estimate', 'mb/s',
+              'note')
+    lines = [header]
+    for e in sorted(estimates, key=lambda x: (-x['seconds'], x['order'])):
+        lines.append((str(e['order']), ','.join('#{0}'.format(c) for c in e['change_ids']), e['kind'], e['table'],
+                      '{0:.1f}'.format(e['bytes'] / 1024.0 / 1024), str(e['rows']), e['algorithm'], e['lock'],
+                      format_seconds(e['seconds']) if e['algorithm'] not in ('-', 'INSTANT') else '-',
+                      '{0:.1f}'.format(e['mb_per_sec']) if e['mb_per_sec'] else '-', e['note']))
+
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    for line in lines:
+        print('  '.join(v.ljust(w) for v, w in zip(line, widths)).rstrip())
+
+    blocking = sum(e['seconds'] for e in estimates if e['lock'] in (LOCK_IMPACT['SHARED'], LOCK_IMPACT['EXCLUSIVE']))
+    print('{0} statements, estimated {1} in total, {2} with writes blocked'.format(
+        len(estimates), format_seconds(sum(e['seconds'] for e in estimates)), format_seconds(blocking)))
+
+
 # 写入变更记录
 def record_change(conn, args, change_id, description=None, end=False, success=False):
     if end:
@@ -255,12 +1350,36 @@ def record_change(conn, args, change_id, description=None, end=False, success=Fa
         cur.close()
 
 
+# 写入变更进度，变更记录表没有progress列时只输出至日志
+def record_progress(conn, args, change_id, progress):
+    if getattr(args, 'progress_column', True) is False:
+        return
+
+    sql = UPDATE_PROGRESS.format(database=args.database, table=args.table)
+    LOGGER.debug('record progress values: {0}'.format((progress, change_id)))
+
+    cur = conn.cursor()
+    try:
+        cur.execute(sql, (progress[:255], change_id))
+        conn.commit()
+    except MySQLdb.OperationalError as exc:
+        if exc.args[0] != 1054:  # ER_BAD_FIELD_ERROR
+            raise
+        args.progress_column = False
+        LOGGER.warning('{0}.{1} has no progress column, add it to record progress: ALTER TABLE {0}.{1} '
+                       'ADD COLUMN progress varchar(255) NULL'.format(args.database, args.table))
+    finally:
+        cur.close()
+
+
 # 设置log
 def config_log(args):
     level = logging.DEBUG if args.debug else logging.INFO
     LOGGER.setLevel(level)
 
-    formatter = logging.Formatter(fmt='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y%m%d_%H%M%S')
+    fmt = '%(asctime)s [%(threadName)s] [%(levelname)s] %(message)s' if args.targets else \
+        '%(asctime)s [%(levelname)s] %(message)s'
+    formatter = logging.Formatter(fmt=fmt, datefmt='%Y%m%d_%H%M%S')
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(level)
@@ -269,41 +1388,215 @@ def config_log(args):
     LOGGER.addHandler(console_handler)
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    config_log(args)
+# 读取目标列表
+# 返回：[(host, port, database)]
+def load_targets(args):
+    targets = []
+    with open(args.targets) as fp:
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            match = TARGET_PATTERN.match(line)
+            if not match:
+                raise ValueError('invalid target in {0}: {1}'.format(args.targets, line))
+
+            host, port, database = match.groups()
+            # 指定端口时不使用--socket（否则localhost上的各端口都连接socket对应的同一实例）
+            target = (host, int(port) if port else args.port, database, None if port else args.socket)
+            if target[:3] in [t[:3] for t in targets]:
+                raise ValueError('target {0} duplicate in {1}'.format(line, args.targets))
+            targets.append(target)
+
+    if not targets:
+        raise ValueError('no target in {0}'.format(args.targets))
+
+    LOGGER.debug('targets: {0}'.format(targets))
+    return targets
+
+
+# 待执行的变更
+# 返回：[(change_id, file_path)]
+def pending_changes(conn, args, all_scripts):
+    applied = applied_changes(conn, args)  # 已执行的变更记录
+
+    max_applied_id = None  # 已执行的最大变更ID
+    if applied:
+        max_applied_id = applied[0][0]
+
+        for record in applied:
+            if record[-1] in ('n', 'N'):  # 如果有失败记录，抛出异常，需先解决遗留问题
+                raise StateError(change_id=record[0], description=record[1])
+
+    res = []
+    for change_id in sorted(all_scripts.keys()):
+        if (change_id >= 1 and  # change_id为0的脚本作为基线，不执行
+                (max_applied_id is None or change_id > max_applied_id) and
+                (args.last is None or change_id <= args.last)):
+            res.append((change_id, all_scripts[change_id]))
+
+    return res
 
-    mysql_client = binary_path('mysql')  # mysql客户端路径
-    conn = connect(args)  # 建立数据库连接
 
+# 依次执行待执行的变更并记录
+# 每个变更执行成功后即加入applied（失败时调用方仍可得到已执行的变更）
+# 返回：执行的change_id列表
+def apply_changes(conn, args, mysql_client, all_scripts, applied=None):
+    pending = pending_changes(conn, args, all_scripts)
+    res = [] if applied is None else applied
+    for step in plan_changes(args, pending):
+        change_ids = step['change_ids']
+        if step['file_path']:
+            LOGGER.info('applying #{0}: {1}'.format(change_ids[0], step['file_path']))
+        else:
+            LOGGER.info('applying {0} merged ({1} rebuilds saved)'.format(
+                ', '.join('#{0}'.format(c) for c in change_ids), step['saved']))
+
+        for change_id in change_ids:
+            record_change(conn, args, change_id, description=os.path.basename(all_scripts[change_id]), end=False)
+
+        try:
+            if step['file_path']:
+                apply_change(conn, args, mysql_client, step['file_path'], change_ids[0])
+            else:
+                statements = [(0, merged_sql(alter)) for alter in step['alters']]
+                source = 'merged changes {0}'.format(', '.join('#{0}'.format(c) for c in change_ids))
+                execute_statements(conn, args, source, statements, change_ids[0])
+            for change_id in change_ids:
+                record_change(conn, args, change_id, end=True, success=True)
+        except Exception as exc:
+            for change_id in change_ids:
+                record_change(conn, args, change_id, end=True, success=False)
+            raise exc
+
+        res.extend(change_ids)
+
+    return res
+
+
+# 输出一个数据库的执行计划或估算
+def show_plan(args, all_scripts):
+    conn = connect(args)
+    try:
+        plan = plan_changes(args, pending_changes(conn, args, all_scripts))
+        if args.dry_run:
+            print_estimates(CostEstimator(conn, args).estimate(plan))
+        else:
+            print_plan(plan)
+    finally:
+        conn.close()
+
+
+# 将变更应用至一个目标
+def apply_target(args, mysql_client, all_scripts, result):
+    start = time.time()
+    conn = None
     try:
-        applied = applied_changes(conn, args)  # 已执行的变更记录
-
-        max_applied_id = None  # 已执行的最大变更ID
-        if applied:
-            max_applied_id = applied[0][0]
-
-            for record in applied:
-                if record[-1] in ('n', 'N'):  # 如果有失败记录，抛出异常，需先解决遗留问题
-                    raise StateError(change_id=record[0], description=record[1])
-
-        all_scripts = all_changes(args)  # 所有变更脚本
-        for change_id in sorted(all_scripts.keys()):
-            if (change_id >= 1 and  # change_id为0的脚本作为基线，不执行
-                    (max_applied_id is None or change_id > max_applied_id) and
-                    (args.last is None or change_id <= args.last)):
-                LOGGER.info('applying #{0}: {1}'.format(change_id, all_scripts[change_id]))
-
-                record_change(conn, args, change_id, description=os.path.basename(all_scripts[change_id]), end=False)
-
-                try:
-                    apply_change(args, mysql_client, all_scripts[change_id])
-                    record_change(conn, args, change_id, end=True, success=True)
-                except Exception as exc:
-                    record_change(conn, args, change_id, end=True, success=False)
-                    raise exc
+        conn = connect(args)
+        apply_changes(conn, args, mysql_client, all_scripts, result['applied'])
+        result['status'] = 'ok'
+    except Exception as exc:
+        LOGGER.error(str(exc))
+        result['status'] = 'failed'
+        result['error'] = str(exc).strip().split('\n')[-1]
     finally:
         if conn:
             conn.close()
+        result['elapsed'] = time.time() - start
+
+
+# 将变更并发应用至全部目标，同一主机同时最多args.per_host个
+# 返回：[result]，与targets顺序一致
+def apply_fleet(args, mysql_client, all_scripts, targets):
+    results = [{'target': '{0}:{1}/{2}'.format(*t), 'status': 'pending', 'applied': [], 'error': '', 'elapsed': 0}
+               for t in targets]
+    pending = list(range(len(targets)))
+    running = {}  # 主机 -> 执行中的目标数
+    cond = threading.Condition()
+
+    # 取下一个所在主机未达到并发上限的目标
+    def next_target():
+        with cond:
+            while pending:
+                for index in pending:
+                    if running.get(targets[index][0], 0) < args.per_host:
+                        pending.remove(index)
+                        running[targets[index][0]] = running.get(targets[index][0], 0) + 1
+                        return index
+                cond.wait()
+            return None
+
+    def worker():
+        while True:
+            index = next_target()
+            if index is None:
+                return
+
+            host = targets[index][0]
+            target_args = copy.copy(args)
+            target_args.host, target_args.port, target_args.database, target_args.socket = targets[index]
+
+            threading.current_thread().name = results[index]['target']  # 日志中显示目标
+            results[index]['status'] = 'running'
+            apply_target(target_args, mysql_client, all_scripts, results[index])
+            LOGGER.info('{0} in {1:.1f}s, applied: {2}'.format(
+                results[index]['status'], results[index]['elapsed'], results[index]['applied']))
+
+            with cond:
+                running[host] -= 1
+                cond.notify_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(args.workers, len(targets)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+# 输出各目标的执行结果
+def print_summary(results):
+    width = max(len(r['target']) for r in results)
+    print('{0}  {1:<7} {2:>9} {3:>8}  {4}'.format('target'.ljust(width), 'status', 'elapsed', 'applied', 'detail'))
+    for r in results:
+        detail = r['error'] if r['status'] == 'failed' else (
+            '#{0}-#{1}'.format(r['applied'][0], r['applied'][-1]) if r['applied'] else 'up to date')
+        print('{0}  {1:<7} {2:>8.1f}s {3:>8}  {4}'.format(
+            r['target'].ljust(width), r['status'], r['elapsed'], len(r['applied']), detail))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config_log(args)
+
+    mysql_client = binary_path('mysql') if args.executor == 'mysql' else None  # mysql客户端路径
+    all_scripts = all_changes(args)  # 所有变更脚本
+
+    if args.plan or args.dry_run:
+        for target in load_targets(args) if args.targets else [(args.host, args.port, args.database, args.socket)]:
+            target_args = copy.copy(args)
+            target_args.host, target_args.port, target_args.database, target_args.socket = target
+            if args.targets:
+                print('{0}:{1}/{2}'.format(*target))
+            show_plan(target_args, all_scripts)
+    elif args.targets:
+        targets = load_targets(args)
+        start = time.time()
+        results = apply_fleet(args, mysql_client, all_scripts, targets)
+        print_summary(results)
+
+        failed = len([r for r in results if r['status'] != 'ok'])
+        LOGGER.info('{0} targets in {1:.1f}s, {2} failed'.format(len(results), time.time() - start, failed))
+        if failed:
+            raise FleetError(failed, len(results))
+    else:
+        conn = connect(args)  # 建立数据库连接
+        try:
+            apply_changes(conn, args, mysql_client, all_scripts)
+        finally:
+            if conn:
+                conn.close()
 
     LOGGER.info('Done!')
@@ -0,0 +1,130 @@
+#! /usr/bin/python
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import types
+import shutil
+import argparse
+import tempfile
+import unittest
+
+# mysql_schema_change导入时依赖MySQLdb，被测函数不连接数据库，未安装时使用空模块代替
+try:
+    import MySQLdb
+except ImportError:
+    sys.modules['MySQLdb'] = types.ModuleType('MySQLdb')
+
+import mysql_schema_change
+
+
+class SplitStatementsTest(unittest.TestCase):
+    def assertSplit(self, text, statements):
+        self.assertEqual(mysql_schema_change.split_statements(text), statements)
+
+    def test_delimiter(self):
+        text = 'DELIMITER ;;\nCREATE TRIGGER t1 BEFORE INSERT ON t FOR EACH ROW BEGIN SET @a = 1; END;;\n' \
+               'DELIMITER ;\nSELECT 1;\n'
+        self.assertSplit(text, [
+            (2, 'CREATE TRIGGER t1 BEFORE INSERT ON t FOR EACH ROW BEGIN SET @a = 1; END'),
+            (4, 'SELECT 1')
+        ])
+
+    # 语句内以delimiter开头的行（同名列）不是DELIMITER命令
+    def test_delimiter_column(self):
+        text = 'CREATE TABLE t (\n  id INT,\n  delimiter VARCHAR(1)\n);\nSELECT 1;\n'
+        self.assertSplit(text, [
+            (1, 'CREATE TABLE t (\n  id INT,\n  delimiter VARCHAR(1)\n)'),
+            (5, 'SELECT 1')
+        ])
+
+    def test_quoted_delimiter(self):
+        self.assertSplit("INSERT INTO t VALUES ('a;b');\nSELECT 1;", [
+            (1, "INSERT INTO t VALUES ('a;b')"),
+            (2, 'SELECT 1')
+        ])
+        self.assertSplit('SELECT `a;b` FROM t;', [(1, 'SELECT `a;b` FROM t')])
+
+    def test_escaped_quote(self):
+        self.assertSplit('SELECT "x\\";";\nSELECT 2;', [(1, 'SELECT "x\\";"'), (2, 'SELECT 2')])
+
+    def test_doubled_quote(self):
+        self.assertSplit("SELECT 'it''s;';\nSELECT 2;", [(1, "SELECT 'it''s;'"), (2, 'SELECT 2')])
+
+    def test_comments(self):
+        self.assertSplit('SELECT 1; # c;\nSELECT 2; -- d;\nSELECT /* e; */ 3;', [
+            (1, 'SELECT 1'),
+            (2, 'SELECT 2'),
+            (3, 'SELECT   3')
+        ])
+        self.assertSplit('SELECT /*!40101 1 */;\n', [(1, 'SELECT /*!40101 1 */')])
+
+    # --后没有空白时不是注释
+    def test_double_dash(self):
+        self.assertSplit('SELECT 1--1;\nSELECT 2;', [(1, 'SELECT 1--1'), (2, 'SELECT 2')])
+
+
+class PlanChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.args = argparse.Namespace(database='db', executor='native', no_coalesce=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # 依次写入变更脚本并生成执行计划
+    # 返回：[(change_ids, saved)]
+    def plan(self, *scripts):
+        pending = []
+        for change_id, sql in enumerate(scripts, 1):
+            file_path = os.path.join(self.directory, '{0}_change.sql'.format(change_id))
+            with open(file_path, 'w') as fp:
+                fp.write(sql)
+            pending.append((change_id, file_path))
+        return [(step['change_ids'], step['saved']) for step in mysql_schema_change.plan_changes(self.args, pending)]
+
+    def test_merge(self):
+        self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', 'ALTER TABLE t ADD INDEX ia (a);'), [([1, 2], 1)])
+
+    def test_other_table(self):
+        self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', 'ALTER TABLE u ADD COLUMN a INT;'),
+                         [([1], 0), ([2], 0)])
+
+    # 修改前面变更修改过的列时不合并
+    def test_same_column(self):
+        self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', 'ALTER TABLE t MODIFY a BIGINT;'),
+                         [([1], 0), ([2], 0)])
+        self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', 'ALTER TABLE t ADD COLUMN b INT;',
+                                   'ALTER TABLE t CHANGE b c INT;'),
+                         [([1, 2], 1), ([3], 0)])
+
+    def test_unmergeable(self):
+        for sql in ('ALTER TABLE t ADD INDEX (b);',
+                    'ALTER TABLE t ADD CONSTRAINT fk FOREIGN KEY (b) REFERENCES p (id);',
+                    'ALTER TABLE t ADD COLUMN b INT, ALGORITHM=INPLACE;'):
+            self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', sql), [([1], 0), ([2], 0)])
+
+    def test_no_coalesce(self):
+        self.args.no_coalesce = True
+        self.assertEqual(self.plan('ALTER TABLE t ADD COLUMN a INT;', 'ALTER TABLE t ADD INDEX ia (a);'),
+                         [([1], 0), ([2], 0)])
+
+    def test_split_clauses(self):
+        self.assertEqual(mysql_schema_change.split_clauses(
+            "ADD COLUMN a INT COMMENT 'x, y', ADD COLUMN b INT COMMENT \"it's, ok\", ADD INDEX ib (a, b)"), [
+            "ADD COLUMN a INT COMMENT 'x, y'",
+            'ADD COLUMN b INT COMMENT "it\'s, ok"',
+            'ADD INDEX ib (a, b)'
+        ])
+
+    def test_clause_targets(self):
+        self.assertEqual(mysql_schema_change.clause_targets('ADD CONSTRAINT uk UNIQUE (a)'),
+                         [('constraint', 'uk'), ('index', 'uk')])
+        self.assertEqual(mysql_schema_change.clause_targets('DROP PRIMARY KEY'), [('index', 'primary')])
+        self.assertEqual(mysql_schema_change.clause_targets('RENAME COLUMN a TO b'), [('column', 'a'), ('column', 'b')])
+        self.assertEqual(mysql_schema_change.clause_targets('ENGINE=InnoDB'), [])
+        self.assertIsNone(mysql_schema_change.clause_targets('ADD UNIQUE (a)'))
+
+
+if __name__ == '__main__':
+    unittest.main()